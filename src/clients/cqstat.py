@@ -157,7 +157,7 @@ if __name__ == '__main__':
         else:
             header = default_header
 
-        # build query from long_header (all fields) and fetch response
+        # build the query from the displayed fields known to the queue-manager, and the fields they are derived from
         try:
             query = []
             for n in names:
@@ -168,8 +168,11 @@ if __name__ == '__main__':
         except ValueError:
             print "jobids must be integers"
             sys.exit(2)
+        displayed = [h.lower() for h in header]
         for q in query:
             for h in long_header:
+                if h.lower() not in displayed:
+                    continue
                 if h == 'JobName':
                     q.update({'outputpath':'*'})
                 elif h != 'JobID':
@@ -195,40 +198,46 @@ if __name__ == '__main__':
         if response:
             maxjoblen = max([len(str(item.get('jobid'))) for item in response])
             jobidfmt = "%%%ss" % maxjoblen
-        # calculate derived values
+        # calculate derived values from the fields that were requested
         for j in response:
+            started = j.get('starttime') not in ('-1', 'BUG', 'N/A', None)
             # remainingtime
-            if j.get('starttime') in ('-1', 'BUG', 'N/A', None):
-                j['remainingtime'] = 'N/A'
-            else:
-                j['remainingtime'] = get_elapsed_time(time.time() - float(j.get('starttime')), float(j.get('walltime')) * 60.0)      
+            if 'remainingtime' in displayed:
+                if not started:
+                    j['remainingtime'] = 'N/A'
+                else:
+                    j['remainingtime'] = get_elapsed_time(time.time() - float(j.get('starttime')), float(j.get('walltime')) * 60.0)      
             # walltime
-            t = int(float(j['walltime']))
-            h = int(math.floor(t/60))
-            t -= (h * 60)
-            j['walltime'] = "%02d:%02d:00" % (h, t)
+            if 'walltime' in j:
+                t = int(float(j['walltime']))
+                h = int(math.floor(t/60))
+                t -= (h * 60)
+                j['walltime'] = "%02d:%02d:00" % (h, t)
             # jobid
             j['jobid'] = jobidfmt % j['jobid']
             # location
-            if isinstance(j['location'], types.ListType) and len(j['location']) > 1:
+            if isinstance(j.get('location'), types.ListType) and len(j['location']) > 1:
                 j['location'] = Cobalt.Util.merge_nodelist(j['location'])
-            elif isinstance(j['location'], types.ListType) and len(j['location']) == 1:
+            elif isinstance(j.get('location'), types.ListType) and len(j['location']) == 1:
                 j['location'] = j['location'][0]
             # queuedtime
-            if j.get('starttime') in ('-1', 'BUG', 'N/A', None):
-                j['queuedtime'] = get_elapsed_time(float(j.get('submittime')), time.time())
-            else:
-                j['queuedtime'] = get_elapsed_time(float(j.get('submittime')), float(j['starttime']))
+            if 'queuedtime' in displayed:
+                if not started:
+                    j['queuedtime'] = get_elapsed_time(float(j.get('submittime')), time.time())
+                else:
+                    j['queuedtime'] = get_elapsed_time(float(j.get('submittime')), float(j['starttime']))
             # runtime
-            if j.get('starttime') in ('-1', 'BUG', 'N/A', None):
-                j['runtime'] = 'N/A'
-            else:
-                j['runtime'] = get_elapsed_time( float(j['starttime']), time.time())
+            if 'runtime' in displayed:
+                if not started:
+                    j['runtime'] = 'N/A'
+                else:
+                    j['runtime'] = get_elapsed_time( float(j['starttime']), time.time())
             # starttime
-            if j.get('starttime') in ('-1', 'BUG', None):
-                j['starttime'] = 'N/A'
-            else:
-                j['starttime'] = sec_to_str(float(j['starttime']))
+            if 'starttime' in j:
+                if j.get('starttime') in ('-1', 'BUG', None):
+                    j['starttime'] = 'N/A'
+                else:
+                    j['starttime'] = sec_to_str(float(j['starttime']))
             # jobname
             outputpath = j.get('outputpath')
             if outputpath:
@@ -236,19 +245,23 @@ if __name__ == '__main__':
                 if jobname != j['jobid'].split()[0]:
                     j['jobname'] = jobname
             # envs
-            if j['envs'] is None:
-                j.update({'envs':''})
-            else:
-                j['envs'] = ' '.join([str(x) + '=' + str(y) for x, y in j['envs'].iteritems()])
+            if 'envs' in j:
+                if j['envs'] is None:
+                    j.update({'envs':''})
+                else:
+                    j['envs'] = ' '.join([str(x) + '=' + str(y) for x, y in j['envs'].iteritems()])
             # args
-            j['args'] = ' '.join(j['args'])
+            if 'args' in j:
+                j['args'] = ' '.join(j['args'])
             
             # make the SubmitTime readable by humans
-            j['submittime'] = sec_to_str(float(j['submittime']))
+            if 'submittime' in j:
+                j['submittime'] = sec_to_str(float(j['submittime']))
             
             j['outputpath'] = outputpath
             j['errorpath'] = j.get('errorpath')
-            j['user_list'] = ':'.join(j['user_list'])
+            if 'user_list' in j:
+                j['user_list'] = ':'.join(j['user_list'])
 
         # any header that was not present in the query response has value set to '-'
         output = [[j.get(x, '-') for x in [y.lower() for y in header]]
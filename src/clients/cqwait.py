@@ -49,14 +49,24 @@ if __name__ == '__main__':
             logger.error("jobid must be an integer")
             raise SystemExit, 1
     
-    if opts['start']:
-        query = [{'tag':'job', 'jobid':jid, 'is_active':False, 'has_completed':False} for jid in args]
-    else:
-        query = [{'tag':'job', 'jobid':jid} for jid in args]
-    
-    while True:
-        response = cqm.get_jobs(query)
-        if len(response) == 0:
-            raise SystemExit, 0
+    if '*' in args:
+        # a wildcard cannot be watched; poll until no job matches
+        if opts['start']:
+            query = [{'tag':'job', 'jobid':jid, 'is_active':False, 'has_completed':False} for jid in args]
         else:
+            query = [{'tag':'job', 'jobid':jid} for jid in args]
+        while cqm.get_jobs(query, {'count':True}) != 0:
             Cobalt.Util.sleep(2)
+        raise SystemExit, 0
+
+    if opts['start']:
+        states = ['starting', 'running', 'killing', 'preempting', 'exiting', 'done']
+    else:
+        states = ['done']
+
+    # the queue manager holds each call until a watched job reaches one of the states or the wait times out
+    waiting = args
+    while waiting:
+        reached = [job['jobid'] for job in cqm.wait_for_jobs(waiting, states, 60)]
+        waiting = [jid for jid in waiting if jid not in reached]
+    raise SystemExit, 0
@@ -33,10 +33,12 @@ if __name__ == '__main__':
         print "Failed to connect to scheduler"
         raise SystemExit, 1
 
+    # only the partitions displayed are fetched, largest first; the children of a partition are only needed if it is
+    # reserved
     spec = [{'tag':'partition', 'name':'*', 'queue':'*', 'state':'*', 'size':'*',
-             'functional':'*', 'scheduled':'*', 'children':'*', 'backfill_time':"*", 'draining':"*"}]
+             'functional':True, 'scheduled':True, 'backfill_time':"*", 'draining':"*"}]
     try:
-        parts = system.get_partitions(spec)
+        parts = system.get_partitions(spec, {'sort':['-size', 'name']})
     except xmlrpclib.Fault, flt:
         if flt.faultCode == NotSupportedError.fault_code:
             print "incompatible with cluster support:  try nodelist"
@@ -46,31 +48,30 @@ if __name__ == '__main__':
 
     reservations = scheduler.get_reservations([{'queue':"*", 'partitions':"*", 'active':True}])
 
+    reserved_names = set()
+    for res in reservations:
+        reserved_names.update(res['partitions'].split(":"))
+    children = {}
+    if reserved_names:
+        for p in system.get_partitions([{'name':name, 'children':'*'} for name in reserved_names],
+                {'fields':['name', 'children']}):
+            children[p['name']] = p['children']
+
     expanded_parts = {}
     for res in reservations:
         for res_part in res['partitions'].split(":"):
-            for p in parts:
-                if p['name'] == res_part:
-                    if expanded_parts.has_key(res['queue']):
-                        expanded_parts[res['queue']].update(p['children'])
-                    else:
-                        expanded_parts[res['queue']] = set( p['children'] )
-                    expanded_parts[res['queue']].add(p['name'])
+            if children.has_key(res_part):
+                if expanded_parts.has_key(res['queue']):
+                    expanded_parts[res['queue']].update(children[res_part])
+                else:
+                    expanded_parts[res['queue']] = set( children[res_part] )
+                expanded_parts[res['queue']].add(res_part)
         
     
     for res in reservations:
         for p in parts:
             if p['name'] in expanded_parts.get(res['queue'], []):
                 p['queue'] += ":%s" % res['queue']
-
-    def my_cmp(left, right):
-        val = -cmp(int(left['size']), int(right['size']))
-        if val == 0:
-            return cmp(left['name'], right['name'])
-        else:
-            return val
-
-    parts.sort(my_cmp)
     
     now = time.time()
     for part in parts:
@@ -89,5 +90,5 @@ if __name__ == '__main__':
 
     header = [['Name', 'Queue', 'State', 'Backfill']]
     #build output list, adding
-    output = [[part.get(x) for x in [y.lower() for y in header[0]]] for part in parts if part['functional'] and part['scheduled']]
+    output = [[part.get(x) for x in [y.lower() for y in header[0]]] for part in parts]
     Cobalt.Util.printTabular(header + output)
@@ -6,6 +6,7 @@ __revision__ = '$Revision: 1 $'
 
 import os
 import sys
+import collections
 import logging
 import ConfigParser
 import traceback
@@ -18,6 +19,7 @@ except ImportError:
 import db2util
 
 import Cobalt.Logging, Cobalt.Util
+from Cobalt.Logging import MessageSpool
 from Cobalt.Statistics import Statistics
 from Cobalt.Components.DBWriter.cdbMessages import LogMessage, LogMessageDecoder, LogMessageEncoder
 from Cobalt.Components.base import Component, exposed, automatic, query, locking
@@ -38,6 +40,9 @@ def get_cdbwriter_config(option, default):
       value = default
    return value
 
+#messages read back from the overflow spool at a time
+spool_batch_size = int(get_cdbwriter_config('spool_batch_size', 1000))
+
 
 class MessageQueue(Component):
    
@@ -61,22 +66,22 @@ class MessageQueue(Component):
       Component.__init__(self, *args, **kwargs)
       self.sync_state = Cobalt.Util.FailureMode("Foreign Data Sync")
       self.connected = False
-      self.msg_queue = []
+      self.msg_queue = collections.deque()
       self.decoder = LogMessageDecoder()
 
       self.overflow = False
       self.overflow_filename = None
-      self.overflow_file = None
-      self.clearing_overflow = False
+      self.spool = None
       
       self.max_queued = int(get_cdbwriter_config('max_queued_msgs', '-1'))
                         
       if self.max_queued <= 0:
          logger.info("message queue set to unlimited.")
          self.max_queued = None
+      else:
          self.overflow_filename = get_cdbwriter_config('overflow_file', None)
          
-      if self.overflow_filename == None:
+      if self.max_queued and (self.overflow_filename == None):
          logger.warning("No file given to catch maximum messages. Setting queue size to unlimited.")
          self.max_queued = None
 
@@ -86,19 +91,18 @@ class MessageQueue(Component):
        state.update(Component.__getstate__(self))
        state.update({
                'cdbwriter_version': 1,
-               'msg_queue': self.msg_queue,
+               'msg_queue': list(self.msg_queue),
                'overflow': self.overflow})
        return state
              
    def __setstate__(self, state):
       Component.__setstate__(self, state)
 
-      self.msg_queue = state['msg_queue']
+      self.msg_queue = collections.deque(state['msg_queue'])
       self.connected = False
       self.decoder = LogMessageDecoder()
-      self.clearing_overflow = False
       self.overflow_filename = None
-      self.overflow_file = None
+      self.spool = None
       self.max_queued = int(get_cdbwriter_config('max_queued_msgs', '-1'))
                         
       if self.max_queued <= 0:
@@ -132,6 +136,20 @@ class MessageQueue(Component):
       else:
          self.connected = True
 
+   def write_message(self, msg):
+      """Add a message to the database.  Returns False if the connection to the database was lost."""
+      try:
+         self.database_writer.addMessage(msg)
+      except db2util.adapterError:
+         logger.error ("Error updating databse.  Unable to add message due to adapter error. Message dropped.")
+         logging.debug(traceback.format_exc())
+      except:
+         logger.error ("Error updating databse.  Unable to add message.")
+         logging.debug(traceback.format_exc())
+         self.connected = False
+         return False
+      return True
+
    def iterate(self):
       """Go through the messages that are sitting on the queue and
       load them into the database."""
@@ -140,47 +158,36 @@ class MessageQueue(Component):
       if not self.connected:
          logger.debug("Attempting reconnection.")
          self.init_database_connection()
-      
-      if self.connected and self.overflow:
-         self.clearing_overflow = True
-         self.open_overflow('r')
-         if self.overflow_file:
-            overflow_queue = [self.decoder.decode(line) 
-                              for line in self.overflow_file]
-            overflow_queue.extend(self.msg_queue)
-            self.msg_queue = overflow_queue
-            self.close_overflow()
-            self.del_overflow()
-            self.overflow = False
-
-      while self.msg_queue and self.connected:
-         msg = self.msg_queue[0]
-
-         try:
-            self.database_writer.addMessage(msg)
-         except db2util.adapterError:
-            logger.error ("Error updating databse.  Unable to add message due to adapter error. Message dropped.")
-            logging.debug(traceback.format_exc())
-            self.msg_queue.pop(0)
-         except:
-            logger.error ("Error updating databse.  Unable to add message.")
-            logging.debug(traceback.format_exc())
-            self.connected = False
-            #if we were clearing an overflow, here we go again.
-            if ((self.max_queued != None) and
-                (len(self.msg_queue) >= self.max_queued)):
-               self.overflow = True
-               self.open_overflow('a')
-               if self.overflow_file != None:
-                  self.queue_to_overflow()
-                  self.close_overflow()
 
+      #spooled messages are older than any in memory, so they go first, a batch at a time.
+      spool = self.get_spool()
+      while self.connected and spool and not spool.empty():
+         entries, position = spool.read(spool_batch_size)
+         if not entries and position == spool.cursor:
+            #only an incomplete message is left
             break
+         written = spool.cursor
+         for line, line_position in entries:
+            try:
+               msg = self.decoder.decode(line)
+            except ValueError:
+               logger.error("Bad message in overflow spool.  Failed to decode string %s" % line)
+            else:
+               if not self.write_message(msg):
+                  break
+            written = line_position
          else:
-            #message added
-            self.msg_queue.pop(0)
-            
-      self.clearing_overflow = False
+            written = position
+         spool.consume(written)
+
+      while self.msg_queue and self.connected:
+         if self.write_message(self.msg_queue[0]):
+            self.msg_queue.popleft()
+
+      #if we're not connected, keep the queue from consuming all memory
+      if ((not self.connected) and (self.max_queued != None) and
+          (len(self.msg_queue) >= self.max_queued)):
+         self.queue_to_overflow()
 
    iterate = automatic(iterate)
 
@@ -189,16 +196,8 @@ class MessageQueue(Component):
      
       #keep the queue from consuming all memory
       if ((self.max_queued != None) and
-          (len(self.msg_queue) >= self.max_queued)and
-          (not self.clearing_overflow)):
-         
-         self.overflow = True
-         self.open_overflow('a')
-         if self.overflow_file == None:
-            logger.critical("MESSAGE DROPPED: %s", msg)
-         else:
-            self.queue_to_overflow()
-            self.close_overflow()
+          (len(self.msg_queue) >= self.max_queued)):
+         self.queue_to_overflow()
       #and now queue as normal
 
       msgDict = None
@@ -215,6 +214,12 @@ class MessageQueue(Component):
       self.msg_queue.append(msgDict) 
       
    add_message = exposed(add_message)
+
+   def add_messages(self, msgs):
+      """Queue a batch of messages, in order."""
+      for msg in msgs:
+         self.add_message(msg)
+   add_messages = exposed(add_messages)
    
    
    def save_me(self):
@@ -222,41 +227,30 @@ class MessageQueue(Component):
    save_me = automatic(save_me)
 
 
-   def open_overflow(self, mode):
-        
-      try:
-         self.overflow_file = open(self.overflow_filename,mode)
-      except:
-         self.logger.critical("Unable to open overflow file!  Information to database will be lost!")
-
-   def close_overflow(self):
-      if self.overflow and self.overflow_file:
-         self.overflow_file.close()
-         self.overflow_file = None
-    
-   def del_overflow(self):
-      os.remove(self.overflow_filename)
-        
+   def get_spool(self):
+      """Return the spool at the overflow file, or None if no overflow file is configured."""
+      if self.spool is None and self.overflow_filename:
+         try:
+            self.spool = MessageSpool(self.overflow_filename)
+         except (IOError, OSError), e:
+            self.logger.critical("Unable to open overflow spool %s: %s" % (self.overflow_filename, e))
+      return self.spool
 
    def queue_to_overflow(self):
-        
-      elements_written = 0
-      if len(self.msg_queue) == 0:
-         return
-
-      while self.msg_queue:
-         msg = self.msg_queue.pop(0)
-         try:
-            self.overflow_file.write(json.dumps(msg, cls=LogMessageEncoder)+'\n')
-            elements_written += 1
-         except IOError:
-            logger.error('Could only partially empty queue, %d messages written' % 
-                         elements_written)
-            self.msg_queue.insert(0, msg)
-                
-      if elements_written > 0:
-         del self.msg_queue[0:elements_written-1] #empty the queue of what we have written
-        
+      """Move the queued messages to the end of the spool; return the number left in memory."""
+      spool = self.get_spool()
+      if spool is None or not self.msg_queue:
+         if self.msg_queue:
+            self.logger.critical("Unable to spool messages; %d held in memory." % len(self.msg_queue))
+         return len(self.msg_queue)
+      try:
+         spool.append([json.dumps(msg, cls=LogMessageEncoder) for msg in self.msg_queue])
+      except (IOError, OSError), e:
+         #the spool may have taken some of the messages; better to write those twice than lose the rest
+         self.logger.critical("Unable to write to overflow spool %s: %s" % (self.overflow_filename, e))
+      else:
+         self.msg_queue.clear()
+         self.overflow = True
       return len(self.msg_queue)
 
 #for storing the message queue to avoid memory problems:
@@ -373,24 +367,24 @@ class DatabaseWriter(object):
       part_list = logMsg.item.partitions.split(':')
       
       if part_list[0] != '':
-         for partition in part_list:
-            res_partitions_record = self.daos['RESERVATION_PARTS'].table.getRecord({
+         self.daos['RESERVATION_PARTS'].insert_many([
+            self.daos['RESERVATION_PARTS'].table.getRecord({
                'RES_DATA_ID': res_data_id,
                'NAME': partition
                })
-            self.daos['RESERVATION_PARTS'].insert(res_partitions_record)
+            for partition in part_list])
       
 
       if logMsg.item.users:
          user_list = logMsg.item.users.split(':')
 
          if user_list[0] != '':
-            for user in user_list:
-               res_users_record = self.daos['RESERVATION_USERS'].table.getRecord({
+            self.daos['RESERVATION_USERS'].insert_many([
+               self.daos['RESERVATION_USERS'].table.getRecord({
                      'RES_DATA_ID': res_data_id,
                      'NAME': user #eventually a FK into users from cbank?
-                     }) 
-               self.daos['RESERVATION_USERS'].insert(res_users_record)
+                     })
+               for user in user_list])
 
             
       reservation_event_record = self.daos['RESERVATION_EVENTS'].table.getRecord({'NAME': logMsg.state})
@@ -497,12 +491,12 @@ class DatabaseWriter(object):
           job_data_id = self.daos['JOB_DATA'].insert(job_data_record)
       
       #populate job_attrs, if needed.
-      for key in specialObjects['attrs'].keys():
-          job_attr_record = self.daos['JOB_ATTR'].table.getRecord({
+      self.daos['JOB_ATTR'].insert_many([
+              self.daos['JOB_ATTR'].table.getRecord({
                   'JOB_DATA_ID' : job_data_id,
                   'KEY' : key,
                   'VALUE' : str(specialObjects['attrs'][key])})
-          self.daos['JOB_ATTR'].insert(job_attr_record)
+              for key in specialObjects['attrs'].keys()])
       
 
       #populate job_deps
@@ -519,11 +513,11 @@ class DatabaseWriter(object):
       #parse and add users:
 
       if specialObjects.has_key('job_user_list'):
-        for user_name in specialObjects['job_user_list']:
-            job_run_users_record = self.daos['JOB_RUN_USERS'].table.getRecord({
+        self.daos['JOB_RUN_USERS'].insert_many([
+              self.daos['JOB_RUN_USERS'].table.getRecord({
                   'JOB_DATA_ID' : job_data_id,
                   'USER_NAME' : user_name})
-            self.daos['JOB_RUN_USERS'].insert(job_run_users_record)
+              for user_name in specialObjects['job_user_list']])
 
 
       self.__addJobProgMsg(logMsg, logMsg.item.job_prog_msg, job_data_id)
@@ -715,6 +709,9 @@ class DatabaseWriter(object):
    
    
 class StateTableData(db2util.dao):
+
+   # the event and state tables are fixed, so the ids found for each name are kept
+   _matches = None
    
    def getStatesDict(self):
       SQL = "select * from %s.%s" % (self.table.schema, self.table.table)
@@ -731,9 +728,15 @@ class StateTableData(db2util.dao):
       """look up the id for a given state-change identifier.  
       This had better be in this table."""
 
-      SQL = "select ID from %s.%s where NAME = '%s'" % (self.table.schema, self.table.table, record.v.NAME)
-      
-      return self.db.getDict(SQL)
+      if self._matches is None:
+         self._matches = {}
+      match = self._matches.get(record.v.NAME)
+      if not match:
+         SQL = "select ID from %s.%s where NAME = '%s'" % (self.table.schema, self.table.table, record.v.NAME)
+         match = self.db.getDict(SQL)
+         if match:
+            self._matches[record.v.NAME] = match
+      return match
       
 
 class ResDataData(db2util.dao):
@@ -881,6 +884,27 @@ class no_pk_dao(db2util.dao):
         except db2util.dbError:
             raise
 
+    def insert_many (self, records):
+        """Inserts the passed records with a single multi-row statement"""
+
+        if not records:
+            return
+
+        for record in records:
+            invalidFields = record.invalidFields()
+            if invalidFields:
+                raise db2util.adapterError("Validation error prior to insert.\n\nTable: %s\n\nField(s): %s\n" % (record.fqtn, str(invalidFields)))
+
+        places = "(%s)" % db2util.valueFormatter(records[0], db2util.FFORMAT.PLACES)
+        insertSQL = "insert into %s (%s) values %s" %(
+            self.table.fqName,
+            db2util.valueFormatter(records[0], db2util.FFORMAT.NAMES),
+            ", ".join([places] * len(records)))
+        values = []
+        for record in records:
+            values.extend(db2util.helpers.num2str(db2util.valueFormatter(record, db2util.FFORMAT.VALUES)))
+        self.db.prepExec(insertSQL, values)
+
 		
 		
         
@@ -2,28 +2,32 @@
 
 __revision__ = '$Revision$'
 
-__all__ = ["Component", "exposed", "automatic", "run_component"]
+__all__ = ["Component", "StateJournal", "exposed", "automatic", "run_component"]
 
 import inspect
 import os
 import os.path
 import cPickle
+import cStringIO
 import ConfigParser
 import pydoc
 import sys
 import getopt
 import logging
+import struct
 import time
 import threading
 import xmlrpclib
+import zlib
 
 import Cobalt
 import Cobalt.Proxy
 import Cobalt.Logging
 from Cobalt.Server import BaseXMLRPCServer, XMLRPCServer, find_intended_location
-from Cobalt.Data import get_spec_fields
+from Cobalt.Data import get_spec_fields, apply_query_options
 from Cobalt.Exceptions import NoExposedMethod
 from Cobalt.Statistics import Statistics
+from Cobalt.Util import ReadWriteLock
 
 
 def state_file_location():
@@ -119,7 +123,10 @@ def run_component (component_cls, argv=None, register=True, state_name=False,
         except:
             component = component_cls(**cls_kwargs)
             component.logger.error("unable to load state from %s", state_file_name, exc_info=True)
-        component.statefile = state_file_name
+            component.statefile = state_file_name
+        else:
+            component.statefile = state_file_name
+            component.recover()
     else:
         component = component_cls(**cls_kwargs)
         
@@ -148,6 +155,108 @@ def run_component (component_cls, argv=None, register=True, state_name=False,
     finally:
         server.server_close()
 
+class StateJournal (object):
+
+    """Append-only record of the changes made to a component since its last save.
+
+    Each record is pickled and framed with its length and CRC, so a record
+    torn by a crash is detected and dropped on replay.  The first record
+    names the generation of the snapshot the journal follows; a journal
+    left behind by any other snapshot is not replayed.
+
+    Methods:
+    start -- begin an empty journal following a snapshot
+    append -- add records and flush them to disk
+    read -- return the records following a snapshot
+    """
+
+    frame = struct.Struct("!II")
+
+    def __init__ (self, path):
+        self.path = path
+        self.size = 0
+        self._file = None
+
+    def _dumps (self, record, persistent_id):
+        data = cStringIO.StringIO()
+        pickler = cPickle.Pickler(data, cPickle.HIGHEST_PROTOCOL)
+        if persistent_id is not None:
+            pickler.inst_persistent_id = persistent_id
+        pickler.dump(record)
+        data = data.getvalue()
+        return self.frame.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+
+    def _write (self, fd, data):
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+    def start (self, generation):
+        """Begin an empty journal following snapshot generation."""
+        self.close()
+        temp_path = self.path + ".temp"
+        data = self._dumps(('generation', generation), None)
+        fd = file(temp_path, "wb")
+        try:
+            self._write(fd, data)
+        finally:
+            fd.close()
+        os.rename(temp_path, self.path)
+        self._file = file(self.path, "ab")
+        self.size = len(data)
+
+    def append (self, records, persistent_id=None):
+        """Write records to the journal and flush them to disk.
+
+        Arguments:
+        records -- picklable records
+        persistent_id -- called with each instance pickled; objects it returns a name for are recorded by that name
+        """
+        data = "".join([self._dumps(record, persistent_id) for record in records])
+        self._write(self._file, data)
+        self.size += len(data)
+
+    def read (self, generation, persistent_load=None):
+        """Return the records following snapshot generation.
+
+        Arguments:
+        generation -- generation of the snapshot just loaded
+        persistent_load -- returns the object recorded under a name given by persistent_id
+        """
+        try:
+            fd = file(self.path, "rb")
+        except IOError:
+            return []
+        records = []
+        try:
+            while True:
+                header = fd.read(self.frame.size)
+                if not header:
+                    break
+                if len(header) == self.frame.size:
+                    length, crc = self.frame.unpack(header)
+                    data = fd.read(length)
+                else:
+                    data = ""
+                if len(header) < self.frame.size or len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                    logging.getLogger("journal").warning("%s: dropping incomplete record at end of journal", self.path)
+                    break
+                unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+                if persistent_load is not None:
+                    unpickler.persistent_load = persistent_load
+                record = unpickler.load()
+                if not records and record != ('generation', generation):
+                    return []
+                records.append(record)
+        finally:
+            fd.close()
+        return records[1:]
+
+    def close (self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
 def exposed (func):
     """Mark a method to be exposed publically.
     
@@ -178,22 +287,47 @@ def locking (func):
     return func
 
 def readonly (func):
-    """Mark a function as read-only -- no data effects in component inst"""
+    """Mark a function as read-only -- no data effects in component inst
+
+    Read-only methods run under the component lock in read mode, alongside one another but never alongside other
+    methods or automatic tasks.
+    """
     func.readonly = True
     return func
 
 def query (func=None, **kwargs):
-    """Mark a method to be marshalled as a query."""
+    """Mark a method to be marshalled as a query.
+    
+    Keyword arguments:
+    options -- the method takes only a list of specs, and callers may pass a dictionary of query options after them
+        (see marshal_query_result); the options are applied by the dispatcher rather than passed to the method
+    """
     def _query (func):
         if kwargs.get("all_fields", True):
             func.query_all_fields = True
+        if kwargs.get("options", False):
+            func.query_options = True
         func.query = True
         return func
     if func is not None:
         return _query(func)
     return _query
 
-def marshal_query_result (items, specs=None):
+def marshal_query_result (items, specs=None, options=None):
+    """Convert the items returned by a query into transmittable dictionaries.
+    
+    Arguments:
+    items -- the matched items
+    specs -- the specs of the query; the fields used by them are returned
+    options -- dictionary of query options: fields, the list of fields to return in place of those used by the specs,
+        and the sort, offset, limit and count options of Cobalt.Data.apply_query_options
+    """
+    if options:
+        items = apply_query_options(items, options)
+        if options.get('count'):
+            return items
+        if options.get('fields'):
+            return [item.to_rx(options['fields']) for item in items]
     if specs is not None:
         fields = get_spec_fields(specs)
     else:
@@ -215,7 +349,11 @@ class Component (object):
     
     Methods:
     save -- pickle the component to a file
+    recover -- bring state loaded from the statefile up to date
     do_tasks -- perform automatic tasks for the component
+    trigger_automatic -- run an automatic task ahead of its period
+    wait_for_tasks -- sleep until automatic tasks are due
+    component_lock_acquire -- take the component lock in read or write mode
 
     """
     
@@ -235,9 +373,11 @@ class Component (object):
         else:
             self._registered_component=False
         self.logger = logging.getLogger("%s %s" % (self.implementation, self.name))
-        self._component_lock = threading.Lock()
-        self._component_lock_acquired_time = None
+        self._component_lock = ReadWriteLock()
+        self._component_lock_holder = threading.local()
         self.statistics = Statistics()
+        self._task_triggers = dict()
+        self._task_wakeup = threading.Event()
 
     def __getstate__(self):
         state = {}
@@ -253,20 +393,36 @@ class Component (object):
         else:
             self._registered_component=False
         self.logger = logging.getLogger("%s %s" % (self.implementation, self.name))
-        self._component_lock = threading.Lock()
-        self._component_lock_acquired_time = None
+        self._component_lock = ReadWriteLock()
+        self._component_lock_holder = threading.local()
         self.statistics = Statistics()
+        self._task_triggers = dict()
+        self._task_wakeup = threading.Event()
+
+    def component_lock_acquire(self, mode="write"):
+        """Take the component lock.
 
-    def component_lock_acquire(self):
+        Any number of threads may hold the lock in "read" mode at once, but only one may hold it in "write" mode.  Wait
+        and hold times are recorded in the component_lock_<mode>_wait and component_lock_<mode>_held statistics.
+        """
         entry_time = time.time()
-        self._component_lock.acquire()
-        self._component_lock_acquired_time = time.time()
-        self.statistics.add_value('component_lock_wait', self._component_lock_acquired_time - entry_time)
+        if mode == "read":
+            self._component_lock.acquire_read()
+        else:
+            self._component_lock.acquire_write()
+        holder = self._component_lock_holder
+        holder.mode = mode
+        holder.acquired_time = time.time()
+        self.statistics.add_value('component_lock_%s_wait' % (mode,), holder.acquired_time - entry_time)
         
     def component_lock_release(self):
-        self.statistics.add_value('component_lock_held', time.time() - self._component_lock_acquired_time)
-        self._component_lock_acquired_time = None
-        self._component_lock.release()
+        """Release the component lock taken by this thread."""
+        holder = self._component_lock_holder
+        self.statistics.add_value('component_lock_%s_held' % (holder.mode,), time.time() - holder.acquired_time)
+        if holder.mode == "read":
+            self._component_lock.release_read()
+        else:
+            self._component_lock.release_write()
         
     def save (self, statefile=None):
         """Pickle the component.
@@ -276,19 +432,31 @@ class Component (object):
         """
         statefile = statefile or self.statefile
         if statefile:
-            temp_statefile = statefile + ".temp"
-            data = cPickle.dumps(self)
             try:
-                fd = file(temp_statefile, "wb")
-                fd.write(data)
-                fd.close()
+                self._write_state(statefile)
             except IOError, e:
                 self.logger.error("statefile failure : %s" % e)
                 return str(e)
             else:
-                os.rename(temp_statefile, statefile)
                 return "state saved to file: %s" % statefile
     save = exposed(save)
+
+    def _write_state (self, statefile):
+        """Pickle the component to statefile, replacing it only once the new state is written."""
+        temp_statefile = statefile + ".temp"
+        data = cPickle.dumps(self)
+        fd = file(temp_statefile, "wb")
+        fd.write(data)
+        fd.close()
+        os.rename(temp_statefile, statefile)
+
+    def recover (self):
+        """Bring state just loaded from the statefile up to date.
+
+        Components that record changes between saves (see StateJournal)
+        replay them here.
+        """
+        pass
     
     def do_tasks (self):
         """Perform automatic tasks for the component.
@@ -299,9 +467,17 @@ class Component (object):
         for name, func in inspect.getmembers(self, callable):
             if getattr(func, "automatic", False):
                 need_to_lock = not getattr(func, 'locking', False)
-                if (time.time() - func.automatic_ts) > func.automatic_period:
+                lock_mode = getattr(func, 'readonly', False) and "read" or "write"
+                triggered = self._task_triggers.get(name, None)
+                if triggered is not None and triggered <= time.time():
+                    # the trigger is dropped before the run, so one arriving while the task runs causes another run
+                    del self._task_triggers[name]
+                    due = True
+                else:
+                    due = (time.time() - func.automatic_ts) > func.automatic_period
+                if due:
                     if need_to_lock:
-                        self.component_lock_acquire()
+                        self.component_lock_acquire(lock_mode)
                     try:
                         mt1 = time.time()
                         func()
@@ -311,11 +487,37 @@ class Component (object):
                     finally:
                         mt2 = time.time()
                         if not need_to_lock:
-                            self.component_lock_acquire()
+                            self.component_lock_acquire(lock_mode)
                         self.statistics.add_value(name, mt2-mt1)
                         self.component_lock_release()
                         func.__dict__['automatic_ts'] = time.time()
 
+    def trigger_automatic (self, name, delay=0):
+        """Run an automatic task ahead of its period.
+
+        The task runs on the next call to do_tasks at least delay seconds from now.  Triggers arriving before then
+        are folded into the same run, so a burst of events costs one run of the task.  The periodic schedule is left
+        alone and still runs the task if no trigger comes.
+
+        Arguments:
+        name -- name of the automatic method
+        delay -- seconds to wait for further triggers
+        """
+        if not self._task_triggers.has_key(name):
+            self._task_triggers[name] = time.time() + delay
+            self._task_wakeup.set()
+
+    def wait_for_tasks (self, timeout):
+        """Sleep for timeout seconds, or until a triggered automatic task comes due."""
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            wake = min([deadline] + self._task_triggers.values())
+            if wake <= now:
+                return
+            self._task_wakeup.wait(wake - now)
+            self._task_wakeup.clear()
+
     def _resolve_exposed_method (self, method_name):
         """Resolve an exposed method.
         
@@ -346,9 +548,15 @@ class Component (object):
                     self.logger.error(e, exc_info=True)
                 raise xmlrpclib.Fault(getattr(e, "fault_code", 1), str(e))
         
+        query_options = None
+        if getattr(method_func, "query_options", False) and len(args) == 2:
+            query_options = args[1]
+            args = args[:1]
+
         need_to_lock = not getattr(method_func, 'locking', False)
+        lock_mode = getattr(method_func, 'readonly', False) and "read" or "write"
         if need_to_lock:
-            self.component_lock_acquire()
+            self.component_lock_acquire(lock_mode)
         try:
             method_start = time.time()
             result = method_func(*args)
@@ -359,15 +567,15 @@ class Component (object):
         finally:
             method_done = time.time()
             if not need_to_lock:
-                self.component_lock_acquire()
+                self.component_lock_acquire(lock_mode)
             self.statistics.add_value(method, method_done - method_start)
             self.component_lock_release()
         if getattr(method_func, "query", False):
-            if not getattr(method_func, "query_all_methods", False):
-                margs = args[:1]
+            if not getattr(method_func, "query_all_methods", False) and args:
+                specs = args[0]
             else:
-                margs = []
-            result = marshal_query_result(result, *margs)
+                specs = None
+            result = marshal_query_result(result, specs, query_options)
         return result
 
     @exposed
@@ -404,6 +612,6 @@ class Component (object):
     def get_statistics (self):
         """Get current statistics about component execution"""
         return self.statistics.display()
-    get_statistics = exposed(get_statistics)
+    get_statistics = exposed(readonly(get_statistics))
 
  
@@ -14,9 +14,12 @@ import fcntl
 import gc
 import logging
 import os
+import shutil
 import signal
 import sys
+import threading
 import ConfigParser
+from collections import deque
 
 import Cobalt
 import Cobalt.Components.base
@@ -55,9 +58,71 @@ def get_forker_config(option, default):
     return value
 
 
+# the children of the forkers in this process waiting to be reaped, keyed by pid, with the forker of each
+_reaper_owners = {}
+# the status of children reaped before their forker handed them over, keyed by pid
+_reaper_unclaimed = {}
+_reaper_lock = threading.Lock()
+_reaper_wakeup = threading.Event()
+_reaper_thread = None
+
+def _reaper():
+    '''
+    Block in waitpid while any forker has children running, passing each exit status to the child's forker.  The thread
+    sleeps while no forker children are running, so that it does not reap processes started by other means.
+    '''
+    while True:
+        _reaper_wakeup.wait()
+        _reaper_wakeup.clear()
+        while _reaper_owners:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                # none of the remaining children belong to this process
+                _reaper_lock.acquire()
+                try:
+                    _logger.warning("pids %s are not children of this process", " ".join([str(pid) for pid in _reaper_owners]))
+                    _reaper_owners.clear()
+                finally:
+                    _reaper_lock.release()
+                break
+            _reaper_lock.acquire()
+            try:
+                forker = _reaper_owners.pop(pid, None)
+                if forker is None:
+                    _reaper_unclaimed[pid] = status
+            finally:
+                _reaper_lock.release()
+            if forker is not None:
+                forker._child_reaped(pid, status)
+
+def _watch_child(pid, forker):
+    '''Have the reaper thread pass the status of a child to its forker once the child exits'''
+    global _reaper_thread
+    _reaper_lock.acquire()
+    try:
+        status = _reaper_unclaimed.pop(pid, None)
+        if status is None:
+            _reaper_owners[pid] = forker
+        if _reaper_thread is None:
+            _reaper_thread = threading.Thread(target=_reaper, name="forker reaper")
+            _reaper_thread.setDaemon(True)
+            _reaper_thread.start()
+    finally:
+        _reaper_lock.release()
+    if status is not None:
+        forker._child_reaped(pid, status)
+    _reaper_wakeup.set()
+
+
 class BaseChild (object):
     '''Base class for child processes.'''
 
+    # whether the captured output is cut down to the output_head_size and output_tail_size forker options
+    bounded_output = True
+
     id_gen = IncrID()
 
     def __init__(self, id=None, **kwargs):
@@ -103,6 +168,8 @@ class BaseChild (object):
         self.stdout_data = None
         self.stderr_file = None
         self.stderr_data = None
+        self.stdout_path = None
+        self.stderr_path = None
         self.return_output = False
 
         self.complete = False
@@ -149,12 +216,16 @@ class BaseChild (object):
         self.stderr_file = None
         self._cobalt_log_file = None
         self._cobalt_log_failed = False
+        if not state.has_key('stdout_path'):
+            self.stdout_path = None
+            self.stderr_path = None
         if not self.complete:
             self.lost_child = True
             self.return_output = False
             self.complete = True
 
-    def export_state(self):
+    def export_state(self, output=True):
+        '''Return the child's state as a dictionary, including its captured output only if output is true'''
         d = {}
         d['id'] = self.id
         d['args'] = self.args
@@ -162,9 +233,13 @@ class BaseChild (object):
         d['tag'] = self.tag
         d['runid'] = self.runid
         d['label'] = self.label
-        if self.return_output:
+        if self.return_output and output:
             d['stdout'] = self.stdout_data
             d['stderr'] = self.stderr_data
+        if self.stdout_path:
+            d['stdout_path'] = self.stdout_path
+        if self.stderr_path:
+            d['stderr_path'] = self.stderr_path
         d['complete'] = self.complete
         d['lost_child'] = self.lost_child
         d['exit_status'] = self.exit_status
@@ -375,6 +450,11 @@ class BaseChild (object):
         if self._cobalt_log_file:
             self._cobalt_log_file.flush()
 
+        self.exec_child()
+
+    def exec_child(self):
+        '''Replace the child process with the program to run.  Runs in the child after the pre-exec methods and does not
+        return.'''
         try:
             if self.env is None:
                 os.execvp(self.exe, self.args)
@@ -418,10 +498,14 @@ class BaseForker (Component):
     
     Methods:
     fork -- takes a dictionary specifying parameters for the forked task (exposed)
+    fork_many -- fork several tasks in one call (exposed)
     signal -- signal a child with the specified signame (exposed)
     active_list -- retrieve a list of children which are still running (exposed)
     get_status -- return a dictionary of status information for a finished process (exposed)
     wait -- wait on children and record their status (automatic)
+
+    A reaper thread blocks in waitpid and runs wait as soon as a child exits; wait_interval only paces the signaling of
+    children marked for death.
     """
     
     # name = __name__.split('.')[-1]
@@ -447,6 +531,7 @@ class BaseForker (Component):
         self.children = {}
         self.active_runids = []
         self.marked_for_death = {}
+        self._init_reaper()
 
     def __getstate__(self):
         state = {}
@@ -484,6 +569,24 @@ class BaseForker (Component):
             self.marked_for_death = state['marked_for_death']
         else:
             self.marked_for_death = {}
+        self._init_reaper()
+
+    def _init_reaper(self):
+        # children whose processes have not been reaped, keyed by pid.  children restored from a statefile are not
+        # children of this process and never will be reaped.
+        self.pid_index = {}
+        # (pid, status) of the children reaped by the reaper thread but not yet recorded by _wait
+        self.reaped = deque()
+
+    def _add_child(self, child):
+        '''Index a started child by pid and hand it to the reaper thread'''
+        self.pid_index[child.pid] = child
+        _watch_child(child.pid, self)
+
+    def _child_reaped(self, pid, status):
+        '''Called from the reaper thread once a child has exited'''
+        self.reaped.append((pid, status))
+        self.trigger_automatic('_wait')
 
     def __save_me(self):
         '''Periodically save off a statefile.'''
@@ -507,7 +610,16 @@ class BaseForker (Component):
         """
 
         _logger.info("fork called with args of %s", " ".join(args))
+        return self._start_child(self.child_cls, args, tag, label, env, runid, data=preexec_data)
+
+    fork = exposed(fork)
+
+    def _start_child(self, child_cls, args, tag, label, env, runid, **kwargs):
+        """Create a child of the given class and start it.  Additional arguments are passed to the child's constructor.
 
+        returns the forker id of the child process object, or None if it could not be started.
+
+        """
         try:
             #make sure that a job isn't retrying because the XML-RPC hung.
             if (runid != None) and (runid in self.active_runids):
@@ -528,7 +640,7 @@ class BaseForker (Component):
 
             child = None
             try:
-                child = self.child_cls(label_prefix=label, tag=tag, args=args, env=env, runid=runid, data=preexec_data)
+                child = child_cls(label_prefix=label, tag=tag, args=args, env=env, runid=runid, **kwargs)
             except:
                 _logger.error("%s: failed to create child object; aborting fork", label, exc_info=True)
             else:
@@ -543,6 +655,7 @@ class BaseForker (Component):
 
             if child is not None and child.pid is not None:
                 self.children[child.id] = child
+                self._add_child(child)
                 if child.runid is not None:
                     self.active_runids.append(runid)
                 return child.id
@@ -552,7 +665,27 @@ class BaseForker (Component):
             _logger.error("%s: failed due to an unexpected exception: %s", child.label, e, exc_info=True)
             raise
 
-    fork = exposed(fork)
+    def fork_many(self, specs):
+        """Fork several child tasks in one call.
+
+        specs -- a list of dictionaries holding the arguments to fork: args, and optionally tag, label, env, preexec_data
+        and runid.
+
+        returns a list of the forker ids of the children, in the order of specs.  the id is None for each task that could
+        not be started.
+
+        """
+        child_ids = []
+        for spec in specs:
+            try:
+                child_ids.append(self.fork(spec['args'], spec.get('tag'), spec.get('label'), spec.get('env'),
+                    spec.get('preexec_data'), spec.get('runid')))
+            except Exception:
+                # fork has already logged the failure
+                child_ids.append(None)
+        return child_ids
+
+    fork_many = exposed(fork_many)
     
     def signal(self, child_id, signame):
         """
@@ -576,18 +709,21 @@ class BaseForker (Component):
 
     signal = exposed(signal)
     
-    def get_children(self, tag=None, child_ids=None):
+    def get_children(self, tag=None, child_ids=None, output=False):
         """
         Retrieve a list of child processes. If a tag is supplied, return only the children with that tag.  If a set of child ids
         are supplied, then return only the children in that set.  If neither a tag nor a set of child ids are provided, then
         return all known children.
 
+        The captured stdout and stderr of the children are only returned if output is true.  The paths of any output spooled
+        to the output_spool_dir are always returned.
+
         """
         ret = []
         if child_ids is None:
             for child in self.children.itervalues():
                 if tag is None or child.tag == tag:
-                    ret.append(child.export_state())
+                    ret.append(child.export_state(output))
         else:
             for child_id in child_ids:
                 try:
@@ -599,7 +735,7 @@ class BaseForker (Component):
                     child.tag = tag
                     child.complete = True
                 if tag is None or child.tag == tag:
-                    ret.append(child.export_state())
+                    ret.append(child.export_state(output))
         return ret
 
     get_children = exposed(get_children)
@@ -630,18 +766,56 @@ class BaseForker (Component):
 
     cleanup_children = exposed(cleanup_children)
 
+    def _spool_output(self, child, output_file, name):
+        '''Copy a child's full output to the output_spool_dir, if one is set, and return the path of the copy'''
+        spool_dir = get_forker_config('output_spool_dir', None)
+        if not spool_dir:
+            return None
+        path = os.path.join(spool_dir, "%s.%s.%s.%s" % (self.name, child.id, child.pid, name))
+        try:
+            output_file.seek(0, 0)
+            spool_file = open(path, 'w')
+            try:
+                shutil.copyfileobj(output_file, spool_file)
+            finally:
+                spool_file.close()
+        except (OSError, IOError), e:
+            _logger.error("task %s: unable to spool %s to %s: %s", child.label, name, path, e)
+            return None
+        return path
+
+    def _read_output(self, child, output_file, name, path=None):
+        '''
+        Read a child's output file as a list of lines.  Unless the child's output is unbounded, only the first
+        output_head_size and the last output_tail_size bytes are kept, with a line noting how much was left out between them.
+        '''
+        output_file.seek(0, 2)
+        size = output_file.tell()
+        output_file.seek(0, 0)
+        if child.bounded_output:
+            head_size = int(get_forker_config('output_head_size', 65536))
+            tail_size = int(get_forker_config('output_tail_size', 65536))
+        else:
+            head_size = tail_size = size
+        if size <= head_size + tail_size:
+            return [line.rstrip() for line in output_file.read().splitlines()]
+        head = output_file.read(head_size)
+        output_file.seek(size - tail_size, 0)
+        tail = output_file.read()
+        omitted = "[%d bytes omitted" % (size - head_size - tail_size,)
+        if path:
+            omitted += "; full %s in %s]" % (name, path)
+        else:
+            omitted += "]"
+        _logger.warning("task %s: %s of %d bytes truncated to its first %d and last %d bytes", child.label, name, size,
+            head_size, tail_size)
+        return [line.rstrip() for line in head.splitlines()] + [omitted] + [line.rstrip() for line in tail.splitlines()]
+
     def _wait(self):
-        """Call os.waitpid to status of dead processes.
+        """Record the status of dead processes reaped by the reaper thread.
         """
-        while True:
-            try:
-                pid, status = os.waitpid(-1, os.WNOHANG)
-            except OSError: # there are no child processes
-                break
-            # this is how waitpid + WNOHANG reports things are running
-            # but not yet dead
-            if pid == 0:
-                break
+        while self.reaped:
+            pid, status = self.reaped.popleft()
             exit_status = None
             signum = 0
             core_dump = False
@@ -655,47 +829,42 @@ class BaseForker (Component):
                 
             if exit_status is None:
                 _logger.info("pid %s died but had no status", pid)
-                break
+                continue
             
             if signum:
                 _logger.info("pid %s died with status %s and signal %s; coredump=%s", pid, exit_status, signum, core_dump)
             else:
                 _logger.info("pid %s died with status %s", pid, exit_status)
 
-            found = False
-            for child in self.children.itervalues():
-                if child.pid == pid:
-                    _logger.info("task %s: dead pid %s matches child %s", child.label, pid, child.id)
-                    child.exit_status = exit_status
-                    child.core_dump = core_dump
-                    child.signum = signum
-                    child.complete = True
-                    if child.return_output:
-                        try:
-                            if child.stdout_file:
-                                _logger.info("task %s: reading stdout", child.label)
-                                child.stdout_file.seek(0, 0)
-                                child.stdout_data = [l.rstrip() for l in child.stdout_file.readlines()]
-                                _logger.debug("task %s: stdout:\n%s", child.label, "\n".join(child.stdout_data))
-                        except (OSError, IOError), e:
-                            _logger.error("%s: unable to read stdout: %s", child.label, e)
-                        try:
-                            if child.stderr_file:
-                                _logger.info("task %s: reading stderr", child.label)
-                                child.stderr_file.seek(0, 0)
-                                child.stderr_data = [l.rstrip() for l in child.stderr_file.readlines()]
-                                _logger.debug("task %s: stderr:\n%s", child.label, "\n".join(child.stderr_data))
-                        except (OSError, IOError), e:
-                            _logger.error("%s: unable to read stderr: %s", child.label, e)
-                    found = True
-                    break
-            if not found:
+            child = self.pid_index.pop(pid, None)
+            if child is not None and self.children.get(child.id) is child:
+                _logger.info("task %s: dead pid %s matches child %s", child.label, pid, child.id)
+                child.exit_status = exit_status
+                child.core_dump = core_dump
+                child.signum = signum
+                child.complete = True
+                if child.return_output:
+                    try:
+                        if child.stdout_file:
+                            _logger.info("task %s: reading stdout", child.label)
+                            child.stdout_path = self._spool_output(child, child.stdout_file, "stdout")
+                            child.stdout_data = self._read_output(child, child.stdout_file, "stdout", child.stdout_path)
+                            _logger.debug("task %s: stdout:\n%s", child.label, "\n".join(child.stdout_data))
+                    except (OSError, IOError), e:
+                        _logger.error("%s: unable to read stdout: %s", child.label, e)
+                    try:
+                        if child.stderr_file:
+                            _logger.info("task %s: reading stderr", child.label)
+                            child.stderr_path = self._spool_output(child, child.stderr_file, "stderr")
+                            child.stderr_data = self._read_output(child, child.stderr_file, "stderr", child.stderr_path)
+                            _logger.debug("task %s: stderr:\n%s", child.label, "\n".join(child.stderr_data))
+                    except (OSError, IOError), e:
+                        _logger.error("%s: unable to read stderr: %s", child.label, e)
+            else:
                 _logger.warning("pid %s has no corresponding child object", pid)
-                for child_id in self.marked_for_death.keys():
-                    if self.marked_for_death[child_id].pid == pid:
-                        _logger.info("pid %s found in marked for death list", pid)
-                        del self.marked_for_death[child_id]
-                        break
+                if child is not None and self.marked_for_death.get(child.id) is child:
+                    _logger.info("pid %s found in marked for death list", pid)
+                    del self.marked_for_death[child.id]
             
         # signal any children marked for death
         for child_id in self.marked_for_death.keys():
@@ -709,7 +878,7 @@ class BaseForker (Component):
                 else:
                     child.death_timer = Timer(self.DEATH_TIMEOUT)
                     child.death_timer.start()
-            elif timer.has_expired():
+            elif child.death_timer.has_expired:
                 try:
                     child.signal(signal.SIGKILL)
                 except OSError, e:
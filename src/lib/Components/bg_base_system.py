@@ -3,6 +3,8 @@
 Classes:
 NodeCard -- node cards make up Partitions
 Partition -- atomic set of nodes
+PartitionSnapshot -- copy of the partition fields used by the allocator
+BackfillEngine -- array-backed view of the partitions used by the allocator
 PartitionDict -- default container for partitions
 ProcessGroup -- virtual process group running on the system
 ProcessGroupDict -- default container for process groups
@@ -11,21 +13,24 @@ BGBaseSystem -- base system component
 
 import sys
 import time
+from array import array
 import xmlrpclib
-import copy
 import re
 import Cobalt
 from Cobalt.Data import Data, DataDict
 from Cobalt.Exceptions import JobValidationError, ComponentLookupError
-from Cobalt.Components.base import Component, exposed, automatic, query, locking
+from Cobalt.Components.base import Component, exposed, automatic, query, locking, readonly
 import thread, ConfigParser
 from Cobalt.Proxy import ComponentProxy
+from Cobalt.Util import notifier_thread
 from Cobalt.DataTypes.ProcessGroup import ProcessGroupDict
 
 
 __all__ = [
     "NodeCard",
     "Partition",
+    "PartitionSnapshot",
+    "BackfillEngine",
     "PartitionDict",
     "BGBaseSystem",
 ]
@@ -37,6 +42,11 @@ try:
     max_drain_hours = float(CP.get('bgsystem', 'max_drain_hours'))
 except:
     max_drain_hours = float(sys.maxint)
+
+try:
+    max_jobs_per_pass = int(CP.get('bgsystem', 'max_jobs_per_pass'))
+except:
+    max_jobs_per_pass = 1
     
 # *AdjEst*
 config = ConfigParser.ConfigParser() 
@@ -54,6 +64,9 @@ else:
     walltime_prediction_enabled = False
 # *AdjEst*
 
+# tells the scheduler when partitions are freed, so that it need not wait for its next periodic pass
+scheduler_notifier = notifier_thread("scheduler", "reschedule")
+
 def parse_nodecard_location(name):
     '''convert a location string to a R,M,N tuple
     must have up to nodecard information in name.
@@ -191,6 +204,204 @@ class Partition (Data):
         return "<%s name=%r>" % (self.__class__.__name__, self.name)
 
 
+class PartitionSnapshot (object):
+    """The fields of a partition read by the allocator, copied at the start of a scheduling pass.
+
+    find_job_location works from these rather than from deep copies of the partitions, so the partitions lock is only
+    held long enough to copy a handful of scalars and the names of the relatives.  backfill_time and draining are
+    computed by the allocator during the pass.
+    """
+
+    __slots__ = ["name", "state", "size", "functional", "scheduled", "queue", "parents", "children", "reserved_by",
+        "backfill_time", "draining"]
+
+    def __init__(self, partition):
+        self.name = partition.name
+        self.state = partition.state
+        self.size = partition.size
+        self.functional = partition.functional
+        self.scheduled = partition.scheduled
+        self.queue = partition.queue
+        self.parents = partition.parents
+        self.children = partition.children
+        self.reserved_by = partition.reserved_by
+        self.backfill_time = partition.backfill_time
+        self.draining = partition.draining
+
+    def __str__ (self):
+        return self.name
+
+    def __repr__ (self):
+        return "<%s name=%r>" % (self.__class__.__name__, self.name)
+
+
+def _csr(rows):
+    """Pack a list of lists of ints into compressed sparse row form: (offsets, indices)"""
+    offsets = array('l', [0])
+    indices = array('l')
+    for row in rows:
+        indices.extend(row)
+        offsets.append(len(indices))
+    return offsets, indices
+
+
+class BackfillEngine (object):
+    """Array-backed view of the managed partitions, used by find_job_location.
+
+    The partitions are numbered in the order they were handed to the constructor.  Sizes, states and backfill times
+    are kept in arrays indexed by partition number, and the parent and child relations (and their inverses, used to
+    apply a job's forbidden list) in compressed sparse row form.  The structure only depends on the partition
+    relations and the locations cache, so it is rebuilt together with the cache; load() refreshes the per-pass
+    values from a new snapshot.
+    """
+
+    def __init__(self, partitions, locations):
+        """partitions maps partition names to partitions (or snapshots); locations is the locations cache"""
+        self.names = list(partitions.iterkeys())
+        self.index = dict([(p_name, i) for i, p_name in enumerate(self.names)])
+        count = len(self.names)
+        self.size = array('l', [int(partitions[p_name].size) for p_name in self.names])
+        parents = [[self.index[name] for name in partitions[p_name].parents if name in self.index]
+            for p_name in self.names]
+        children = [[self.index[name] for name in partitions[p_name].children if name in self.index]
+            for p_name in self.names]
+        has_parent = [[] for _ in xrange(count)]
+        has_child = [[] for _ in xrange(count)]
+        for i in xrange(count):
+            for j in parents[i]:
+                has_parent[j].append(i)
+            for j in children[i]:
+                has_child[j].append(i)
+        self.parents_ptr, self.parents = _csr(parents)
+        self.children_ptr, self.children = _csr(children)
+        self.has_parent_ptr, self.has_parent = _csr(has_parent)
+        self.has_child_ptr, self.has_child = _csr(has_child)
+        self.locations = {}
+        for q_name, per_size in locations.iteritems():
+            self.locations[q_name] = dict([(size, array('l', [self.index[p_name] for p_name in p_names]))
+                for size, p_names in per_size.iteritems()])
+        self.idle = array('b', [0] * count)
+        self.idle_scheduled = array('b', [0] * count)
+        self.reserved = array('b', [0] * count)
+        self.score = array('l', [0] * count)
+        self.backfill_time = array('d', [0.0] * count)
+
+    def __len__ (self):
+        return len(self.names)
+
+    def load(self, partitions):
+        """Take the states of a new snapshot and count, for every partition, the idle scheduled parents that
+        placing a job on it would block"""
+        idle = array('b', [partitions[p_name].state == "idle" for p_name in self.names])
+        idle_scheduled = array('b', [is_idle and bool(partitions[p_name].scheduled)
+            for p_name, is_idle in zip(self.names, idle)])
+        reserved = array('b', [bool(partitions[p_name].reserved_by) for p_name in self.names])
+        score = array('l', [0] * len(self.names))
+        parents_ptr = self.parents_ptr
+        parents = self.parents
+        for i in xrange(len(self.names)):
+            if idle[i]:
+                score[i] = len([j for j in parents[parents_ptr[i]:parents_ptr[i + 1]] if idle_scheduled[j]])
+        self.idle = idle
+        self.idle_scheduled = idle_scheduled
+        self.reserved = reserved
+        self.score = score
+
+    def propagate(self, now, job_end_times):
+        """Compute the time at which each partition becomes free for backfilling.
+
+        A busy partition is free at the end time of the job running on it (or in five minutes if the end is unknown);
+        that time is pushed up to the partitions it blocks, then down to the children of every busy partition.
+        Partitions are visited in number order.
+        """
+        backfill_time = array('d', [now if is_idle else now + 5*60 for is_idle in self.idle])
+        parents_ptr = self.parents_ptr
+        parents = self.parents
+        ends = [(self.index[p_name], end_time) for p_name, end_time in job_end_times.iteritems()
+            if p_name in self.index]
+        ends.sort()
+        for i, end_time in ends:
+            if end_time > backfill_time[i]:
+                backfill_time[i] = end_time
+            for j in parents[parents_ptr[i]:parents_ptr[i + 1]]:
+                if backfill_time[i] > backfill_time[j]:
+                    backfill_time[j] = backfill_time[i]
+        children_ptr = self.children_ptr
+        children = self.children
+        for i in xrange(len(self.names)):
+            if backfill_time[i] == now:
+                continue
+            for j in children[children_ptr[i]:children_ptr[i + 1]]:
+                if backfill_time[j] == now or backfill_time[j] > backfill_time[i]:
+                    backfill_time[j] = backfill_time[i]
+        self.backfill_time = backfill_time
+
+    def claim(self, i, until):
+        """Record a job placed on partition i and running until the given time.
+
+        The partition and its relatives stop being idle, the scores of the partitions they were blocking go down, and
+        their backfill times move out to the end of the job.  Returns the numbers of the partitions touched.
+        """
+        idle = self.idle
+        score = self.score
+        backfill_time = self.backfill_time
+        claimed = [i] + list(self.relatives(i))
+        for j in claimed:
+            if idle[j]:
+                idle[j] = 0
+                if self.idle_scheduled[j]:
+                    self.idle_scheduled[j] = 0
+                    for k in self.has_parent[self.has_parent_ptr[j]:self.has_parent_ptr[j + 1]]:
+                        if idle[k]:
+                            score[k] -= 1
+            if until > backfill_time[j]:
+                backfill_time[j] = until
+        return claimed
+
+    def relatives(self, i):
+        """Numbers of partition i's parents and children"""
+        return self.parents[self.parents_ptr[i]:self.parents_ptr[i + 1]] + \
+            self.children[self.children_ptr[i]:self.children_ptr[i + 1]]
+
+    def forbidden(self, p_names):
+        """Numbers of the partitions a job forbidding p_names may not run on: the named partitions and every
+        partition listing one of them as a parent or child"""
+        excluded = set()
+        for p_name in p_names:
+            if p_name in self.index:
+                i = self.index[p_name]
+                excluded.add(i)
+                excluded.update(self.has_parent[self.has_parent_ptr[i]:self.has_parent_ptr[i + 1]])
+                excluded.update(self.has_child[self.has_child_ptr[i]:self.has_child_ptr[i + 1]])
+        return excluded
+
+    def select(self, candidates, excluded, now=None, runtime=None, walltime=None):
+        """Pick the idle candidate blocking the fewest idle scheduled parents, or None.
+
+        When now is given, only partitions free for backfilling for the job's runtime estimate and walltime (in
+        minutes) are considered; the walltime is used as the estimate on reserved partitions.
+        """
+        best = None
+        best_score = sys.maxint
+        idle = self.idle
+        score = self.score
+        backfill_time = self.backfill_time
+        reserved = self.reserved
+        for i in candidates:
+            if i in excluded or not idle[i]:
+                continue
+            if now is not None:
+                estimate = runtime
+                if reserved[i]:
+                    estimate = walltime
+                if 60 * estimate > backfill_time[i] - now or 60 * walltime > backfill_time[i] - now:
+                    continue
+            if score[i] < best_score:
+                best_score = score[i]
+                best = i
+        return best
+
+
 class PartitionDict (DataDict):
     """Default container for partitions.
     
@@ -251,6 +462,8 @@ class BGBaseSystem (Component):
         self.node_card_cache = dict()
         self.cached_partitions = None
         self.offline_partitions = []
+        self._reset_relatives()
+        self._reset_locations_cache()
 
     def __getstate__(self):
         state = {}
@@ -313,6 +526,8 @@ class BGBaseSystem (Component):
         self.bridge_in_error = False
         self.cached_partitions = None
         self.offline_partitions = []
+        self._reset_relatives()
+        self._reset_locations_cache()
 
     def _restore_partition_state(self, state):
         if 'partition_flags' in state:
@@ -336,6 +551,7 @@ class BGBaseSystem (Component):
                         part.cleanup_pending = flags[6]
                 else:
                     logger.info("Partition %s is no longer defined" % pname)
+            self._invalidate_locations_cache()
 
             for part in self._partitions.values():
                 if part.state == 'idle':
@@ -392,7 +608,7 @@ class BGBaseSystem (Component):
         self._partitions_lock.release()
         
         return partitions
-    get_partitions = exposed(query(get_partitions))
+    get_partitions = exposed(readonly(query(get_partitions, options=True)))
     
     def verify_locations(self, location_list):
         """Providing a system agnostic interface for making sure a 'location string' is valid"""
@@ -429,6 +645,8 @@ class BGBaseSystem (Component):
         self._partitions_lock.acquire()
         try:
             partitions = self._partitions.q_get(specs, _set_partitions, updates)
+            if partitions and [field for field in updates if field in self._locations_cache_fields]:
+                self._invalidate_locations_cache()
         except:
             partitions = []
             self.logger.error("error in set_partitions", exc_info=True)
@@ -436,68 +654,138 @@ class BGBaseSystem (Component):
         return partitions
     set_partitions = exposed(query(set_partitions))
 
-    def update_relatives(self):
-        """Call this method after changing the contents of self._managed_partitions"""
-        for p_name in self._managed_partitions:
-            self._partitions[p_name]._parents = set()
-            self._partitions[p_name]._children = set()
-
-        for p in self._partitions.itervalues():
-            p._all_children = set()
+    def _reset_relatives(self):
+        """Forget the bookkeeping used by update_relatives; the next call recomputes every relationship"""
+        # partition objects and managed partition names seen by the last call to update_relatives
+        self._relatives_partitions = dict()
+        self._relatives_managed = set()
+        # node card bitmaps: node card id -> bit, partition name -> (node card ids, bitmap)
+        self._node_card_bit = dict()
+        self._partition_bits = dict()
+        # inverted index from node card id to the names of the partitions using that node card
+        self._node_card_partitions = dict()
+        self._empty_partitions = set()
+        # partition name -> names of managed partitions that strictly contain it
+        self._base_parents = dict()
+
+    def _index_node_cards(self, partition):
+        nc_ids = partition.node_card_names
+        bits = 0L
+        for nc_id in nc_ids:
+            if nc_id not in self._node_card_bit:
+                self._node_card_bit[nc_id] = 1L << len(self._node_card_bit)
+            bits |= self._node_card_bit[nc_id]
+            self._node_card_partitions.setdefault(nc_id, set()).add(partition.name)
+        if not nc_ids:
+            self._empty_partitions.add(partition.name)
+        self._partition_bits[partition.name] = (nc_ids, bits)
+
+    def _unindex_node_cards(self, p_name):
+        nc_ids, bits = self._partition_bits.pop(p_name)
+        for nc_id in nc_ids:
+            names = self._node_card_partitions[nc_id]
+            names.discard(p_name)
+            if not names:
+                del self._node_card_partitions[nc_id]
+        self._empty_partitions.discard(p_name)
+        return nc_ids
+
+    def _partitions_sharing(self, nc_ids):
+        """Names of the partitions that use any of the node cards, plus those without node cards"""
+        if not nc_ids:
+            return set(self._partitions.keys())
+        names = set(self._empty_partitions)
+        for nc_id in nc_ids:
+            names.update(self._node_card_partitions.get(nc_id, ()))
+        return names
 
-        for p_name in self._managed_partitions:
+    def update_relatives(self):
+        """Call this method after changing the contents of self._managed_partitions
+        
+        Each partition is represented by a bitmap of its node cards, and an inverted index maps node cards to partitions,
+        so the containment tests are only made between partitions that share node cards.  Only the partitions that share
+        node cards with a partition that was added, removed or replaced since the last call, or with one of its wiring
+        conflicts, have their relatives recomputed.
+        """
+        managed = set([p_name for p_name in self._managed_partitions if p_name in self._partitions])
+
+        # find the partitions that have been added, removed or replaced, and bring the node card index up to date
+        # changed maps partition names to the node cards and wiring conflicts of the old and new partition objects
+        changed = dict()
+        for p_name, part in self._relatives_partitions.items():
+            if self._partitions.get(p_name) is not part:
+                changed[p_name] = (self._unindex_node_cards(p_name), set(part._wiring_conflicts))
+                del self._relatives_partitions[p_name]
+        for p_name, part in self._partitions.iteritems():
+            if p_name not in self._relatives_partitions:
+                nc_ids, wiring_conflicts = changed.get(p_name, ([], set()))
+                changed[p_name] = (nc_ids + part.node_card_names, wiring_conflicts | part._wiring_conflicts)
+                self._index_node_cards(part)
+                self._relatives_partitions[p_name] = part
+        for p_name in managed.symmetric_difference(self._relatives_managed):
+            if p_name not in changed and p_name in self._partitions:
+                part = self._partitions[p_name]
+                changed[p_name] = (part.node_card_names, set(part._wiring_conflicts))
+        self._relatives_managed = managed
+        if not changed:
+            return
+        self._invalidate_locations_cache()
+
+        # the containment relationships can only change between a changed partition and the partitions it shares node
+        # cards with; the parent sets additionally pull in the wiring conflicts and parents of every child
+        touched = set()
+        dirty = set()
+        for p_name, (nc_ids, wiring_conflicts) in changed.iteritems():
+            touched.update(self._partitions_sharing(nc_ids))
+            touched.add(p_name)
+            for dep_name in wiring_conflicts:
+                dirty.add(dep_name)
+                if dep_name in self._partition_bits:
+                    dirty.update(self._partitions_sharing(self._partition_bits[dep_name][0]))
+        dirty.update(touched)
+
+        for p_name in touched:
+            if p_name not in self._partitions:
+                self._base_parents.pop(p_name, None)
+                continue
             p = self._partitions[p_name]
-            
-
-            # toss the wiring dependencies in with the parents
-            for dep_name in p._wiring_conflicts:
-                if dep_name in self._managed_partitions:
-                    p._parents.add(self._partitions[dep_name])
-            
-            for other in self._partitions.itervalues():
-                if p.name == other.name:
-                    continue
-
-                p_set = set(p.node_cards)
-                other_set = set(other.node_cards)
-                
-               
-                if p.size == 16 and other.size == 16 and len(p_set ^ other_set) == 0:
+            p._all_children = set()
+            if p_name not in managed:
+                self._base_parents.pop(p_name, None)
+                p._parents = set()
+                p._children = set()
+                continue
+            nc_ids, p_bits = self._partition_bits[p_name]
+            base_parents = set()
+            p._children = set()
+            for other_name in self._partitions_sharing(nc_ids):
+                if other_name == p_name:
                     continue
-
-                if other.name in self._managed_partitions:
-                    # if p is a subset of other, then p is a child; add other to p's list of managed parent partitions, and p to
-                    # other's list of managed child partitions
-                    if p_set.intersection(other_set)==p_set:
-                        if p.size < other.size:
-                            p._parents.add(other)
-                            other._children.add(p)
-                    # if p contains other, then p is a parent; add other to p's list of managed child partitions and p to other's
-                    # list of managed parent partitions
-                    elif p_set.union(other_set)==p_set:
-                        if p.size > other.size:
-                            p._children.add(other)
-                            other._parents.add(p)
-
-                # if p contains other, then p is a parent; add other to p's list of all child partitions
-                if p_set.union(other_set)==p_set:
-                    if p.size > other.size:
-                        p._all_children.add(other)
-
-        #Let's get the wiring conflicts for direct childeren as well, 
-        #we shouldn't be able to run on these either. --PMR
-        for p_name in self._managed_partitions:
-
+                other = self._partitions[other_name]
+                other_bits = self._partition_bits[other_name][1]
+                if other_bits & p_bits == other_bits and p.size > other.size:
+                    # other is contained in p
+                    p._all_children.add(other)
+                    if other_name in managed:
+                        p._children.add(other)
+                elif other_bits & p_bits == p_bits and p.size < other.size and other_name in managed:
+                    # p is contained in other
+                    base_parents.add(other_name)
+            self._base_parents[p_name] = base_parents
+
+        # the parents of a partition are the partitions containing it, its wiring conflicts, and the wiring conflicts and
+        # parents of its children.  we shouldn't be scheduling on any of those while the partition is in use. --PMR
+        for p_name in dirty:
+            if p_name not in managed:
+                continue
             p = self._partitions[p_name]
+            parent_names = set(self._base_parents[p_name])
+            parent_names.update(p._wiring_conflicts)
             for child in p._children:
-                for dep_name in child._wiring_conflicts:
-                    if dep_name in self._managed_partitions:        
-                        p._parents.add(self._partitions[dep_name])
-                #we shouldn't be scheduling on the parents of our children either
-                for par in child._parents:
-                    if ((par.name != p_name) and
-                        (par.name in self._managed_partitions)):
-                        p._parents.add(self._partitions[par.name])
+                parent_names.update(child._wiring_conflicts)
+                parent_names.update(self._base_parents[child.name])
+            parent_names.discard(p_name)
+            p._parents = set([self._partitions[name] for name in parent_names if name in managed])
                     
     def validate_job(self, spec):
         """validate a job for submission
@@ -813,6 +1101,7 @@ class BGBaseSystem (Component):
             if self.failed_diags.count(p.name) == 0:
                 ret += "failing %s\n" % p.name
                 self.failed_diags.append(p.name)
+                self._invalidate_locations_cache()
             else:
                 ret += "%s is already marked as failing\n" % p.name
 
@@ -830,6 +1119,7 @@ class BGBaseSystem (Component):
             if self.failed_diags.count(p.name):
                 ret += "unfailing %s\n" % p.name
                 self.failed_diags.remove(p.name)
+                self._invalidate_locations_cache()
             else:
                 ret += "%s is not currently failing\n" % p.name
         
@@ -837,10 +1127,10 @@ class BGBaseSystem (Component):
     unfail_partitions = exposed(unfail_partitions)
     
     def _find_job_location(self, args, drain_partitions=set(), backfilling=False):
+        """Find the best partition for one job; drain_partitions holds the numbers of the partitions to avoid"""
         jobid = args['jobid']
         nodes = args['nodes']
         queue = args['queue']
-        utility_score = args['utility_score']
         walltime = args['walltime']
         walltime_p = args.get('walltime_p', walltime)  #*AdjEst* 
         forbidden = args.get("forbidden", [])
@@ -851,10 +1141,7 @@ class BGBaseSystem (Component):
         else:
             runtime_estimate = float(walltime)
         
-        best_score = sys.maxint
-        best_partition = None
-        
-        available_partitions = set()
+        engine = self._backfill_engine
         
         requested_location = None
         if args['attrs'].has_key("location"):
@@ -865,9 +1152,11 @@ class BGBaseSystem (Component):
             # this is a lot like the stuff in _build_locations_cache, but unfortunately, 
             # reservation queues aren't assigned like real queues, so that code doesn't find
             # these
+            available_partitions = set()
             for p_name in required:
                 available_partitions.add(self.cached_partitions[p_name])
-                available_partitions.update(self.cached_partitions[p_name]._children)
+                available_partitions.update([self.cached_partitions[c_name]
+                    for c_name in self.cached_partitions[p_name].children])
 
             possible = set()
             for p in available_partitions:            
@@ -880,55 +1169,32 @@ class BGBaseSystem (Component):
                     desired_size = psize
                     break
             
-            for p in available_partitions.copy():
+            candidates = []
+            for p in available_partitions:
                 if p.size != desired_size:
-                    available_partitions.remove(p)
+                    continue
                 elif p.name in self._not_functional_set:
-                    available_partitions.remove(p)
+                    continue
                 elif requested_location and p.name != requested_location:
-                    available_partitions.remove(p)
+                    continue
+                candidates.append(engine.index[p.name])
+            candidates.sort()
+            excluded = drain_partitions
         else:
-            for p in self.possible_locations(nodes, queue):
-                skip = False
-                for bad_name in forbidden:
-                    if p.name==bad_name or bad_name in p.children or bad_name in p.parents:
-                        skip = True
-                        break
-                if not skip:
-                    if (not requested_location) or (p.name == requested_location):
-                        available_partitions.add(p)
+            candidates = engine.locations.get(queue, {}).get(self._desired_size(nodes, queue), [])
+            if requested_location:
+                candidates = [i for i in candidates if engine.names[i] == requested_location]
+            excluded = drain_partitions
+            if forbidden:
+                excluded = excluded | engine.forbidden(forbidden)
         
-        available_partitions -= drain_partitions
-        now = time.time()
-        
-        for partition in available_partitions:
-            # if the job needs more time than the partition currently has available, look elsewhere    
-            if backfilling: 
-                               
-                if partition.reserved_by:
-                    #if the partition is reserved, we don't use predicted walltime to backfill
-                    runtime_estimate = float(walltime)
-                
-                if 60 * runtime_estimate > (partition.backfill_time - now):      # *Adj_Est*
-                    continue
-                
-                if 60*float(walltime) > (partition.backfill_time - now):
-                    continue
-                
-            if partition.state == "idle":
-                # let's check the impact on partitions that would become blocked
-                score = 0
-                for p in partition.parents:
-                    if self.cached_partitions[p].state == "idle" and self.cached_partitions[p].scheduled:
-                        score += 1
-                
-                # the lower the score, the fewer new partitions will be blocked by this selection
-                if score < best_score:
-                    best_score = score
-                    best_partition = partition        
+        if backfilling:
+            best = engine.select(candidates, excluded, time.time(), runtime_estimate, float(walltime))
+        else:
+            best = engine.select(candidates, excluded)
 
-        if best_partition:
-            return {jobid: [best_partition.name]}
+        if best is not None:
+            return {jobid: [engine.names[best]]}
 
 
     def _find_drain_partition(self, job):
@@ -956,46 +1222,69 @@ class BGBaseSystem (Component):
         return drain_partition
 
 
-    def possible_locations(self, job_nodes, q_name):
-        desired_size = 0
+    def _desired_size(self, job_nodes, q_name):
+        """The smallest partition size defined in the queue that fits the job, or 0"""
         job_nodes = int(job_nodes)
         if self._defined_sizes.has_key(q_name):
             for psize in self._defined_sizes[q_name]:
                 if psize >= job_nodes:
-                    desired_size = psize
-                    break
+                    return psize
+        return 0
+
+    def possible_locations(self, job_nodes, q_name):
+        desired_size = self._desired_size(job_nodes, q_name)
 
         if self._locations_cache.has_key(q_name):
-            return self._locations_cache[q_name].get(desired_size, [])
+            return [self.cached_partitions[p_name] for p_name in self._locations_cache[q_name].get(desired_size, [])]
         else:
             return []
 
+    # partition fields read by _build_locations_cache; set_partitions only invalidates the cache when one of these changes
+    _locations_cache_fields = ['functional', 'scheduled', 'queue']
+
+    def _reset_locations_cache(self):
+        self._defined_sizes = {}
+        self._locations_cache = {}
+        self._not_functional_set = set()
+        # bumped whenever a partition change could alter the cache; find_job_location rebuilds the cache only when the
+        # generation it was built from is out of date
+        self._locations_generation = 0
+        self._locations_cache_generation = None
+        self._backfill_engine = None
+
+    def _invalidate_locations_cache(self):
+        """Force the next scheduling pass to rebuild the locations cache"""
+        self._locations_generation += 1
+
     # this function builds three things, namely a pair of dictionaries keyed by queue names, and a set of 
     # partition names which are not functional
     #
     # self._defined_sizes maps queue names to an ordered list of partition sizes available in that queue
     #     for all schedulable partitions (even if currently offline and not functional)
-    # self._locations_cache maps queue names to dictionaries which map partition sizes to partition objects;
+    # self._locations_cache maps queue names to dictionaries which map partition sizes to partition names;
     #     this structure will only contain partitions which are fully online, so we don't try to drain a
     #     broken partition
     # self._not_functional_set contains names of partitions which are not functional (either themselves, or
     #     a parent or child) 
+    #
+    # only names are kept so that the cache stays valid across passes; possible_locations looks the names up in
+    # self.cached_partitions
     def _build_locations_cache(self):
         per_queue = {}
         defined_sizes = {}
-        not_functional_set = set()
+        broken = set([p.name for p in self.cached_partitions.itervalues() if not p.functional])
+        not_functional_set = set(broken)
+        offline = set(self.cached_offline_partitions)
         for target_partition in self.cached_partitions.itervalues():
             usable = True
-            if target_partition.name in self.cached_offline_partitions:
+            if target_partition.name in offline:
                 usable = False
             else:
-                for part in self.cached_partitions.itervalues():
-                    if not part.functional:
-                        not_functional_set.add(part.name)
-                        if target_partition.name in part.children or target_partition.name in part.parents:
-                            usable = False
-                            not_functional_set.add(target_partition.name)
-                            break
+                for rel_name in target_partition.children + target_partition.parents:
+                    if rel_name in broken:
+                        usable = False
+                        not_functional_set.add(target_partition.name)
+                        break
 
             for queue_name in target_partition.queue.split(":"):
                 if not per_queue.has_key(queue_name):
@@ -1007,7 +1296,7 @@ class BGBaseSystem (Component):
                 if target_partition.scheduled and target_partition.functional and usable:
                     if not per_queue[queue_name].has_key(target_partition.size):
                         per_queue[queue_name][target_partition.size] = []
-                    per_queue[queue_name][target_partition.size].append(target_partition)
+                    per_queue[queue_name][target_partition.size].append(target_partition.name)
         
         for q_name in defined_sizes:
             defined_sizes[q_name] = sorted(defined_sizes[q_name])
@@ -1016,25 +1305,38 @@ class BGBaseSystem (Component):
         self._locations_cache = per_queue
         self._not_functional_set = not_functional_set
     
+    def _snapshot_partitions(self):
+        """Copy the managed partitions into PartitionSnapshots; the caller must hold the partitions lock"""
+        return dict([(p_name, PartitionSnapshot(self._partitions[p_name])) for p_name in self._managed_partitions
+            if p_name in self._partitions])
+
     def find_job_location(self, arg_list, end_times):
         best_partition_dict = {}
         
+        snapshot_start = time.time()
         self._partitions_lock.acquire()
         try:
             try:
                 if self.bridge_in_error:
                     return {}
-                self.cached_partitions = copy.deepcopy(self.partitions)
-                self.cached_offline_partitions = copy.deepcopy(self.offline_partitions)
+                self.cached_partitions = self._snapshot_partitions()
+                self.cached_offline_partitions = list(self.offline_partitions)
+                locations_generation = self._locations_generation
             except:
-                self.logger.error("error in copy.deepcopy", exc_info=True)
+                self.logger.error("error in taking the partition snapshot", exc_info=True)
                 return {}
         finally:
             self._partitions_lock.release()
-
-        # build the cached_partitions structure first
-        self._build_locations_cache()
-
+            self.statistics.add_value('find_job_location_snapshot', time.time() - snapshot_start)
+
+        # rebuild the locations cache and the backfill engine if any partition changed since they were last built
+        if self._locations_cache_generation != locations_generation or \
+                len(self._backfill_engine) != len(self.cached_partitions):
+            self._build_locations_cache()
+            self._backfill_engine = BackfillEngine(self.cached_partitions, self._locations_cache)
+            self._locations_cache_generation = locations_generation
+        engine = self._backfill_engine
+        engine.load(self.cached_partitions)
             
         # first, figure out backfilling cutoffs per partition (which we'll also use for picking which partition to drain)
         job_end_times = {}
@@ -1042,64 +1344,56 @@ class BGBaseSystem (Component):
             job_end_times[item[0][0]] = item[1]
             
         now = time.time()
-        for p in self.cached_partitions.itervalues():
-            if p.state == "idle":
-                p.backfill_time = now
-            else:
-                p.backfill_time = now + 5*60
+        engine.propagate(now, job_end_times)
+        for i, p_name in enumerate(engine.names):
+            p = self.cached_partitions[p_name]
+            p.backfill_time = engine.backfill_time[i]
             p.draining = False
         
-        for p in self.cached_partitions.itervalues():    
-            if p.name in job_end_times:
-                if job_end_times[p.name] > p.backfill_time:
-                    p.backfill_time = job_end_times[p.name]
-                
-                for parent_name in p.parents:
-                    parent_partition = self.cached_partitions[parent_name]
-                    if p.backfill_time > parent_partition.backfill_time:
-                        parent_partition.backfill_time = p.backfill_time
-        
-        for p in self.cached_partitions.itervalues():
-            if p.backfill_time == now:
-                continue
-            
-            for child_name in p.children:
-                child_partition = self.cached_partitions[child_name]
-                if child_partition.backfill_time == now or child_partition.backfill_time > p.backfill_time:
-                    child_partition.backfill_time = p.backfill_time
+        def _claim(job, partition_name):
+            # with max_jobs_per_pass above one, later jobs are placed against the partitions left over by earlier ones
+            best_partition_dict.update(partition_name)
+            if len(best_partition_dict) >= max_jobs_per_pass:
+                return True
+            until = time.time() + 60 * float(job['walltime'])
+            for i in engine.claim(engine.index[partition_name[job['jobid']][0]], until):
+                self.cached_partitions[engine.names[i]].backfill_time = engine.backfill_time[i]
+            return False
 
-        
         # first time through, try for starting jobs based on utility scores
         drain_partitions = set()
         
         for job in arg_list:
             partition_name = self._find_job_location(job, drain_partitions)
             if partition_name:
-                best_partition_dict.update(partition_name)
-                break
+                if _claim(job, partition_name):
+                    break
+                continue
             
             location = self._find_drain_partition(job)
             if location is not None:
                 for p_name in location.parents:
-                    drain_partitions.add(self.cached_partitions[p_name])
+                    drain_partitions.add(engine.index[p_name])
                 for p_name in location.children:
-                    drain_partitions.add(self.cached_partitions[p_name])
+                    drain_partitions.add(engine.index[p_name])
                     self.cached_partitions[p_name].draining = True
-                drain_partitions.add(location)
+                drain_partitions.add(engine.index[location.name])
                 #self.logger.info("job %s is draining %s" % (winning_job['jobid'], location.name))
                 location.draining = True
         
-        # the next time through, try to backfill, but only if we couldn't find anything to start
-        if not best_partition_dict:
+        # the next time through, try to backfill, but only if we couldn't start as many jobs as allowed
+        if len(best_partition_dict) < max_jobs_per_pass:
             
             # arg_list.sort(self._walltimecmp)
 
             for args in arg_list:
+                if best_partition_dict.has_key(args['jobid']):
+                    continue
                 partition_name = self._find_job_location(args, backfilling=True)
                 if partition_name:
                     self.logger.info("backfilling job %s" % args['jobid'])
-                    best_partition_dict.update(partition_name)
-                    break
+                    if _claim(args, partition_name):
+                        break
 
         # reserve the stuff in the best_partition_dict, as those partitions are allegedly going to 
         # be running jobs very soon
@@ -1236,6 +1530,7 @@ class BGBaseSystem (Component):
                     part.reserved_until = False
                     part.reserved_by = None
                     self.logger.info("reservation on partition '%s' has been removed", partition_name)
+                    scheduler_notifier.post()
                     rc = True
                 else:
                     self.logger.error("job %s wasn't allowed to clear the reservation on partition %s (owner=%s)",
@@ -407,8 +407,10 @@ class Job (ForeignData):
 class JobDict(ForeignDataDict):
     item_cls = Job
     key = 'jobid'
+    indexed_fields = ['jobid', 'queue', 'state', 'user', 'location', 'is_runnable', 'has_resources']
     __oserror__ = Cobalt.Util.FailureMode("QM Connection (job)")
     __function__ = ComponentProxy("queue-manager").get_jobs
+    __since_function__ = ComponentProxy("queue-manager").get_jobs_since
     __fields__ = ['nodes', 'location', 'jobid', 'state', 'index',
                   'walltime', 'queue', 'user', 'submittime', 'starttime', 'project',
                   'is_runnable', 'is_active', 'has_resources', 'score', 'attrs', 'walltime_p',]
@@ -443,6 +445,7 @@ class QueueDict(ForeignDataDict):
     key = 'name'
     __oserror__ = Cobalt.Util.FailureMode("QM Connection (queue)")
     __function__ = ComponentProxy("queue-manager").get_queues
+    __since_function__ = ComponentProxy("queue-manager").get_queues_since
     __fields__ = ['name', 'state', 'policy', 'priority']
 
 #    def Sync(self):
@@ -502,7 +505,7 @@ class BGSched (Component):
                 'active':self.active,
                 'next_res_id':self.id_gen.idnum+1, 
                 'next_cycle_id':self.cycle_id_gen.idnum+1, 
-                'msg_queue': dbwriter.msg_queue, 
+                'msg_queue': list(dbwriter.msg_queue), 
                 'overflow': dbwriter.overflow})
         return state
     
@@ -615,6 +618,8 @@ class BGSched (Component):
 
     def get_reservations (self, specs):
         return self.reservations.q_get(specs)
+    # matching or returning the active field runs Reservation.is_active, which activates and cycles reservations, so
+    # this is not read-only
     get_reservations = exposed(query(get_reservations))
 
     def set_reservations(self, specs, updates, user_name):
@@ -729,25 +734,40 @@ class BGSched (Component):
                 self.logger.error("failed to connect to system component")
                 best_partition_dict = {}
     
-            for jobid in best_partition_dict:
-                job = self.jobs[int(jobid)]
-                self._start_job(job, best_partition_dict[jobid], {str(job.jobid):cur_res.res_id})
+            self._start_jobs(active_jobs, best_partition_dict, cur_res.res_id)
 
-    def _start_job(self, job, partition_list, resid=None):
-        """Get the queue manager to start a job."""
+    def _start_job(self, job, partition_list, resid=None, cqm=None):
+        """Get the queue manager to start a job.  Returns False if the queue manager could not be reached."""
 
-        cqm = ComponentProxy("queue-manager")
+        if cqm is None:
+            cqm = ComponentProxy("queue-manager")
         
         try:
             self.logger.info("trying to start job %d on partition %r" % (job.jobid, partition_list))
             cqm.run_jobs([{'tag':"job", 'jobid':job.jobid}], partition_list, None, resid)
         except ComponentLookupError:
             self.logger.error("failed to connect to queue manager")
-            return
+            return False
 
         self.started_jobs[job.jobid] = self.get_current_time()
+        return True
 
+    def _start_jobs(self, jobs, best_partition_dict, res_id=None):
+        """Start every job the allocator placed, in the order of the job list.
 
+        The allocator may place several jobs per pass (see max_jobs_per_pass in the bgsystem section); they are all
+        started with the same queue manager proxy, and the batch is abandoned if the queue manager goes away.
+        """
+        cqm = ComponentProxy("queue-manager")
+        for job in jobs:
+            jobid = str(job.jobid)
+            if not best_partition_dict.has_key(jobid):
+                continue
+            resid = None
+            if res_id is not None:
+                resid = {jobid:res_id}
+            if not self._start_job(job, best_partition_dict[jobid], resid, cqm):
+                break
 
     def schedule_jobs (self):
         '''look at the queued jobs, and decide which ones to start'''
@@ -911,14 +931,22 @@ class BGSched (Component):
                 self.logger.error("failed to connect to system component", exc_info=True)
                 best_partition_dict = {}
     
-            for jobid in best_partition_dict:
-                job = self.jobs[int(jobid)]
-                self._start_job(job, best_partition_dict[jobid])
+            self._start_jobs(active_jobs, best_partition_dict)
     
 
         # print "took %f seconds for scheduling loop" % (time.time() - started_scheduling, )
     schedule_jobs = locking(automatic(schedule_jobs, float(get_bgsched_config('schedule_jobs_interval', 10))))
 
+    def reschedule(self):
+        '''run a scheduling pass soon, rather than waiting for the next periodic one
+
+        the queue manager and the system component call this when jobs are submitted or released, tasks end, or
+        partitions are freed.  calls arriving within reschedule_delay seconds of the first are folded into one pass.
+        '''
+        self.trigger_automatic('schedule_jobs', float(get_bgsched_config('reschedule_delay', 1)))
+        return True
+    reschedule = locking(exposed(reschedule))
+
     def get_resid(self, queue_name):
         
         return None
@@ -27,7 +27,8 @@ from Cobalt.Components.base import Component, exposed, automatic, query
 import Cobalt.bridge
 from Cobalt.bridge import BridgeException
 from Cobalt.Exceptions import ProcessGroupCreationError, ComponentLookupError
-from Cobalt.Components.bg_base_system import NodeCard, PartitionDict, BGProcessGroupDict, BGBaseSystem, JobValidationError
+from Cobalt.Components.bg_base_system import NodeCard, PartitionDict, BGProcessGroupDict, BGBaseSystem, JobValidationError, \
+    scheduler_notifier
 from Cobalt.Proxy import ComponentProxy
 from Cobalt.Statistics import Statistics
 from Cobalt.DataTypes.ProcessGroup import ProcessGroup
@@ -321,6 +322,7 @@ class BGSystem (BGBaseSystem):
             now = time.time()
             partitions_cleanup = []
             bridge_partition_cache = {}
+            previous_offline_partitions = set(self.offline_partitions)
             self.offline_partitions = []
             missing_partitions = set(self._partitions.keys())
             new_partitions = []
@@ -398,6 +400,7 @@ class BGSystem (BGBaseSystem):
                             else:
                                 p.cleanup_pending = False
                                 self.logger.info("partition %s: cleaning complete", p.name)
+                                scheduler_notifier.post()
                     if p.state == "busy":
                         # FIXME: this should not be necessary any longer since all jobs reserve the resources. --brt
 
@@ -449,6 +452,9 @@ class BGSystem (BGBaseSystem):
             except:
                 self.logger.error("error in update_partition_state", exc_info=True)
 
+            # partitions going offline or coming back change where jobs can be placed
+            if set(self.offline_partitions) != previous_offline_partitions:
+                self._invalidate_locations_cache()
             self._partitions_lock.release()
 
             # cleanup partitions and set their kernels back to the default (while _not_ holding the lock)
@@ -6,14 +6,20 @@ ClusterBaseSystem -- base system component
 
 import time
 import sys
+import math
+import shlex
 import Cobalt
 import threading
 import pwd
 import grp
 import ConfigParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
 import Cobalt.Util
 from Cobalt.Exceptions import  JobValidationError, NotSupportedError, ComponentLookupError
-from Cobalt.Components.base import Component, exposed, automatic
+from Cobalt.Components.base import Component, exposed, automatic, readonly
 from Cobalt.DataTypes.ProcessGroup import ProcessGroupDict
 from Cobalt.Statistics import Statistics
 from Cobalt.Data import DataDict
@@ -601,7 +607,7 @@ class ClusterBaseSystem (Component):
                 partitions.append(item)
         
         return partitions
-    get_partitions = exposed(get_partitions)
+    get_partitions = exposed(readonly(get_partitions))
 
 
     def clean_nodes(self, locations, user, jobid):
@@ -618,45 +624,66 @@ class ClusterBaseSystem (Component):
             group_name = ""
             self.logger.error("Job %s/%s: unable to determine group name for epilogue" % (user, jobid))
      
-        self.cleaning_host_count[jobid] = 0
-        for host in locations:
-            h = host.split(":")[0]
-            cleaning_process_info ={
+        hosts = [host.split(":")[0] for host in locations]
+        timeout = self.script_timeout("epilogue", len(hosts))
+        cleaning_processes = []
+        for h in hosts:
+            cleaning_processes.append({
                     "host": h, 
                     "cleaning_id": None, 
                     "user": user,
                     "jobid": jobid,
                     "group": group_name,
                     "start_time":time.time(), 
+                    "timeout":timeout,
                     "completed":False, 
                     "retry":False,
-                    }
-            try:
-                cleaning_id = self.launch_script("epilogue", h, jobid, user,
-                        group_name)
-                if cleaning_id == None:
-                    #there was no script to run.
-                    self.running_nodes.discard(cleaning_processes["host"]) 
-                    return 
-                self.cleaning_host_count[jobid] += 1
-                cleaning_process_info["cleaning_id"] = cleaning_id
-                self.cleaning_processes.append(cleaning_process_info)
-            except ComponentLookupError:
-                self.logger.warning("Job %s/%s: Error contacting forker "
-                        "component.  Will Retry until timeout." % (user, jobid))
-                cleaning_process_info["retry"] = True
-                self.cleaning_processes.append(cleaning_process_info)
-                self.cleaning_host_count[jobid] += 1
-            except:
-                self.logger.error("Job %s/%s: Failed to run epilogue on host "
-                        "%s, marking node down", jobid, user, h, exc_info=True)
-                self.down_nodes.add(h)
-                self.running_nodes.discard(h)
+                    })
+        self.cleaning_host_count[jobid] = 0
+        try:
+            cleaning_ids = self.launch_scripts("epilogue", hosts, jobid, user, group_name)
+        except ComponentLookupError:
+            self.logger.warning("Job %s/%s: Error contacting forker "
+                    "component.  Will Retry until timeout." % (user, jobid))
+            for cleaning_process in cleaning_processes:
+                cleaning_process["retry"] = True
+            self.cleaning_processes.extend(cleaning_processes)
+            self.cleaning_host_count[jobid] += len(cleaning_processes)
+            return
+        except:
+            self.logger.error("Job %s/%s: Failed to run epilogue on hosts "
+                    "%s, marking nodes down", jobid, user, " ".join(hosts), exc_info=True)
+            self.down_nodes.update(hosts)
+            self.running_nodes.difference_update(hosts)
+            cleaning_ids = []
+
+        if cleaning_ids == None:
+            #there was no script to run.
+            self.running_nodes.difference_update(hosts)
+            cleaning_ids = []
+        for cleaning_process, cleaning_id in zip(cleaning_processes, cleaning_ids):
+            if cleaning_id == None:
+                #the forker could not start the script on this host; it was never cleaned, so mark it down.
+                self.logger.error("Job %s/%s: Failed to start epilogue on host %s, marking node down",
+                        user, jobid, cleaning_process["host"])
+                self.down_nodes.add(cleaning_process["host"])
+                self.running_nodes.discard(cleaning_process["host"])
+                continue
+            self.cleaning_host_count[jobid] += 1
+            cleaning_process["cleaning_id"] = cleaning_id
+            self.cleaning_processes.append(cleaning_process)
+        self.__check_job_cleaned(jobid, user)
     
 
 
-    def launch_script(self, config_option, host, jobid, user, group_name):
-        '''Start our script processes used for node prep and cleanup.
+    def launch_scripts(self, config_option, hosts, jobid, user, group_name):
+        '''Start our script processes used for node prep and cleanup, one per
+        host, with a single call to the forker.  Returns the list of child ids
+        in the order of hosts, or None if no script is configured.
+
+        Unless script_fanout is turned off, the forker runs the script across
+        all of the hosts from a single child, fanout_window hosts at a time,
+        and every host shares that child's id.
 
         '''
         script = get_cluster_system_config(config_option, None)
@@ -666,10 +693,31 @@ class ClusterBaseSystem (Component):
                     user, jobid, config_option)
             return None
         else:
-            cmd = ["/usr/bin/ssh", host, script, 
-                    str(jobid), user, group_name]
-            return ComponentProxy("system_script_forker").fork(cmd, "system epilogue", 
-                    "Job %s/%s" % (jobid, user))
+            #sites may add options, such as ControlMaster, to reuse connections
+            ssh = shlex.split(get_cluster_system_config("ssh_command", "/usr/bin/ssh"))
+            label = "Job %s/%s" % (jobid, user)
+            if get_cluster_system_config("script_fanout", "true").lower() in Cobalt.Util.config_true_values:
+                cleaning_id = ComponentProxy("system_script_forker").fork_fanout(
+                        ssh + ["{host}", script, str(jobid), user, group_name], hosts, "system epilogue", label, None,
+                        int(get_cluster_system_config("fanout_window", 64)),
+                        float(get_cluster_system_config("%s_timeout" % config_option, 60.0)))
+                return [cleaning_id] * len(hosts)
+            specs = []
+            for host in hosts:
+                specs.append({'args':ssh + [host, script, str(jobid), user, group_name],
+                              'tag':"system epilogue", 'label':label})
+            return ComponentProxy("system_script_forker").fork_many(specs)
+
+    def script_timeout(self, config_option, host_count):
+        '''Time allowed for a script to finish on all of the hosts launched
+        together.  A fan-out works through the hosts a window at a time.
+
+        '''
+        timeout = float(get_cluster_system_config("%s_timeout" % config_option, 60.0))
+        if get_cluster_system_config("script_fanout", "true").lower() in Cobalt.Util.config_true_values:
+            windows = math.ceil(host_count / float(get_cluster_system_config("fanout_window", 64)))
+            return timeout * (windows + 1)
+        return timeout
 
         
 
@@ -693,30 +741,46 @@ class ClusterBaseSystem (Component):
     def retry_cleaning_scripts(self):
         '''Continue retrying scripts in the event that we have lost contact 
         with the forker component.  Reset start-time to when script starts.
+        The scripts for each job are restarted with a single call to the forker.
 
         '''
+        retries = {}
         for cleaning_process in self.cleaning_processes:
             if cleaning_process['retry'] == True:
-                try:
-                    cleaning_id = self.launch_script(
-                            "epilogue",
-                            cleaning_process["host"],
-                            cleaning_process['jobid'],
-                            cleaning_process['user'],
-                            cleaning_process['group'])
+                retries.setdefault(cleaning_process['jobid'], []).append(cleaning_process)
+
+        for jobid, cleaning_processes in retries.iteritems():
+            user = cleaning_processes[0]['user']
+            hosts = [cleaning_process['host'] for cleaning_process in cleaning_processes]
+            timeout = self.script_timeout("epilogue", len(hosts))
+            try:
+                cleaning_ids = self.launch_scripts("epilogue", hosts, jobid, user, cleaning_processes[0]['group'])
+            except ComponentLookupError:
+                self.logger.warning("Job %s/%s: Error contacting forker "
+                    "component." % (jobid, user))
+                break
+            except:
+                self.logger.error("Job %s/%s: Failed to run epilogue on "
+                        "hosts %s, marking nodes down", jobid, user, " ".join(hosts),
+                        exc_info=True)
+                cleaning_ids = [None] * len(hosts)
+            if cleaning_ids == None:
+                cleaning_ids = [None] * len(hosts)
+            for cleaning_process, cleaning_id in zip(cleaning_processes, cleaning_ids):
+                cleaning_process["retry"] = False
+                if cleaning_id == None:
+                    cleaning_process["completed"] = True
+                    self.cleaning_host_count[jobid] -= 1
+                    self.down_nodes.add(cleaning_process["host"])
+                    self.running_nodes.discard(cleaning_process["host"])
+                else:
                     cleaning_process["cleaning_id"] = cleaning_id
                     cleaning_process["start_time"] = time.time()
-                    cleaning_process["retry"] = False
-                except ComponentLookupError:
-                    self.logger.warning("Job %s/%s: Error contacting forker "
-                        "component." % (pg.jobid, pg.user))
-                except:
-                    self.logger.error("Job %s/%s: Failed to run epilogue on "
-                            "host %s, marking node down", pg.jobid, pg.user, h,
-                            exc_info=True)
-                    self.cleaning_host_count[jobid] -= 1
-                    self.down_nodes.add(h)
-                    self.running_nodes.discard(h)
+                    cleaning_process["timeout"] = timeout
+            self.__check_job_cleaned(jobid, user)
+
+        self.cleaning_processes = [cleaning_process for cleaning_process in self.cleaning_processes 
+                                    if cleaning_process["completed"] == False]
 
     retry_cleaning_scripts = automatic(retry_cleaning_scripts,
             get_cluster_system_config("automatic_method_interval", 10.0))
@@ -727,74 +791,95 @@ class ClusterBaseSystem (Component):
         consumption.  If the cleanup fails for some reason, then mark the node
         down and release it. 
 
+        The status of every cleaning process is fetched, and the finished ones
+        cleaned up, with one call to the forker each.
+
         """
         
-        if self.cleaning_processes == []:
+        #skip processes waiting to be retried.  Try anyway, if component came back up.
+        cleaning_processes = [cleaning_process for cleaning_process in self.cleaning_processes
+                              if cleaning_process['retry'] == False]
+        if cleaning_processes == []:
             #don't worry if we have nothing to cleanup
             return
-        
-        for cleaning_process in self.cleaning_processes: 
 
-            #if we can't reach the forker, we've lost all the cleanup scripts.
-            #don't try and recover, just assume all nodes that were being 
-            #cleaned are down. --PMR
-            if cleaning_process['retry'] == True:
-                continue #skip this.  Try anyway, if component came back up.
-            
+        #if we can't reach the forker, we've lost all the cleanup scripts.
+        #don't try and recover, just assume all nodes that were being 
+        #cleaned are down. --PMR
+        forker = ComponentProxy("system_script_forker")
+        try:
+            children = {}
+            #hosts cleaned by a fan-out share its child
+            for child in forker.get_children(None, list(set([cleaning_process['cleaning_id']
+                                                             for cleaning_process in cleaning_processes])), True):
+                children[child['id']] = child
+        except ComponentLookupError:
+            self.logger.error("Error contacting forker component. Running "
+                    "child processes are unrecoverable.")
+            return
+
+        epilogue_timeout = float(get_cluster_system_config("epilogue_timeout", 60.0))
+        finished_ids = set()
+        signaled_ids = set()
+        fanout_results = {}
+        finished_jobs = {}
+        for cleaning_process in cleaning_processes: 
             jobid = cleaning_process['jobid']
             user = cleaning_process['user']
+            child = children.get(cleaning_process['cleaning_id'], {})
 
-            try:
-                exit_status = ComponentProxy("system_script_forker").child_completed(
-                        cleaning_process['cleaning_id'])
-                ComponentProxy("system_script_forker").child_cleanup(
-                        [cleaning_process['cleaning_id']])
-
-            except ComponentLookupError:
-                self.logger.error("Job %s/%s: Error contacting forker "
-                        "component. Running child processes are "
-                        "unrecoverable." % (jobid, user))
-                return
-
-            if exit_status != None:
-                #we're done, this node is now free to be scheduled again.
-                self.running_nodes.discard(cleaning_process["host"])
+            if child.get('complete', False):
                 cleaning_process["completed"] = True
                 self.cleaning_host_count[jobid] -= 1
-            else:
+                finished_ids.add(cleaning_process['cleaning_id'])
+                finished_jobs[jobid] = user
+                if not fanout_results.has_key(child['id']):
+                    fanout_results[child['id']] = self.__fanout_results(child)
+                result = fanout_results[child['id']].get(cleaning_process["host"])
+                if result is not None and result['timed_out']:
+                    #the fan-out gave up on this host; mark it down.
+                    self.down_nodes.add(cleaning_process['host'])
+                    self.logger.error("Job %s/%s: epilogue timed out on host %s, marking hosts down",
+                        user, jobid, cleaning_process['host'])
+                    self.logger.error("Job %s/%s: output from epilogue on host %s: [%s]",
+                        user, jobid, cleaning_process['host'], result['output'].strip())
+                #we're done, this node is now free to be scheduled again.
+                self.running_nodes.discard(cleaning_process["host"])
+            elif time.time() - cleaning_process["start_time"] > cleaning_process.get("timeout", epilogue_timeout):
                 #timeout exceeded
-                if (time.time() - cleaning_process["start_time"] > 
-                        float(get_cluster_system_config("epilogue_timeout", 60.0))): 
-                    cleaning_process["completed"] = True
+                if cleaning_process['cleaning_id'] not in signaled_ids:
                     try:
-                        forker = ComponentProxy("system_script_forker").signal(
-                                cleaning_process['cleaning_id'], "SIGINT")
-                        child_output = forker.get_child_data(
-                            cleaning_process['cleaning_id'])
-                        forker.child_cleanup([cleaning_process['cleaning_id']])
-                            
-                        #mark as dirty and arrange to mark down.
-                        self.down_nodes.add(cleaning_process['host'])
-                        self.running_nodes.discard(cleaning_process['host'].host) # <---????check this!
-                        self.logger.error("Job %s/%s: epilogue timed out on host %s, marking hosts down", 
-                            user, jobid, cleaning_process['host'])
-                        self.logger.error("Job %s/%s: stderr from epilogue on host %s: [%s]",
-                            user, jobid,
-                            cleaning_process['host'], 
-                            child_output['stderr'].strip())
-                        self.cleaning_host_count[jobid] -= 1
+                        forker.signal(cleaning_process['cleaning_id'], "SIGINT")
                     except ComponentLookupError:
                         self.logger.error("Job %s/%s: Error contacting forker "
                             "component. Running child processes are "
                             "unrecoverable." % (jobid, user))
+                        continue
+                    signaled_ids.add(cleaning_process['cleaning_id'])
+                cleaning_process["completed"] = True
+                finished_ids.add(cleaning_process['cleaning_id'])
+                finished_jobs[jobid] = user
+
+                #mark as dirty and arrange to mark down.
+                self.down_nodes.add(cleaning_process['host'])
+                self.running_nodes.discard(cleaning_process['host'])
+                self.logger.error("Job %s/%s: epilogue timed out on host %s, marking hosts down", 
+                    user, jobid, cleaning_process['host'])
+                self.logger.error("Job %s/%s: stderr from epilogue on host %s: [%s]",
+                    user, jobid,
+                    cleaning_process['host'], 
+                    "\n".join(child.get('stderr') or []).strip())
+                self.cleaning_host_count[jobid] -= 1
+
+        if finished_ids:
+            try:
+                forker.cleanup_children(list(finished_ids))
+            except ComponentLookupError:
+                self.logger.error("Error contacting forker component. Finished "
+                        "child processes were not cleaned up.")
 
-            if self.cleaning_host_count[jobid] == 0:
-                self.del_process_groups(jobid)
-                #clean up other cleanup-monitoring stuff
-                self.logger.info("Job %s/%s: job finished on %s",
-                    user, jobid, Cobalt.Util.merge_nodelist(self.locations_by_jobid[jobid]))
-                del self.locations_by_jobid[jobid]
-                del self.jobid_to_user[jobid]
+        for jobid, user in finished_jobs.iteritems():
+            self.__check_job_cleaned(jobid, user)
         
         self.cleaning_processes = [cleaning_process for cleaning_process in self.cleaning_processes 
                                     if cleaning_process["completed"] == False]
@@ -802,6 +887,29 @@ class ClusterBaseSystem (Component):
     check_done_cleaning = automatic(check_done_cleaning, 
             get_cluster_system_config("automatic_method_interval", 10.0))
 
+    def __fanout_results(self, child):
+        '''Per-host results reported by a fan-out child, keyed by host'''
+        results = {}
+        for line in child.get('stdout') or []:
+            try:
+                result = json.loads(line)
+                results[str(result['host'])] = result
+            except (ValueError, TypeError, KeyError):
+                #the output of a script run directly rather than fanned out
+                pass
+        return results
+
+    def __check_job_cleaned(self, jobid, user):
+        '''Once no hosts of a job remain to be cleaned, finish off the job.'''
+        if self.cleaning_host_count[jobid] == 0:
+            self.del_process_groups(jobid)
+            #clean up other cleanup-monitoring stuff
+            self.logger.info("Job %s/%s: job finished on %s",
+                user, jobid, Cobalt.Util.merge_nodelist(self.locations_by_jobid[jobid]))
+            del self.locations_by_jobid[jobid]
+            del self.jobid_to_user[jobid]
+            del self.cleaning_host_count[jobid]
+
 
 
     def del_process_groups(self, jobid):
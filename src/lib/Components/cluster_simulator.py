@@ -26,7 +26,7 @@ import Cobalt.Data
 import Cobalt.Util
 from Cobalt.Components import cluster_base_system
 from Cobalt.Data import Data, DataDict, IncrID
-from Cobalt.Components.base import Component, exposed, automatic, query
+from Cobalt.Components.base import Component, exposed, automatic, query, readonly
 from Cobalt.Components.cluster_base_system import ProcessGroupDict, ClusterBaseSystem
 from Cobalt.Exceptions import ProcessGroupCreationError
 from Cobalt.DataTypes.ProcessGroup import ProcessGroup
@@ -145,7 +145,7 @@ class Simulator (ClusteSystem):
     def get_process_groups (self, specs):
         """Query process_groups from the simulator."""
         return self.process_groups.q_get(specs)
-    get_process_groups = exposed(query(get_process_groups))
+    get_process_groups = exposed(readonly(query(get_process_groups)))
     
     def wait_process_groups (self, specs):
         """get process groups that have finished running."""
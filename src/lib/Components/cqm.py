@@ -80,20 +80,23 @@ import math
 import types
 import xmlrpclib
 import ConfigParser
+import cPickle
 import signal
 import thread
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 import traceback
 import string
+import heapq
+import itertools
 
 
 import Cobalt
 import Cobalt.Util
-from Cobalt.Util import Timer, pickle_data, unpickle_data, disk_writer_thread
+from Cobalt.Util import Timer, pickle_data, unpickle_data, disk_writer_thread, notifier_thread
 import Cobalt.Cqparse
-from Cobalt.Data import Data, DataList, DataDict, IncrID
+from Cobalt.Data import Data, DataList, DataDict, IncrID, changes_since
 from Cobalt.StateMachine import StateMachine
-from Cobalt.Components.base import Component, exposed, automatic, query, locking
+from Cobalt.Components.base import Component, StateJournal, exposed, automatic, query, locking, readonly
 from Cobalt.Proxy import ComponentProxy
 from Cobalt.Exceptions import (QueueError, ComponentLookupError, DataStateError, DataStateTransitionError, StateMachineError,
     StateMachineIllegalEventError, StateMachineNonexistentEventError, ThreadPickledAliveException, JobProcessingError,
@@ -108,6 +111,18 @@ logger = logging.getLogger(__name__.split('.')[-1])
 cqm_id_gen = None
 run_id_gen = None #IncrID()
 
+# jobs changed since the queue manager's last save, keyed by jobid; None while no state journal is kept
+journaled_jobs = None
+
+# jobs whose place in the queue manager's progress schedule must be reconsidered, keyed by jobid
+progress_pending = {}
+
+# jobs whose share of their queue's job counts must be recomputed, keyed by queue name and then jobid
+counts_pending = {}
+
+# events of the wait_for_jobs calls watching each job, keyed by jobid
+job_watches = {}
+
 cqm_forker_tag = "cqm_script"
 job_prescript_tag = "job prescript"
 job_postscript_tag = "job postscript"
@@ -152,6 +167,14 @@ if walltime_prediction  == "true":
     
 prediction_scheme = get_histm_config("prediction_scheme", "combined").lower()  # ["project", "user", "combined"]   # *AdjEst*
 
+# longest a wait_for_jobs call is held before returning, kept below the clients' RPC timeout
+max_job_wait = float(get_cqm_config("max_job_wait", 60))
+
+# between full snapshots of the statefile, changed jobs are appended to a journal alongside it
+state_journal_enabled = get_cqm_config("state_journal", "true").lower() in Cobalt.Util.config_true_values
+snapshot_interval = float(get_cqm_config("snapshot_interval", 600))
+journal_max_size = int(get_cqm_config("journal_max_size", 64 * 1024 * 1024))
+
 accounting_logdir = os.path.expandvars(get_cqm_config("log_dir", Cobalt.DEFAULT_LOG_DIRECTORY))
 accounting_logger = logging.getLogger("cqm.accounting")
 accounting_logger.addHandler(
@@ -177,6 +200,9 @@ cobalt_log_writer = disk_writer_thread()
 cobalt_log_writer.daemon = True
 cobalt_log_writer.start()
 
+#tells the scheduler about submitted, released and finished jobs so that it need not wait for its next periodic pass.
+scheduler_notifier = notifier_thread("scheduler", "reschedule")
+
 def cobalt_log_write(filename, msg):
     '''send the cobalt_log writer thread a filename, msg tuple.
     
@@ -189,6 +215,26 @@ def cobalt_log_terminate():
     '''
     coblat_log_writer.send(None)
 
+def journal_job(job):
+    '''note a changed job for the next state journal flush'''
+    if journaled_jobs is not None:
+        journaled_jobs[job.jobid] = job
+
+def schedule_progress(job):
+    '''note a job whose state or timers changed for the next progress pass'''
+    progress_pending[job.jobid] = job
+
+def schedule_count(job):
+    '''note a job whose state, walltime or size changed for the next use of its queue's job counts'''
+    counts_pending.setdefault(job.queue, {})[job.jobid] = job
+
+def notify_watches(job):
+    '''wake the wait_for_jobs calls watching a job whose state changed.  besides state machine transitions, the state
+    also changes with the flags behind the maxrun_hold, dep_hold and dep_fail states (max_running, the dependencies
+    and dep_fail), so this is called wherever those are set'''
+    for watch in job_watches.get(job.jobid, ()):
+        watch.set()
+
 def str_elapsed_time(elapsed_time):
     return "%d:%02d:%02d" % (elapsed_time / 3600, elapsed_time / 60 % 60, elapsed_time % 60)
 
@@ -395,113 +441,113 @@ def get_job_sm_events():
 
     return ['Run', 'Hold', 'Release', 'Preempt', 'Kill', 'Task_End']
 
-def get_job_sm_seas(job):
-
-    return {('Ready', 'Run') : [job._sm_ready__run],
-            ('Ready', 'Hold') : [job._sm_ready__hold],
-            ('Ready', 'Release') : [job._sm_ready__release],
-            ('Ready', 'Kill') : [job._sm_ready__kill],
-            ('Hold', 'Hold') : [job._sm_hold__hold],
-            ('Hold', 'Release') : [job._sm_hold__release],
-            ('Hold', 'Kill') : [job._sm_hold__kill],
-            ('Job_Prologue', 'Progress') : [job._sm_job_prologue__progress],
-            ('Job_Prologue', 'Hold') : [job._sm_common__pending_hold], 
-            ('Job_Prologue', 'Release') : [job._sm_common__pending_release],
-            ('Job_Prologue', 'Preempt') : [job._sm_common__pending_preempt], #custom?
-            ('Job_Prologue', 'Kill') : [job._sm_common__pending_kill],
-            ('Job_Prologue_Retry', 'Progress') : [job._sm_job_prologue_retry__progress],
-            ('Job_Prologue_Retry', 'Hold') : [job._sm_common__pending_hold],
-            ('Job_Prologue_Retry', 'Release') : [job._sm_common__pending_release],
-            ('Job_Prologue_Retry', 'Preempt') : [job._sm_common__pending_preempt], #Must go pending
-            ('Job_Prologue_Retry', 'Kill') : [job._sm_job_prologue_retry__kill],
-            ('Resource_Prologue', 'Progress') : [job._sm_resource_prologue__progress],
-            ('Resource_Prologue', 'Hold') : [job._sm_common__pending_hold],
-            ('Resource_Prologue', 'Release') : [job._sm_common__pending_release],
-            ('Resource_Prologue', 'Preempt') : [job._sm_common__pending_preempt], #custom?
-            ('Resource_Prologue', 'Kill') : [job._sm_common__pending_kill],
-            ('Resource_Prologue_Retry', 'Progress') : [job._sm_job_prologue_retry__progress],
-            ('Resource_Prologue_Retry', 'Hold') : [job._sm_common__pending_hold],
-            ('Resource_Prologue_Retry', 'Release') : [job._sm_common__pending_release],
-            ('Resource_Prologue_Retry', 'Preempt') : [job._sm_common__pending_preempt], #custom: go directly to preempted?
-            ('Resource_Prologue_Retry', 'Kill') : [job._sm_job_prologue_retry__kill],
-            ('Release_Resources_Retry', 'Progress') : [job._sm_release_resources_retry__progress],
-            ('Release_Resources_Retry', 'Hold') : [job._sm_exit_common__hold],
-            ('Release_Resources_Retry', 'Release') : [job._sm_exit_common__release],
-            ('Release_Resources_Retry', 'Preempt') : [job._sm_exit_common__preempt],
-            ('Release_Resources_Retry', 'Kill') : [job._sm_exit_common__kill],
-            ('Run_Retry', 'Progress') : [job._sm_run_retry__progress],
-            ('Run_Retry', 'Hold') : [job._sm_common__pending_hold],
-            ('Run_Retry', 'Release') : [job._sm_common__pending_release],
-            ('Run_Retry', 'Preempt') : [job._sm_common__pending_preempt],
-            ('Run_Retry', 'Kill') : [job._sm_run_retry__kill],
-            ('Running', 'Progress') : [job._sm_running__progress],
-            ('Running', 'Hold') : [job._sm_common__pending_hold],
-            ('Running', 'Release') : [job._sm_common__pending_release],
-            ('Running', 'Preempt') : [job._sm_common__pending_preempt],
-            ('Running', 'Kill') : [job._sm_running__kill],
-            ('Running', 'Task_End') : [job._sm_running__task_end],
-            ('Kill_Retry', 'Progress') : [job._sm_kill_retry__progress],
-            ('Kill_Retry', 'Hold') : [job._sm_kill_common__hold],
-            ('Kill_Retry', 'Release') : [job._sm_kill_common__release],
-            ('Kill_Retry', 'Preempt') : [job._sm_kill_common__preempt],
-            ('Kill_Retry', 'Kill') : [job._sm_kill_retry__kill],
-            ('Kill_Retry', 'Task_End') : [job._sm_kill_retry__task_end],
-            ('Killing', 'Progress') : [job._sm_killing__progress],
-            ('Killing', 'Hold') : [job._sm_kill_common__hold],
-            ('Killing', 'Release') : [job._sm_kill_common__release],
-            ('Killing', 'Preempt') : [job._sm_kill_common__preempt],
-            ('Killing', 'Kill') : [job._sm_killing__kill],
-            ('Killing', 'Task_End') : [job._sm_killing__task_end],
-            ('Preempt_Retry', 'Progress') : [job._sm_preempt_retry__progress],
-            ('Preempt_Retry', 'Hold') : [job._sm_common__pending_hold],
-            ('Preempt_Retry', 'Release') : [job._sm_common__pending_release],
-            ('Preempt_Retry', 'Kill') : [job._sm_preempt_retry__kill],
-            ('Preempt_Retry', 'Task_End') : [job._sm_preempt_retry__task_end],
-            ('Preempting', 'Progress') : [job._sm_preempting__progress],
-            ('Preempting', 'Hold') : [job._sm_common__pending_hold],
-            ('Preempting', 'Release') : [job._sm_common__pending_release],
-            ('Preempting', 'Kill') : [job._sm_preempting__kill],
-            ('Preempting', 'Task_End') : [job._sm_preempting__task_end],
-            ('Preempt_Finalize_Retry', 'Progress') : [job._sm_preempt_finalize_retry__progress],
-            ('Preempt_Finalize_Retry', 'Hold') : [job._sm_common__pending_hold],
-            ('Preempt_Finalize_Retry', 'Release') : [job._sm_common__pending_release],
-            ('Preempt_Finalize_Retry', 'Kill') : [job._sm_common__pending_kill],
-            ('Preempt_Epilogue', 'Progress') : [job._sm_preempt_epilogue__progress],
-            ('Preempt_Epilogue', 'Hold') : [job._sm_common__pending_hold],
-            ('Preempt_Epilogue', 'Release') : [job._sm_common__pending_release],
-            ('Preempt_Epilogue', 'Kill') : [job._sm_common__pending_kill],
-            ('Preempted', 'Run') : [job._sm_preempted__run],
-            ('Preempted', 'Hold') : [job._sm_preempted__hold],
-            ('Preempted', 'Release') : [job._sm_preempted__release],
-            ('Preempted', 'Kill') : [job._sm_preempted__kill],
-            ('Preempted_Hold', 'Hold') : [job._sm_preempted_hold__hold],
-            ('Preempted_Hold', 'Release') : [job._sm_preempted_hold__release],
-            ('Preempted_Hold', 'Kill') : [job._sm_preempted_hold__kill],
-            ('Finalize_Retry', 'Progress') : [job._sm_finalize_retry__progress],
-            ('Finalize_Retry', 'Hold') : [job._sm_exit_common__hold],
-            ('Finalize_Retry', 'Release') : [job._sm_exit_common__release],
-            ('Finalize_Retry', 'Preempt') : [job._sm_exit_common__preempt],
-            ('Finalize_Retry', 'Kill') : [job._sm_exit_common__kill],
-            ('Resource_Epilogue', 'Progress') : [job._sm_resource_epilogue__progress],
-            ('Resource_Epilogue', 'Hold') : [job._sm_exit_common__hold],
-            ('Resource_Epilogue', 'Release') : [job._sm_exit_common__release],
-            ('Resource_Epilogue', 'Preempt') : [job._sm_exit_common__preempt],
-            ('Resource_Epilogue', 'Kill') : [job._sm_exit_common__kill],
-            ('Resource_Epilogue_Retry', 'Progress') : [job._sm_resource_epilogue_retry__progress],
-            ('Resource_Epilogue_Retry', 'Hold') : [job._sm_exit_common__hold],
-            ('Resource_Epilogue_Retry', 'Release') : [job._sm_exit_common__release],
-            ('Resource_Epilogue_Retry', 'Preempt') : [job._sm_exit_common__preempt],
-            ('Resource_Epilogue_Retry', 'Kill') : [job._sm_exit_common__kill],
-            ('Job_Epilogue', 'Progress') : [job._sm_job_epilogue__progress],
-            ('Job_Epilogue', 'Hold') : [job._sm_exit_common__hold],
-            ('Job_Epilogue', 'Release') : [job._sm_exit_common__release],
-            ('Job_Epilogue', 'Preempt') : [job._sm_exit_common__preempt],
-            ('Job_Epilogue', 'Kill') : [job._sm_exit_common__kill],
-            ('Job_Epilogue_Retry', 'Progress') : [job._sm_job_epilogue_retry__progress],
-            ('Job_Epilogue_Retry', 'Hold') : [job._sm_exit_common__hold],
-            ('Job_Epilogue_Retry', 'Release') : [job._sm_exit_common__release],
-            ('Job_Epilogue_Retry', 'Preempt') : [job._sm_exit_common__preempt],
-            ('Job_Epilogue_Retry', 'Kill') : [job._sm_exit_common__kill],
+def get_job_sm_actions():
+
+    return {('Ready', 'Run') : ['_sm_ready__run'],
+            ('Ready', 'Hold') : ['_sm_ready__hold'],
+            ('Ready', 'Release') : ['_sm_ready__release'],
+            ('Ready', 'Kill') : ['_sm_ready__kill'],
+            ('Hold', 'Hold') : ['_sm_hold__hold'],
+            ('Hold', 'Release') : ['_sm_hold__release'],
+            ('Hold', 'Kill') : ['_sm_hold__kill'],
+            ('Job_Prologue', 'Progress') : ['_sm_job_prologue__progress'],
+            ('Job_Prologue', 'Hold') : ['_sm_common__pending_hold'], 
+            ('Job_Prologue', 'Release') : ['_sm_common__pending_release'],
+            ('Job_Prologue', 'Preempt') : ['_sm_common__pending_preempt'], #custom?
+            ('Job_Prologue', 'Kill') : ['_sm_common__pending_kill'],
+            ('Job_Prologue_Retry', 'Progress') : ['_sm_job_prologue_retry__progress'],
+            ('Job_Prologue_Retry', 'Hold') : ['_sm_common__pending_hold'],
+            ('Job_Prologue_Retry', 'Release') : ['_sm_common__pending_release'],
+            ('Job_Prologue_Retry', 'Preempt') : ['_sm_common__pending_preempt'], #Must go pending
+            ('Job_Prologue_Retry', 'Kill') : ['_sm_job_prologue_retry__kill'],
+            ('Resource_Prologue', 'Progress') : ['_sm_resource_prologue__progress'],
+            ('Resource_Prologue', 'Hold') : ['_sm_common__pending_hold'],
+            ('Resource_Prologue', 'Release') : ['_sm_common__pending_release'],
+            ('Resource_Prologue', 'Preempt') : ['_sm_common__pending_preempt'], #custom?
+            ('Resource_Prologue', 'Kill') : ['_sm_common__pending_kill'],
+            ('Resource_Prologue_Retry', 'Progress') : ['_sm_job_prologue_retry__progress'],
+            ('Resource_Prologue_Retry', 'Hold') : ['_sm_common__pending_hold'],
+            ('Resource_Prologue_Retry', 'Release') : ['_sm_common__pending_release'],
+            ('Resource_Prologue_Retry', 'Preempt') : ['_sm_common__pending_preempt'], #custom: go directly to preempted?
+            ('Resource_Prologue_Retry', 'Kill') : ['_sm_job_prologue_retry__kill'],
+            ('Release_Resources_Retry', 'Progress') : ['_sm_release_resources_retry__progress'],
+            ('Release_Resources_Retry', 'Hold') : ['_sm_exit_common__hold'],
+            ('Release_Resources_Retry', 'Release') : ['_sm_exit_common__release'],
+            ('Release_Resources_Retry', 'Preempt') : ['_sm_exit_common__preempt'],
+            ('Release_Resources_Retry', 'Kill') : ['_sm_exit_common__kill'],
+            ('Run_Retry', 'Progress') : ['_sm_run_retry__progress'],
+            ('Run_Retry', 'Hold') : ['_sm_common__pending_hold'],
+            ('Run_Retry', 'Release') : ['_sm_common__pending_release'],
+            ('Run_Retry', 'Preempt') : ['_sm_common__pending_preempt'],
+            ('Run_Retry', 'Kill') : ['_sm_run_retry__kill'],
+            ('Running', 'Progress') : ['_sm_running__progress'],
+            ('Running', 'Hold') : ['_sm_common__pending_hold'],
+            ('Running', 'Release') : ['_sm_common__pending_release'],
+            ('Running', 'Preempt') : ['_sm_common__pending_preempt'],
+            ('Running', 'Kill') : ['_sm_running__kill'],
+            ('Running', 'Task_End') : ['_sm_running__task_end'],
+            ('Kill_Retry', 'Progress') : ['_sm_kill_retry__progress'],
+            ('Kill_Retry', 'Hold') : ['_sm_kill_common__hold'],
+            ('Kill_Retry', 'Release') : ['_sm_kill_common__release'],
+            ('Kill_Retry', 'Preempt') : ['_sm_kill_common__preempt'],
+            ('Kill_Retry', 'Kill') : ['_sm_kill_retry__kill'],
+            ('Kill_Retry', 'Task_End') : ['_sm_kill_retry__task_end'],
+            ('Killing', 'Progress') : ['_sm_killing__progress'],
+            ('Killing', 'Hold') : ['_sm_kill_common__hold'],
+            ('Killing', 'Release') : ['_sm_kill_common__release'],
+            ('Killing', 'Preempt') : ['_sm_kill_common__preempt'],
+            ('Killing', 'Kill') : ['_sm_killing__kill'],
+            ('Killing', 'Task_End') : ['_sm_killing__task_end'],
+            ('Preempt_Retry', 'Progress') : ['_sm_preempt_retry__progress'],
+            ('Preempt_Retry', 'Hold') : ['_sm_common__pending_hold'],
+            ('Preempt_Retry', 'Release') : ['_sm_common__pending_release'],
+            ('Preempt_Retry', 'Kill') : ['_sm_preempt_retry__kill'],
+            ('Preempt_Retry', 'Task_End') : ['_sm_preempt_retry__task_end'],
+            ('Preempting', 'Progress') : ['_sm_preempting__progress'],
+            ('Preempting', 'Hold') : ['_sm_common__pending_hold'],
+            ('Preempting', 'Release') : ['_sm_common__pending_release'],
+            ('Preempting', 'Kill') : ['_sm_preempting__kill'],
+            ('Preempting', 'Task_End') : ['_sm_preempting__task_end'],
+            ('Preempt_Finalize_Retry', 'Progress') : ['_sm_preempt_finalize_retry__progress'],
+            ('Preempt_Finalize_Retry', 'Hold') : ['_sm_common__pending_hold'],
+            ('Preempt_Finalize_Retry', 'Release') : ['_sm_common__pending_release'],
+            ('Preempt_Finalize_Retry', 'Kill') : ['_sm_common__pending_kill'],
+            ('Preempt_Epilogue', 'Progress') : ['_sm_preempt_epilogue__progress'],
+            ('Preempt_Epilogue', 'Hold') : ['_sm_common__pending_hold'],
+            ('Preempt_Epilogue', 'Release') : ['_sm_common__pending_release'],
+            ('Preempt_Epilogue', 'Kill') : ['_sm_common__pending_kill'],
+            ('Preempted', 'Run') : ['_sm_preempted__run'],
+            ('Preempted', 'Hold') : ['_sm_preempted__hold'],
+            ('Preempted', 'Release') : ['_sm_preempted__release'],
+            ('Preempted', 'Kill') : ['_sm_preempted__kill'],
+            ('Preempted_Hold', 'Hold') : ['_sm_preempted_hold__hold'],
+            ('Preempted_Hold', 'Release') : ['_sm_preempted_hold__release'],
+            ('Preempted_Hold', 'Kill') : ['_sm_preempted_hold__kill'],
+            ('Finalize_Retry', 'Progress') : ['_sm_finalize_retry__progress'],
+            ('Finalize_Retry', 'Hold') : ['_sm_exit_common__hold'],
+            ('Finalize_Retry', 'Release') : ['_sm_exit_common__release'],
+            ('Finalize_Retry', 'Preempt') : ['_sm_exit_common__preempt'],
+            ('Finalize_Retry', 'Kill') : ['_sm_exit_common__kill'],
+            ('Resource_Epilogue', 'Progress') : ['_sm_resource_epilogue__progress'],
+            ('Resource_Epilogue', 'Hold') : ['_sm_exit_common__hold'],
+            ('Resource_Epilogue', 'Release') : ['_sm_exit_common__release'],
+            ('Resource_Epilogue', 'Preempt') : ['_sm_exit_common__preempt'],
+            ('Resource_Epilogue', 'Kill') : ['_sm_exit_common__kill'],
+            ('Resource_Epilogue_Retry', 'Progress') : ['_sm_resource_epilogue_retry__progress'],
+            ('Resource_Epilogue_Retry', 'Hold') : ['_sm_exit_common__hold'],
+            ('Resource_Epilogue_Retry', 'Release') : ['_sm_exit_common__release'],
+            ('Resource_Epilogue_Retry', 'Preempt') : ['_sm_exit_common__preempt'],
+            ('Resource_Epilogue_Retry', 'Kill') : ['_sm_exit_common__kill'],
+            ('Job_Epilogue', 'Progress') : ['_sm_job_epilogue__progress'],
+            ('Job_Epilogue', 'Hold') : ['_sm_exit_common__hold'],
+            ('Job_Epilogue', 'Release') : ['_sm_exit_common__release'],
+            ('Job_Epilogue', 'Preempt') : ['_sm_exit_common__preempt'],
+            ('Job_Epilogue', 'Kill') : ['_sm_exit_common__kill'],
+            ('Job_Epilogue_Retry', 'Progress') : ['_sm_job_epilogue_retry__progress'],
+            ('Job_Epilogue_Retry', 'Hold') : ['_sm_exit_common__hold'],
+            ('Job_Epilogue_Retry', 'Release') : ['_sm_exit_common__release'],
+            ('Job_Epilogue_Retry', 'Preempt') : ['_sm_exit_common__preempt'],
+            ('Job_Epilogue_Retry', 'Kill') : ['_sm_exit_common__kill'],
             }
 
 class Job (StateMachine):
@@ -541,6 +587,23 @@ class Job (StateMachine):
          
     _initial_state = get_job_sm_initial_state()
     _events = get_job_sm_events() + StateMachine._events
+    _sm_actions = get_job_sm_actions()
+    progress_states = frozenset([state for state, event in _sm_actions if event == 'Progress'])
+
+    # the attributes every job sets live in slots rather than the instance dictionary, which saves several KB per job.
+    # private names are given mangled.  any other attribute is kept in the dictionary as usual.
+    __slots__ = (
+        '_DataState__state', '_StateMachine__event', '_StateMachine__seas', '_StateMachine__terminal_actions',
+        '_Job__admin_hold', '_Job__locations', '_Job__preempts', '_Job__queue', '_Job__resource_nodects',
+        '_Job__timers', '_Job__user_hold', '_Job__walltime',
+        'adminemail', 'all_dependencies', 'args', 'attribute', 'attrs', 'called_has_dep_hold_once', 'cobalt_log_file',
+        'command', 'cwd', 'dep_fail', 'dep_frac', 'endtime', 'envs', 'errorpath', 'etime', 'exit_status',
+        'force_kill_delay', 'host', 'initializing', 'inputfile', 'job_postscript_ids', 'job_prescript_ids', 'jobid',
+        'jobname', 'kernel', 'kerneloptions', 'lienID', 'location', 'max_running', 'mode', 'nodes', 'notify',
+        'outputdir', 'outputpath', 'path', 'port', 'preemptable', 'prev_dep_hold', 'priority_core_hours', 'procs',
+        'project', 'reservation', 'resid', 'resource_postscript_ids', 'resource_prescript_ids', 'runid',
+        'satisfied_dependencies', 'score', 'stageid', 'stagein', 'stageout', 'starttime', 'submittime', 'tag',
+        'task_running', 'taskid', 'total_etime', 'type', 'umask', 'url', 'user', 'user_list', 'walltime_p')
 
     # return codes to improve typo detection.  by using the return codes in condition statements, a typo will result in a key
     # error rather than an incorrectly followed path.
@@ -552,10 +615,9 @@ class Job (StateMachine):
 
     def __init__(self, spec):
         self.initializing = True
-        seas = get_job_sm_seas(self)
 
-        # StateMachine.__init__(self, spec, seas = seas, terminal_actions = [(self._sm_terminal, {})])
-        StateMachine.__init__(self, spec, seas = seas)
+        # StateMachine.__init__(self, spec, terminal_actions = [(self._sm_terminal, {})])
+        StateMachine.__init__(self, spec)
         
         self.jobid = spec.get("jobid")
         self.umask = spec.get("umask")
@@ -692,18 +754,38 @@ class Job (StateMachine):
                 self.has_dep_hold or 
                 self.max_running)
 
+    def trigger_event(self, event, args = {}):
+        '''Run the action routines for the event, noting the job for the state journal'''
+        state = self._sm_state
+        try:
+            StateMachine.trigger_event(self, event, args)
+        finally:
+            # progress events that leave the job in the same state only do bookkeeping that a snapshot captures
+            if event != 'Progress' or self._sm_state != state:
+                journal_job(self)
+                schedule_progress(self)
+                schedule_count(self)
+                notify_watches(self)
+                self.note_change()
+
     def __getstate__(self):
         data = {}
         for key, value in self.__dict__.iteritems():
-            if key not in ['log', 'comms', 'acctlog']:
+            if key not in ['log', 'comms', 'acctlog', '_data_indexes', '_change_logs', '_modified_seq']:
                 data[key] = value
+        for key in self.__slots__:
+            try:
+                data[key] = object.__getattribute__(self, key)
+            except AttributeError:
+                pass
         return data
 
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        for key, value in state.iteritems():
+            object.__setattr__(self, key, value)
         
-        #reset the statemachine's states
-        self.update_seas(get_job_sm_seas(self))
+        #drop the per-job action tables kept by old statefiles; the actions now come from the class
+        self.update_seas(None)
 
         # BRT: why is the current queue timer being reset?  if cqm is 
         #restarted, the job remained in the queue during that time, so I would
@@ -1286,6 +1368,7 @@ class Job (StateMachine):
             self._sm_log_info("%s hold released" % (args['type'],), cobalt_log = True)
             if self.no_holds_left():
                 dbwriter.log_to_db(None, "all_holds_clear", "job_prog", JobProgMsg(self))
+                scheduler_notifier.post()
         else:
             self._sm_log_info("%s hold not present; ignoring release request" % (args['type'],), cobalt_log = True)
             
@@ -1962,7 +2045,7 @@ class Job (StateMachine):
 
         '''
         try:
-            children = ComponentProxy("system_script_forker").get_children(None, script_ids)
+            children = ComponentProxy("system_script_forker").get_children(None, script_ids, True)
         except ComponentLookupError:
             logger.error("Job %s/%s: Could not communicate with "
                         "forker component.", self.user, self.jobid)
@@ -2072,6 +2155,7 @@ class Job (StateMachine):
         self._sm_log_info("task completed normally with an exit code of %s; initiating job cleanup and removal" % \
             (self.exit_status,), cobalt_log = True)
         self._sm_start_resource_epilogue_scripts()
+        scheduler_notifier.post()
 
     def _sm_kill_common__hold(self, args):
         '''attempt to add a hold to a preemptable job that is being killed'''
@@ -2159,6 +2243,7 @@ class Job (StateMachine):
         self._sm_log_info("task completed normally with an exit code of %s; initiating job cleanup and removal" % \
             (self.exit_status,), cobalt_log = True)
         self._sm_start_resource_epilogue_scripts()
+        scheduler_notifier.post()
 
     def _sm_killing__progress(self, args):
         '''check if the signal timer; if it has expired, promote signal to a force kill and signal the task again'''
@@ -2526,6 +2611,7 @@ class Job (StateMachine):
         self._sm_log_info("task completed normally with an exit code of %s; initiating job cleanup and removal" % \
             (self.exit_status,), cobalt_log = True)
         self._sm_start_resource_epilogue_scripts()
+        scheduler_notifier.post()
 
     def _sm_resource_epilogue__progress(self, args):
         '''wait for resource epilogue scripts to complete.  once they have 
@@ -2703,6 +2789,8 @@ class Job (StateMachine):
             self.__max_job_timer.max_time = walltime * 60
         except AttributeError:
             pass
+        schedule_progress(self)
+        schedule_count(self)
         self._sm_log_info("walltime adjusted to %d minutes" % (self.__walltime,))
 
     walltime = property(__get_walltime, __set_walltime)
@@ -2730,7 +2818,7 @@ class Job (StateMachine):
     user_hold = property(__get_user_hold, __set_user_hold)
 
     def __has_dep_hold(self):    
-        current_dep_hold = self.all_dependencies and not set(self.all_dependencies).issubset(set(self.satisfied_dependencies))
+        current_dep_hold = bool(self.all_dependencies) and not set(self.all_dependencies).issubset(set(self.satisfied_dependencies))
         if self.initializing:
             return current_dep_hold
         if ((not self.prev_dep_hold) and current_dep_hold and (not self.called_has_dep_hold_once)):
@@ -2928,6 +3016,28 @@ class Job (StateMachine):
         except:
             self._sm_log_exception(None, "an exception occurred during a progress event")
 
+    def progress_deadline(self):
+        '''
+        return the time at which a progress event next has work to do in the current state.  states whose progress only
+        watches timers return the earliest expiration, or infinity if none can expire.  states that poll other components
+        return None, meaning they must be progressed at every interval.
+        '''
+        if self._sm_state == 'Running':
+            timers = [self.__max_job_timer]
+            if self.preemptable:
+                timers.append(self.__maxtasktimer)
+                if has_private_attr(self, '__signaling_info') and \
+                        self.__signaling_info.reason == Signal_Info.Reason.preempt and self.__signaling_info.pending:
+                    timers.append(self.__mintasktimer)
+        elif self._sm_state in ('Killing', 'Preempting'):
+            timers = [self.__signal_timer]
+        else:
+            return None
+        deadlines = [deadline for deadline in [timer.expiration_time for timer in timers] if deadline != None]
+        if deadlines:
+            return min(deadlines)
+        return float('inf')
+
     def run(self, nodelist, user = None):
         try:
             self.trigger_event("Run", {'nodelist' : nodelist})
@@ -3064,17 +3174,171 @@ class Job (StateMachine):
         self.trigger_event('Task_End')
 
 
+class JobCounts (object):
+    '''
+    Per-user totals over the jobs of a queue, so that queue restrictions can be checked without scanning the queue.
+    The share each job contributes is remembered, so that it can be taken back when the job changes or leaves.
+    '''
+
+    def __init__(self, jobs=()):
+        # jobid -> (user, node hours, holds resources, running nodes)
+        self.shares = {}
+        # user -> the user's jobs, keyed by jobid
+        self.user_jobs = {}
+        # user -> node hours of the user's jobs
+        self.node_hours = {}
+        # user -> number of the user's jobs holding resources
+        self.resource_jobs = {}
+        # user -> nodes of the user's running jobs
+        self.running_nodes = {}
+        self.total_running_nodes = 0
+        # users whose number of jobs holding resources changed, or who have new jobs, since max_running was last set
+        self.dirty_users = set()
+        # the maxrunning limit max_running was last set for
+        self.max_running_limit = None
+        # user -> number and node hours of the specs accepted so far in a batch of jobs being added (see
+        # QueueDict.add_jobs)
+        self.batch_jobs = {}
+        self.batch_node_hours = {}
+        for job in jobs:
+            self.add(job)
+
+    def __len__(self):
+        return len(self.shares)
+
+    def __node_hours(self, walltime, nodes):
+        try:
+            return float(walltime) / 60.0 * int(nodes)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def __share(self, job):
+        node_hours = self.__node_hours(job.walltime, job.nodes)
+        running_nodes = 0
+        if job._sm_state == 'Running':
+            try:
+                running_nodes = int(job.nodes)
+            except (TypeError, ValueError):
+                pass
+        return (job.user, node_hours, job.has_resources, running_nodes)
+
+    def __apply(self, share, sign):
+        user, node_hours, has_resources, running_nodes = share
+        self.node_hours[user] = self.node_hours.get(user, 0.0) + sign * node_hours
+        if has_resources:
+            self.resource_jobs[user] = self.resource_jobs.get(user, 0) + sign
+            if not self.resource_jobs[user]:
+                del self.resource_jobs[user]
+        if running_nodes:
+            self.running_nodes[user] = self.running_nodes.get(user, 0) + sign * running_nodes
+            if not self.running_nodes[user]:
+                del self.running_nodes[user]
+            self.total_running_nodes += sign * running_nodes
+
+    def add(self, job):
+        '''count a job added to the queue'''
+        if job.jobid in self.shares:
+            return
+        share = self.__share(job)
+        self.shares[job.jobid] = share
+        self.user_jobs.setdefault(job.user, {})[job.jobid] = job
+        self.__apply(share, 1)
+        self.dirty_users.add(job.user)
+
+    def remove(self, job):
+        '''stop counting a job removed from the queue'''
+        share = self.shares.pop(job.jobid, None)
+        if share is None:
+            return
+        user = share[0]
+        self.__apply(share, -1)
+        del self.user_jobs[user][job.jobid]
+        if not self.user_jobs[user]:
+            # drop the user's rounding residue along with the user
+            del self.user_jobs[user]
+            self.node_hours.pop(user, None)
+        if share[2]:
+            self.dirty_users.add(user)
+
+    def add_batch_spec(self, spec):
+        '''count a spec accepted earlier in a batch of jobs being added, so that later specs are checked against it'''
+        user = spec.get('user')
+        self.batch_jobs[user] = self.batch_jobs.get(user, 0) + 1
+        self.batch_node_hours[user] = self.batch_node_hours.get(user, 0.0) + \
+            self.__node_hours(spec.get('walltime'), spec.get('nodes'))
+
+    def clear_batch(self):
+        '''forget the specs of a batch once its jobs are added or it is rejected'''
+        self.batch_jobs.clear()
+        self.batch_node_hours.clear()
+
+    def update(self, job):
+        '''recount a job whose state, walltime or size may have changed; jobs not counted are ignored'''
+        old = self.shares.get(job.jobid)
+        if old is None:
+            return
+        new = self.__share(job)
+        if new == old:
+            return
+        self.__apply(old, -1)
+        self.__apply(new, 1)
+        self.shares[job.jobid] = new
+        if new[2] != old[2]:
+            self.dirty_users.add(job.user)
+
+
 class JobList(DataList):
     item_cls = Job
+    # state and the other job status fields are computed from the state machine, so only fields that are assigned
+    # directly can be indexed
+    indexed_fields = ['jobid']
     
     def __init__(self, q):
         self.queue = q
         self.id_gen = cqm_id_gen
+
+    def __getstate__ (self):
+        state = DataList.__getstate__(self)
+        state.pop('_counts', None)
+        return state
+
+    def _get_counts (self):
+        """Return the job counts of the queue, bringing them up to date with the jobs changed since they were last used."""
+        counts = self.__dict__.get('_counts')
+        pending = counts_pending.pop(self.queue.name, None)
+        if counts is None or len(counts) != len(self):
+            # (re)build the counts if the list has changed behind their back
+            counts = JobCounts(self)
+            self.__dict__['_counts'] = counts
+        elif pending:
+            for job in pending.itervalues():
+                counts.update(job)
+        return counts
+
+    counts = property(_get_counts)
+
+    def _index_add (self, items):
+        DataList._index_add(self, items)
+        counts = self.__dict__.get('_counts')
+        if counts is not None:
+            for job in items:
+                counts.add(job)
+
+    def _index_remove (self, items):
+        DataList._index_remove(self, items)
+        counts = self.__dict__.get('_counts')
+        pending = counts_pending.get(self.queue.name)
+        for job in items:
+            if counts is not None:
+                counts.remove(job)
+            if pending:
+                pending.pop(job.jobid, None)
     
     def q_add (self, specs, callback = None, cargs = {}):
-        for spec in specs:
-            if "jobid" not in spec or spec['jobid'] == "*":
-                spec['jobid'] = self.id_gen.next()
+        # reserve the ids for the whole batch at once
+        unnumbered = [spec for spec in specs if "jobid" not in spec or spec['jobid'] == "*"]
+        for spec, jobid in zip(unnumbered, self.id_gen.reserve(len(unnumbered))):
+            spec['jobid'] = jobid
         jobs_added = DataList.q_add(self, specs, callback, cargs)
         if jobs_added:
             user = spec.get('user', None)
@@ -3141,28 +3405,28 @@ class Restriction (Data):
     def maxuserjobs(self, job, queuestate=None):
         '''limits how many jobs each user can run by checking queue state
         with potential job added'''
-        userjobs = [j for j in queuestate if j.user == job.user and j.has_resources and j.queue == job['queue']]
-        if len(userjobs) >= int(self.value):
+        if queuestate is None:
+            userjobs = self.queue.jobs.counts.resource_jobs.get(job['user'], 0)
+        else:
+            userjobs = len([j for j in queuestate if j.user == job.user and j.has_resources and j.queue == job['queue']])
+        if userjobs >= int(self.value):
             return (False, "Maxuserjobs limit reached")
         else:
             return (True, "")
 
     def maxqueuedjobs(self, job, _=None):
         '''limits how many jobs a user can have in the queue at a time'''
-        userjobs = [j for j in self.queue.jobs if j.user == job['user']]
-        if len(userjobs) >= int(self.value):
+        counts = self.queue.jobs.counts
+        userjobs = len(counts.user_jobs.get(job['user'], ())) + counts.batch_jobs.get(job['user'], 0)
+        if userjobs >= int(self.value):
             return (False, "The limit of %s jobs per user in the '%s' queue has been reached" % (self.value, job['queue']))
         else:
             return (True, "")
 
     def maxnodehours(self, job, _=None):
         '''limits how many node hours a user can have in the queue at a time'''
-        userjobs = [j for j in self.queue.jobs if j.user == job['user']]
-        
-        total = 0.0
-        for j in userjobs:
-            total += float(j.walltime)/60.0 * int(j.nodes)
-            
+        counts = self.queue.jobs.counts
+        total = counts.node_hours.get(job['user'], 0.0) + counts.batch_node_hours.get(job['user'], 0.0)
         total += float(job['walltime'])/60.0 * int(job['nodes'])
 
         if total > float(self.value):
@@ -3173,11 +3437,14 @@ class Restriction (Data):
 
     def maxusernodes(self, job, queuestate=None):
         '''limits how many nodes a single user can have running'''
-        usernodes = 0
-        for j in [qs for qs in queuestate if qs.user == job['user']
-                  and qs.state == 'running'
-                  and qs.queue == job.queue]:
-            usernodes = usernodes + int(j.nodes)
+        if queuestate is None:
+            usernodes = self.queue.jobs.counts.running_nodes.get(job['user'], 0)
+        else:
+            usernodes = 0
+            for j in [qs for qs in queuestate if qs.user == job['user']
+                      and qs.state == 'running'
+                      and qs.queue == job.queue]:
+                usernodes = usernodes + int(j.nodes)
         if usernodes + int(job['nodes']) > int(self.value):
             return (False, "Job exceeds MaxUserNodes limit")
         else:
@@ -3186,10 +3453,13 @@ class Restriction (Data):
     def maxtotalnodes(self, job, queuestate=None):
         '''limits how many total nodes can be used by jobs running in
         this queue'''
-        totalnodes = 0
-        for j in [qs for qs in queuestate if qs.state == 'running'
-                  and qs.queue == job['queue']]:
-            totalnodes = totalnodes + int(j.nodes)
+        if queuestate is None:
+            totalnodes = self.queue.jobs.counts.total_running_nodes
+        else:
+            totalnodes = 0
+            for j in [qs for qs in queuestate if qs.state == 'running'
+                      and qs.queue == job['queue']]:
+                totalnodes = totalnodes + int(j.nodes)
         if totalnodes + int(job['nodes']) > int(self.value):
             return (False, "Job exceeds MaxTotalNodes limit")
         else:
@@ -3282,41 +3552,38 @@ class Queue (Data):
 
     def update_max_running(self):
         '''In order to keep the max_running property of jobs up to date, this function needs
-        to be called when a job starts running, or a new job appears in a queue.'''
+        to be called when a job starts running, or a new job appears in a queue.
+
+        Only the jobs of users whose number of jobs holding resources changed, or who have new jobs, are visited, unless
+        the maxrunning restriction itself changed.'''
         
-        if not self.restrictions.has_key("maxrunning"):
-            # if it *was* there and was removed, we better clean up
-            for job in self.jobs:
-                if job.max_running:
-                    logger.info("Job %s/%s: max_running set to False", job.jobid, job.user)
-                    dbwriter.log_to_db(None, "maxrun_hold_release", "job_prog", JobProgMsg(job))
-
-                    if job.no_holds_left():
-                        dbwriter.log_to_db(None, "all_holds_clear", "job_prog", JobProgMsg(job))
-                job.max_running = False
-                
-            return
-        unum = dict()
-        for job in self.jobs.q_get([{'has_resources':True}]):
-            if job.user not in unum:
-                unum[job.user] = 1
-            else:
-                unum[job.user] = unum[job.user] + 1
-
-        for job in self.jobs:
-            old = job.max_running
-            job.max_running = False
-            if unum.get(job.user, 0) >= int(self.restrictions["maxrunning"].value):
-                if not job.has_resources:
-                    job.max_running = True
-            if old != job.max_running:
-                logger.info("Job %s/%s: max_running set to %s", job.jobid, job.user, job.max_running)
-                if job.max_running:
-                    dbwriter.log_to_db(None, "maxrun_hold", "job_prog", JobProgMsg(job))
-                else:
-                    dbwriter.log_to_db(None, "maxrun_hold_release", "job_prog", JobProgMsg(job))
-                    if job.no_holds_left():
-                        dbwriter.log_to_db(None, "all_holds_clear", "job_prog", JobProgMsg(job))
+        counts = self.jobs.counts
+        if self.restrictions.has_key("maxrunning"):
+            limit = int(self.restrictions["maxrunning"].value)
+        else:
+            # if it *was* there and was removed, every job held by it is released below
+            limit = None
+        if limit != counts.max_running_limit:
+            users = counts.user_jobs.keys()
+            counts.max_running_limit = limit
+        else:
+            users = counts.dirty_users
+        counts.dirty_users = set()
+
+        for user in users:
+            held = limit is not None and counts.resource_jobs.get(user, 0) >= limit
+            for job in counts.user_jobs.get(user, {}).values():
+                old = job.max_running
+                job.max_running = held and not job.has_resources
+                if old != job.max_running:
+                    notify_watches(job)
+                    logger.info("Job %s/%s: max_running set to %s", job.jobid, job.user, job.max_running)
+                    if job.max_running:
+                        dbwriter.log_to_db(None, "maxrun_hold", "job_prog", JobProgMsg(job))
+                    else:
+                        dbwriter.log_to_db(None, "maxrun_hold_release", "job_prog", JobProgMsg(job))
+                        if job.no_holds_left():
+                            dbwriter.log_to_db(None, "all_holds_clear", "job_prog", JobProgMsg(job))
                 
 class QueueDict(DataDict):
     item_cls = Queue
@@ -3331,12 +3598,10 @@ class QueueDict(DataDict):
     def can_queue(self, spec):
         '''Check that job meets criteria of the specified queue'''
         # if queue doesn't exist, don't check other restrictions
-        if spec['queue'] not in [q.name for q in self.itervalues()]:
+        if spec['queue'] not in self:
             raise QueueError, "Queue '%s' does not exist" % spec['queue']
 
-        [testqueue] = [q for q in self.itervalues() if q.name == spec['queue']]
-
-        return testqueue.can_queue(spec)
+        return self[spec['queue']].can_queue(spec)
 
     def del_queues(self, specs, callback=None, cargs={}):
         return self.q_del(specs, callback, cargs)
@@ -3345,21 +3610,34 @@ class QueueDict(DataDict):
         queue_names = self.keys()
         
         failed = False
-        for spec in specs:
-            if spec['queue'] not in queue_names:
-                logger.error("trying to add job to non-existant queue %s" % spec['queue'])
-                failed = True
-            if not self.can_queue(spec)[0]:
-                logger.error("job %r cannot be added to queue" % spec)
-                failed = True
+        batch_counts = set()
+        try:
+            for spec in specs:
+                if spec['queue'] not in queue_names:
+                    logger.error("trying to add job to non-existant queue %s" % spec['queue'])
+                    failed = True
+                if not self.can_queue(spec)[0]:
+                    logger.error("job %r cannot be added to queue" % spec)
+                    failed = True
+                # each spec is checked against the queue's jobs together with the specs before it in the batch
+                counts = self[spec['queue']].jobs.counts
+                counts.add_batch_spec(spec)
+                batch_counts.add(counts)
+        finally:
+            for counts in batch_counts:
+                counts.clear_batch()
         results = []
         if failed:
             return results
         
-        # we know all of the queues exist, so add the jobs to the appropriate JobList
-        for spec in specs:
-            results += self[spec['queue']].jobs.q_add([spec], callback, cargs)
-            self[spec['queue']].update_max_running()
+        # we know all of the queues exist, so add the jobs to the appropriate JobList, each run of specs for the same
+        # queue at once
+        for queue_name, queue_specs in itertools.groupby(specs, lambda spec: spec['queue']):
+            results += self[queue_name].jobs.q_add(list(queue_specs), callback, cargs)
+        # the new jobs are counted as they are added, so each queue's max_running holds need only be brought up to date
+        # once
+        for queue_name in set([spec['queue'] for spec in specs]):
+            self[queue_name].update_max_running()
             
         return results
     
@@ -3409,6 +3687,15 @@ class QueueManager(Component):
         self.define_user_utility_functions()
 
         self.score_timestamp = None
+        self.dependents = {}
+
+        global journaled_jobs
+        journaled_jobs = None
+        self.journal = None
+        self.journal_generation = 0
+        self._reset_progress_schedule()
+        self.snapshot_time = 0
+        self.snapshot_due = False
         
         if dbwriter.enabled:
             logger.info("Logging to cdbwriter enabled.")
@@ -3429,8 +3716,9 @@ class QueueManager(Component):
                 'Queues':self.Queues,
                 'next_job_id':self.id_gen.idnum+1,
                 'next_run_id':self.run_id_gen.idnum+1,
-                'msg_queue':dbwriter.msg_queue,
-                'overflow': dbwriter.overflow})
+                'msg_queue':list(dbwriter.msg_queue),
+                'overflow': dbwriter.overflow,
+                'journal_generation':self.journal_generation})
         return state
 
     def __setstate__(self, state):
@@ -3461,6 +3749,16 @@ class QueueManager(Component):
         self.define_user_utility_functions()
 
         self.score_timestamp = None
+        self._build_dependency_graph()
+        self.check_dep_fail()
+
+        global journaled_jobs
+        journaled_jobs = None
+        self.journal = None
+        self.journal_generation = state.get('journal_generation', 0)
+        self._reset_progress_schedule()
+        self.snapshot_time = 0
+        self.snapshot_due = False
         
         if dbwriter.enabled:
             logger.info("Logging to database enabled.")
@@ -3480,17 +3778,203 @@ class QueueManager(Component):
 
 
     def __save_me(self):
-        Component.save(self)
+        if state_journal_enabled:
+            self._save_state()
+        else:
+            Component.save(self)
     __save_me = automatic(__save_me, float(get_cqm_config('save_me_interval', 10)))
 
+    def _save_state(self):
+        '''Append the jobs changed since the last save to the state journal, or write a snapshot if one is due'''
+        if not self.statefile:
+            return
+        if (self.journal is None or self.snapshot_due or self.journal.size >= journal_max_size or
+                time.time() - self.snapshot_time >= snapshot_interval):
+            self._snapshot()
+        else:
+            self._flush_journal()
+
+    def _snapshot(self):
+        '''Write the whole queue manager to the statefile and start an empty journal after it'''
+        global journaled_jobs
+        self.journal_generation += 1
+        try:
+            self._write_state(self.statefile)
+        except (IOError, OSError), e:
+            # the previous snapshot and its journal remain valid, so keep adding to them
+            logger.error("statefile failure : %s" % e)
+            self.journal_generation -= 1
+            if self.journal is not None:
+                self._flush_journal()
+            return
+        self.snapshot_time = time.time()
+        self.snapshot_due = False
+        self.journaled_ids = (self.id_gen.idnum, self.run_id_gen.idnum)
+        self.journaled_msgs = False
+        if not state_journal_enabled:
+            return
+        journaled_jobs = {}
+        try:
+            if self.journal is None:
+                self.journal = StateJournal(self.statefile + ".journal")
+            self.journal.start(self.journal_generation)
+        except (IOError, OSError), e:
+            # the journal left on disk follows an older snapshot and will be ignored; retry on the next save
+            logger.error("state journal failure : %s" % e)
+            self.journal = None
+
+    def _flush_journal(self):
+        '''Append records of the jobs changed since the last save to the state journal'''
+        records = []
+        for jobid, job in journaled_jobs.iteritems():
+            if not job.has_completed and self._holds_job(job):
+                records.append(('job', job))
+            else:
+                records.append(('del', jobid))
+        ids = (self.id_gen.idnum, self.run_id_gen.idnum)
+        if ids != self.journaled_ids:
+            records.append(('ids',) + ids)
+        if dbwriter.msg_queue or self.journaled_msgs:
+            records.append(('msg_queue', list(dbwriter.msg_queue)))
+        if not records:
+            return
+        try:
+            self.journal.append(records, self._persistent_id)
+        except (IOError, OSError), e:
+            logger.error("state journal failure : %s" % e)
+            self.snapshot_due = True
+            return
+        journaled_jobs.clear()
+        self.journaled_ids = ids
+        self.journaled_msgs = bool(dbwriter.msg_queue)
+
+    def _holds_job(self, job):
+        '''Determine if the job is still held by its queue'''
+        queue = self.Queues.get(job.queue)
+        return queue is not None and [j for j in queue.jobs.q_get([{'jobid':job.jobid}]) if j is job] != []
+
+    def _persistent_id(self, obj):
+        # jobs hold the queue manager's terminal action, which must not drag the whole component into each record
+        if obj is self:
+            return "queue-manager"
+        return None
+
+    def _persistent_load(self, persistent_id):
+        if persistent_id == "queue-manager":
+            return self
+        raise cPickle.UnpicklingError("unknown persistent id %r in state journal" % (persistent_id,))
+
+    def recover(self):
+        '''Replay the state journal written since the statefile's snapshot'''
+        journal = StateJournal(self.statefile + ".journal")
+        if not state_journal_enabled and not os.path.exists(journal.path):
+            return
+        records = journal.read(self.journal_generation, self._persistent_load)
+        if records:
+            logger.info("replaying %d records from %s", len(records), journal.path)
+        for record in records:
+            if record[0] == 'job':
+                job = record[1]
+                self.Queues.del_jobs([{'jobid':job.jobid}])
+                if job.queue in self.Queues:
+                    self.Queues[job.queue].jobs.append(job)
+                else:
+                    logger.error("Job %s/%s: journaled in non-existent queue %s; dropping it", job.jobid, job.user,
+                            job.queue)
+            elif record[0] == 'del':
+                self.Queues.del_jobs([{'jobid':record[1]}])
+            elif record[0] == 'ids':
+                self.id_gen.idnum = max(self.id_gen.idnum, record[1])
+                self.run_id_gen.idnum = max(self.run_id_gen.idnum, record[2])
+            elif record[0] == 'msg_queue':
+                dbwriter.msg_queue = record[1]
+        if records:
+            self._build_dependency_graph()
+            self.check_dep_fail()
+            for queue in self.Queues.itervalues():
+                queue.update_max_running()
+        if state_journal_enabled:
+            # fold the replayed changes into a fresh snapshot so the journal starts over
+            self.journal = journal
+            self._snapshot()
+            return
+        # journaling has been turned off since the journal was written; fold it into the statefile and remove it, so
+        # that it is not replayed over newer state should journaling be turned back on
+        try:
+            self._write_state(self.statefile)
+            os.remove(journal.path)
+        except (IOError, OSError), e:
+            logger.error("statefile failure : %s" % e)
+
 
     def __flush_msg_queue(self):
         dbwriter.flush_queue()
     __flush_msg_queue = automatic(__flush_msg_queue, float(get_cqm_config('db_flush_interval', 10)))
         
+    def _reset_progress_schedule(self):
+        '''Rebuild the progress schedule from every queued job on the next progress pass'''
+        # jobs in states that poll other components, keyed by jobid
+        self.progress_polled = None
+        # deadline and job of each job in a timer-driven state, keyed by jobid; the heap holds (deadline, jobid) and
+        # may hold stale entries, which are skipped when their deadline no longer matches
+        self.progress_deadlines = {}
+        self.progress_heap = []
+
+    def _schedule_progress(self, job):
+        '''Place a job in the progress schedule according to its current state'''
+        jobid = job.jobid
+        self.progress_polled.pop(jobid, None)
+        self.progress_deadlines.pop(jobid, None)
+        if job._sm_state not in Job.progress_states or not self._holds_job(job):
+            return
+        deadline = job.progress_deadline()
+        if deadline is None:
+            self.progress_polled[jobid] = job
+        elif deadline != float('inf'):
+            self.progress_deadlines[jobid] = (deadline, job)
+            heapq.heappush(self.progress_heap, (deadline, jobid))
+
+    def _update_progress_schedule(self):
+        '''Reconsider the jobs noted by schedule_progress since the last pass'''
+        global progress_pending
+        pending = progress_pending
+        progress_pending = {}
+        if self.progress_polled is None:
+            self.progress_polled = {}
+            pending = dict([(job.jobid, job) for queue in self.Queues.itervalues() for job in queue.jobs])
+        for job in pending.itervalues():
+            self._schedule_progress(job)
+        if len(self.progress_heap) > 2 * len(self.progress_deadlines) + 100:
+            self.progress_heap = [(deadline, jobid) for jobid, (deadline, job) in self.progress_deadlines.iteritems()]
+            heapq.heapify(self.progress_heap)
+
     def __progress(self):
         '''Process asynchronous job work'''
-        [job.progress() for queue in self.Queues.itervalues() for job in queue.jobs]
+        # only jobs whose state has a progress action are visited: those polling other components at every pass, and
+        # those watching timers once their earliest deadline has passed
+        self._update_progress_schedule()
+        now = time.time()
+        jobs = self.progress_polled.values()
+        while self.progress_heap and self.progress_heap[0][0] <= now:
+            deadline, jobid = heapq.heappop(self.progress_heap)
+            entry = self.progress_deadlines.get(jobid)
+            if entry is not None and entry[0] == deadline:
+                del self.progress_deadlines[jobid]
+                jobs.append(entry[1])
+                schedule_progress(entry[1])
+        jobs.sort(key = lambda job: job.jobid)
+        for job in jobs:
+            if self._holds_job(job):
+                job.progress()
+            else:
+                self.progress_polled.pop(job.jobid, None)
+        self._update_progress_schedule()
+
+        # wake ahead of the next pass when a timer expires sooner; one already past waits for the next pass
+        if self.progress_heap:
+            delay = self.progress_heap[0][0] - time.time()
+            if 0 < delay < self.__progress.automatic_period:
+                self.trigger_automatic('_QueueManager__progress', delay)
 
         # enforce the maxrunning queue attribute (HACK ALERT)
         for queue in self.Queues.itervalues():
@@ -3499,6 +3983,7 @@ class QueueManager(Component):
         for (name, q) in self.Queues.items():
             if q.state == 'dead' and q.name.startswith('R.') and not q.jobs:
                 del self.Queues[name]
+                self.snapshot_due = True
 
         return 1
 
@@ -3546,10 +4031,14 @@ class QueueManager(Component):
         #
         # NOTE: this assumes that the system component will return a non-zero exit status if the task was killed by a signal.
         # 'None' is considered to be non-zero and thus would be a valid exit status if the task was terminated.
+        waiting_jobs = list(self.dependents.get(str(job.jobid), ()))
         if job.exit_status == 0:
-            for waiting_job in self.Queues.get_jobs([{'state':"dep_hold"}]):
-                if str(job.jobid) in waiting_job.all_dependencies:
+            for waiting_job in waiting_jobs:
+                if str(job.jobid) not in waiting_job.satisfied_dependencies:
                     waiting_job.satisfied_dependencies.append(str(job.jobid))
+                    journal_job(waiting_job)
+                    waiting_job.note_change()
+                    notify_watches(waiting_job)
                     
                     if set(waiting_job.all_dependencies).issubset(
                             set(waiting_job.satisfied_dependencies)):
@@ -3577,6 +4066,12 @@ class QueueManager(Component):
         # could "job.queue.jobs.remove(job)" be used instead or would that make an inappropriate assumption about the
         # implementation of the JobList/DataList?
         self.Queues[job.queue].jobs.q_del([{'jobid':job.jobid}])
+        journal_job(job)
+        notify_watches(job)
+        self._remove_dependency_edges(job, job.all_dependencies)
+
+        # jobs still waiting on this one can no longer have it satisfied
+        self._update_dep_fail(waiting_jobs)
 
         # update state of jobs held because the user exceeded the maximum number of running jobs allowed by the queue
         self.Queues[job.queue].update_max_running()
@@ -3637,23 +4132,29 @@ class QueueManager(Component):
         
         return Ap
         
-    def get_walltime_p(self, spec):
+    def get_walltime_p(self, spec, ap_cache=None):
         '''get predicted walltime provided with user estimated walltime'''  #*AdjEst*
-        ap = self.get_walltime_Ap(spec)
+        # a batch of jobs shares one lookup of the adjusting parameter for each (user, project)
+        key = (spec.get('user'), spec.get('project'))
+        if ap_cache is not None and ap_cache.has_key(key):
+            ap = ap_cache[key]
+        else:
+            ap = self.get_walltime_Ap(spec)
+            if ap_cache is not None:
+                ap_cache[key] = ap
         walltime_p = int(spec.get('walltime')) * ap
         return walltime_p
 
     def add_jobs(self, specs):
         '''Add a job, throws in adminemail'''
 
-        queue_names = self.Queues.keys()
-        
         failed = False
+        ap_cache = {}
         for spec in specs:
             if spec['queue'] in self.Queues:
                 spec.update({'adminemail':self.Queues[spec['queue']].adminemail})
                 if walltime_prediction_enabled:
-                    spec['walltime_p'] = self.get_walltime_p(spec)        #*AdjEst*
+                    spec['walltime_p'] = self.get_walltime_p(spec, ap_cache)        #*AdjEst*
                 else:
                     if spec.has_key('walltime'):
                         spec['walltime_p'] = spec['walltime']
@@ -3664,13 +4165,89 @@ class QueueManager(Component):
         if failed:
             raise QueueError, failure_msg
         
-        response = self.Queues.add_jobs(specs, self.__add_job_terminal_action)
+        # the messages for the new jobs go to cdbwriter in batches once they are all created
+        dbwriter.hold()
+        try:
+            response = self.Queues.add_jobs(specs, self.__add_job_terminal_action)
+        finally:
+            dbwriter.release()
+        affected = set(response)
+        for job in response:
+            journal_job(job)
+            self._add_dependency_edges(job)
+            # a job waiting on an id that did not exist yet may be waiting on this one
+            affected.update(self.dependents.get(str(job.jobid), ()))
+        self._update_dep_fail(affected)
+        scheduler_notifier.post()
         return response
     add_jobs = exposed(query(add_jobs))
 
     def get_jobs(self, specs):
         return self.Queues.get_jobs(specs)
-    get_jobs = exposed(query(get_jobs))
+    get_jobs = exposed(readonly(query(get_jobs, options=True)))
+
+    def get_jobs_since(self, seq, fields):
+        """Return the jobs changed or deleted since seq (see Cobalt.Data.changes_since)."""
+        # the jobs of a deleted queue are not remembered by the change logs of the queues left, so the caller must
+        # start over
+        queue_changes = self.Queues.change_log.since(seq)
+        full = queue_changes is None or bool(queue_changes[1])
+        return changes_since([queue.jobs.change_log for queue in self.Queues.itervalues()], seq, 'jobid', fields, full)
+    get_jobs_since = exposed(get_jobs_since)
+
+    def _jobs_in_states(self, jobids, states):
+        """Return the jobid and state of each of the jobs in one of states; a job no longer queued is "done"."""
+        jobs = dict([(job.jobid, job) for job in self.Queues.get_jobs([{'tag':"job", 'jobid':jobid} for jobid in jobids])])
+        ready = []
+        for jobid in jobids:
+            job = jobs.get(jobid)
+            if job is None:
+                state = "done"
+            else:
+                state = job.state
+            if state in states:
+                ready.append({'jobid':jobid, 'state':state})
+        return ready
+
+    def wait_for_jobs(self, jobids, states, timeout):
+        """Wait until any of the jobs is in one of the states, or for timeout seconds.
+
+        jobids -- the jobs to watch
+        states -- the job states (as reported by the state field) to wait for; a job no longer in the queue is "done"
+        timeout -- the most seconds to wait, limited to the max_job_wait cqm option
+
+        Returns a list of dictionaries holding the jobid and state of each watched job in one of the states, which is
+        empty if the timeout passed first.  The call returns at once if a job is already in one of the states.
+        """
+        deadline = time.time() + min(timeout, max_job_wait)
+        watch = Event()
+        self.component_lock_acquire()
+        try:
+            for jobid in jobids:
+                job_watches.setdefault(jobid, []).append(watch)
+            try:
+                while True:
+                    # the watch is set by state changes made under the component lock, so none is missed between the
+                    # check and the wait
+                    watch.clear()
+                    ready = self._jobs_in_states(jobids, states)
+                    remaining = deadline - time.time()
+                    if ready or remaining <= 0:
+                        return ready
+                    self.component_lock_release()
+                    try:
+                        watch.wait(remaining)
+                    finally:
+                        self.component_lock_acquire()
+            finally:
+                for jobid in jobids:
+                    watches = job_watches[jobid]
+                    watches.remove(watch)
+                    if not watches:
+                        del job_watches[jobid]
+        finally:
+            self.component_lock_release()
+    wait_for_jobs = exposed(locking(wait_for_jobs))
 
     def set_jobs(self, specs, updates, user_name=None):
         joblist = self.Queues.get_jobs(specs)
@@ -3728,6 +4305,7 @@ class QueueManager(Component):
                 only_hold = True
 
             elif self.Queues[test["queue"]].can_queue(test):
+                old_dependencies = job.all_dependencies
                 job.update(updates)
                 if updates.has_key("all_dependencies"):
                     if job.all_dependencies:
@@ -3735,7 +4313,9 @@ class QueueManager(Component):
                     else:
                         message = "[]"
                     logger.info("Job %s/%s: dependencies set to %s", job.jobid, job.user, message) 
-                self.check_dep_fail()
+                    self._remove_dependency_edges(job, old_dependencies)
+                    self._add_dependency_edges(job)
+                self._update_dep_fail([job])
 
                 # only do this if the new queue can accept this job
                 if new_q_name:
@@ -3745,6 +4325,10 @@ class QueueManager(Component):
                     new_q.update_max_running()
                 if not only_hold:
                     dbwriter.log_to_db(user_name, "modifying", "job_data", JobDataMsg(job))
+            journal_job(job)
+            schedule_count(job)
+            # a change of dependencies may put the job in or out of dep_hold without a state machine event
+            notify_watches(job)
 
         return joblist    
     set_jobs = exposed(query(set_jobs))
@@ -3792,12 +4376,18 @@ class QueueManager(Component):
     def add_queues(self, specs, user_name=None):
         if user_name:
             logger.info("%s adding queue %s", user_name, specs)
+        self.snapshot_due = True
         return self.Queues.add_queues(specs)
     add_queues = exposed(query(add_queues))
     
     def get_queues(self, specs):
         return self.Queues.get_queues(specs)
-    get_queues = exposed(query(get_queues))
+    get_queues = exposed(readonly(query(get_queues, options=True)))
+
+    def get_queues_since(self, seq, fields):
+        """Return the queues changed or deleted since seq (see Cobalt.Data.changes_since)."""
+        return changes_since([self.Queues.change_log], seq, 'name', fields)
+    get_queues_since = exposed(get_queues_since)
 
     def can_queue(self, job_spec):
         return self.Queues.can_queue(job_spec)
@@ -3821,14 +4411,23 @@ class QueueManager(Component):
                     elif newattr[key] is not None:
                         queue.restrictions[key] = Restriction({'name':key, 'value':newattr[key]}, queue)
         logger.info("%s calling set_queues on %s with updates %s", user_name, specs, updates)
+        self.snapshot_due = True
         return self.Queues.get_queues(specs, _setQueues, updates)
     set_queues = exposed(query(set_queues))
 
     def del_queues(self, specs, force=False, user_name=None):
         '''Delete queue(s), but check if there are still jobs in the queue'''
+        self.snapshot_due = True
         if force:
             logger.info("%s requested force delete of queue %s", user_name, specs)
-            return self.Queues.del_queues(specs)
+            response = self.Queues.del_queues(specs)
+            waiting_jobs = set()
+            for queue in response:
+                for job in queue.jobs:
+                    self._remove_dependency_edges(job, job.all_dependencies)
+                    waiting_jobs.update(self.dependents.get(str(job.jobid), ()))
+            self._update_dep_fail(waiting_jobs)
+            return response
 
         logger.info("%s requested delete of queue %s", user_name, specs)
         queues = self.Queues.get_queues(specs)
@@ -3920,6 +4519,7 @@ class QueueManager(Component):
                 job.score = delta
             else:
                 job.score += delta
+            journal_job(job)
             results.append(job.jobid)
         dbwriter.log_to_db(user_name, "modifying", "job_data", JobDataMsg(job))
                                     
@@ -4015,10 +4615,36 @@ class QueueManager(Component):
 
     compute_utility_scores = automatic(compute_utility_scores, float(get_cqm_config('compute_utility_interval', 10)))
     
+    def _build_dependency_graph(self):
+        """Index every job by the jobids it depends on."""
+        self.dependents = {}
+        for job in self.Queues.get_jobs([{'jobid':'*'}]):
+            self._add_dependency_edges(job)
+
+    def _add_dependency_edges(self, job):
+        for dep in job.all_dependencies:
+            self.dependents.setdefault(dep, set()).add(job)
+
+    def _remove_dependency_edges(self, job, dependencies):
+        for dep in dependencies:
+            waiting_jobs = self.dependents.get(dep)
+            if waiting_jobs is not None:
+                waiting_jobs.discard(job)
+                if not waiting_jobs:
+                    del self.dependents[dep]
+
     def check_dep_fail(self):
-        queued_jobs = self.Queues.get_jobs([{'jobid': '*'}])
+        """Recompute dep_fail for every job.
+
+        The dependency graph keeps dep_fail current as jobs are added, changed and removed, so this is only needed
+        when the graph is rebuilt.
+        """
+        self._update_dep_fail(self.Queues.get_jobs([{'jobid': '*'}]))
+
+    def _update_dep_fail(self, jobs):
+        """Set dep_fail on jobs that depend on a job that is no longer queued."""
         already_failed = False
-        for job in queued_jobs:
+        for job in jobs:
             already_failed = job.dep_fail
             job.dep_fail = False
             pending = set(job.all_dependencies).difference(set(job.satisfied_dependencies))
@@ -4032,13 +4658,14 @@ class QueueManager(Component):
                 if not self.Queues.get_jobs([{'jobid': jobid}]):
                     job.dep_fail = True
                     break
+            if job.dep_fail != already_failed:
+                notify_watches(job)
             if (job.dep_fail and (not already_failed)):
                 dbwriter.log_to_db(None, "dep_fail", "job_prog", JobProgMsg(job))
             if ((not job.dep_fail) and already_failed and 
                 (job.no_holds_left())):
                 dbwriter.log_to_db(None, "all_holds_clear", "job_prog", 
                                    JobProgMsg(job))
-    check_dep_fail = automatic(check_dep_fail, period=60)
     
     def get_next_id(self):
         '''get the next id, the generator will throw.  Useful for recovery.'''
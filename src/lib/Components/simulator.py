@@ -264,6 +264,7 @@ class Simulator (BGBaseSystem):
 
         # explicitly unblock the blocked partitions
         self.update_partition_state()
+        bg_base_system.scheduler_notifier.post()
 
         self.logger.info("release_partition(%r)" % (name))
         return True
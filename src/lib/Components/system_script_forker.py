@@ -1,11 +1,23 @@
 import logging
 import os
+import signal
+import subprocess
+import sys
 import tempfile
+import time
+from collections import deque
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 import Cobalt
 import Cobalt.Components.base_forker
 BaseForker = Cobalt.Components.base_forker.BaseForker
 BaseChild = Cobalt.Components.base_forker.BaseChild
+get_forker_config = Cobalt.Components.base_forker.get_forker_config
+exposed = Cobalt.Components.base_forker.exposed
 import Cobalt.Util
 convert_argv_to_quoted_command_string = Cobalt.Util.convert_argv_to_quoted_command_string
 
@@ -93,6 +105,102 @@ class SystemScriptChild (BaseChild):
         BaseChild.preexec_last(self)
 
 
+# argument replaced by the host name in each command run by a fan-out child
+host_placeholder = "{host}"
+
+def run_fanout(args, hosts, window, host_timeout=None, env=None, max_output=4096, poll_interval=0.05):
+    '''
+    Run a command once for each host, with no more than window commands running at a time.  Each argument equal to
+    host_placeholder is replaced by the host name.  A command still running after host_timeout seconds is killed.
+
+    Returns a list of dictionaries in the order of hosts, each holding the host, its exit_status, whether it timed_out,
+    and the last max_output bytes of its combined stdout and stderr.
+    '''
+    pending = deque(hosts)
+    running = {}
+    results = {}
+    devnull = open(os.devnull)
+    try:
+        while pending or running:
+            while pending and len(running) < window:
+                host = pending.popleft()
+                argv = [(arg == host_placeholder and host) or arg for arg in args]
+                output = tempfile.TemporaryFile()
+                try:
+                    proc = subprocess.Popen(argv, stdin=devnull, stdout=output, stderr=subprocess.STDOUT, env=env,
+                        close_fds=True)
+                except OSError, e:
+                    output.close()
+                    results[host] = {'host':host, 'exit_status':255, 'timed_out':False, 'output':str(e)}
+                    continue
+                running[proc] = (host, output, time.time())
+            time.sleep(poll_interval)
+            now = time.time()
+            for proc, (host, output, start_time) in running.items():
+                timed_out = False
+                if proc.poll() is None:
+                    if host_timeout is None or now - start_time <= host_timeout:
+                        continue
+                    proc.kill()
+                    proc.wait()
+                    timed_out = True
+                del running[proc]
+                exit_status = proc.returncode
+                if exit_status < 0:
+                    exit_status = 128 - exit_status
+                output.seek(0, 2)
+                output.seek(max(output.tell() - max_output, 0))
+                results[host] = {'host':host, 'exit_status':exit_status, 'timed_out':timed_out,
+                                 'output':output.read().decode('utf-8', 'replace')}
+                output.close()
+    finally:
+        # the fan-out was interrupted; do not leave commands behind
+        for proc in running:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        devnull.close()
+    return [results[host] for host in hosts]
+
+
+class FanoutChild (SystemScriptChild):
+    '''
+    Child running one command across a list of hosts.  A line of JSON per host, holding the result returned by
+    run_fanout, is written to stdout.  The child exits with a status of 0 if every command succeeded and 1 otherwise.
+    '''
+
+    # the output for each host is already cut down to its tail, and every line is needed to report on the hosts
+    bounded_output = False
+    def __init__(self, id = None, hosts = None, window = None, host_timeout = None, **kwargs):
+        SystemScriptChild.__init__(self, id=id, **kwargs)
+        self.hosts = hosts
+        self.window = window
+        self.host_timeout = host_timeout
+
+    def preexec_first(self):
+        # the command for each host is run directly rather than through the shell
+        BaseChild.preexec_first(self)
+
+    def exec_child(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(143))
+        signal.signal(signal.SIGINT, lambda signum, frame: sys.exit(130))
+        try:
+            results = run_fanout(self.args, self.hosts, self.window, self.host_timeout, self.env)
+            # sys.stdout may have been replaced in the parent; write to the redirected descriptor itself
+            stdout = os.fdopen(1, 'w')
+            for result in results:
+                stdout.write(json.dumps(result) + "\n")
+            stdout.flush()
+        except SystemExit, e:
+            os._exit(e.code)
+        except:
+            _logger.error("%s: fan-out failed", self.label, exc_info=True)
+            os._exit(255)
+        os._exit(int([result for result in results if result['exit_status'] != 0] != []))
+
+
 class SystemScriptForker (BaseForker):
     """
     Component for starting system script jobs such as the prologue and epilogue scripts run by cqm
@@ -118,3 +226,25 @@ class SystemScriptForker (BaseForker):
 
     def __setstate__(self, state):
         BaseForker.__setstate__(self, state)
+
+    def fork_fanout(self, args, hosts, tag=None, label=None, env=None, window=None, host_timeout=None, runid=None):
+        """Fork a single child that runs a command across a list of hosts, a window of them at a time.
+
+        args -- the command and arguments; each argument equal to "{host}" is replaced by the host name
+        hosts -- the hosts to run the command for
+        window -- the most commands to run at once (default: the fanout_window forker option, or 64)
+        host_timeout -- seconds after which the command for a host is killed (default: no limit)
+
+        The remaining arguments are those of fork.  The child's stdout holds a line of JSON per host with its exit_status,
+        whether it timed_out, and the tail of its output.
+
+        returns the forker id of the child process object.
+
+        """
+        _logger.info("fan-out called for %d hosts with args of %s", len(hosts), " ".join(args))
+        if window is None:
+            window = int(get_forker_config('fanout_window', 64))
+        return self._start_child(FanoutChild, args, tag, label, env, runid, hosts=hosts, window=window,
+            host_timeout=host_timeout)
+
+    fork_fanout = exposed(fork_fanout)
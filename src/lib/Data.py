@@ -2,11 +2,16 @@
 
 __revision__ = '$Revision$'
 
+import os
 import time
 import random
 import warnings
 import sys
 import socket
+import threading
+import weakref
+import xmlrpclib
+from collections import OrderedDict
 
 import Cobalt.Util
 from Cobalt.Exceptions import DataCreationError, IncrIDError, DataStateError, DataStateTransitionError
@@ -14,6 +19,22 @@ from Cobalt.Exceptions import DataCreationError, IncrIDError, DataStateError, Da
 DB_SECTION = "cdbwriter"
 DB_COMMON_SCHEMA = "COMMON"
 
+# held while stale secondary indexes are rebuilt, since queries run by read-only component methods may find them stale
+# at the same time
+index_rebuild_lock = threading.Lock()
+
+# sequence number of the latest change noted on an item held by a container with a change log (see ChangeLog); items
+# are only changed by component methods holding the component lock for writing, so no lock of its own is needed
+modification_seq = 0
+# identifies this process; modification sequence numbers are only comparable within an epoch
+modification_epoch = "%d.%f" % (os.getpid(), time.time())
+
+def next_modification_seq ():
+    """Advance the modification sequence number and return it."""
+    global modification_seq
+    modification_seq += 1
+    return modification_seq
+
 def get_spec_fields (specs):
     """Given a list of specs, return the set of all fields used."""
     fields = set()
@@ -22,6 +43,34 @@ def get_spec_fields (specs):
             fields.add(field)
     return fields
 
+def apply_query_options (items, options):
+    """Sort and page the items matched by a query, or count them.
+    
+    Arguments:
+    items -- the matched items
+    options -- a dictionary that may contain:
+        sort -- list of fields to sort by; a field prefixed by '-' sorts in descending order
+        offset -- number of items to skip after sorting (default 0)
+        limit -- largest number of items to return (default no limit)
+        count -- if true, return the number of matched items, ignoring offset and limit
+    
+    Returns a list of items, or the count.
+    """
+    if options.get('count'):
+        return len(items)
+    items = list(items)
+    sort = options.get('sort') or []
+    # sorts are stable, so sorting by each field from the last to the first orders by all of them
+    for field in reversed(sort):
+        descending = field.startswith('-')
+        field = field.lstrip('-')
+        items.sort(key=lambda item: getattr(item, field, None), reverse=descending)
+    offset = int(options.get('offset') or 0)
+    limit = options.get('limit')
+    if limit is None:
+        return items[offset:]
+    return items[offset:offset + int(limit)]
+
 
 
 class IncrID (object):
@@ -121,6 +170,14 @@ class IncrID (object):
     def next (self):
         """Iterator interface."""
         return self.get()
+
+    def reserve(self, count):
+        """Get the next count ids at once.  Ids provided by the database are still fetched one at a time."""
+        if self.use_database:
+            return [self.get() for _ in xrange(count)]
+        ids = range(self.idnum + 1, self.idnum + count + 1)
+        self.idnum += count
+        return ids
     
     def set(self, val, override = False):
         """Set the next id.  val cannot be less than the current value of idnum."""
@@ -178,6 +235,12 @@ class Data (object):
     update -- Set the value of multiple fields at once.
     match -- Test that a spec identifies a data.
     to_rx -- Convert a data to an explicit spec.
+
+    Setting a field that a DataList or DataDict indexes (see
+    indexed_fields) updates the secondary indexes of the containers that
+    hold the entity.  Changing the value of a public attribute notes the
+    change in the change logs of the containers that hold the entity (see
+    note_change).
     """
     
     fields = ["tag"]
@@ -203,6 +266,44 @@ class Data (object):
             raise DataCreationError, "Specified inherent field %s" \
                   % (":".join(inherent))
 
+    def __setattr__ (self, name, value):
+        logged = self.__dict__.get('_change_logs') and not name.startswith('_')
+        if logged:
+            old_value = getattr(self, name, DataIndex._missing)
+        object.__setattr__(self, name, value)
+        indexes = self.__dict__.get('_data_indexes')
+        if indexes and name in indexes:
+            for index_ref in indexes[name][:]:
+                index = index_ref()
+                if index is None:
+                    indexes[name].remove(index_ref)
+                else:
+                    index.reindex(self)
+        if logged and old_value != value:
+            self.note_change()
+
+    def __getstate__ (self):
+        state = dict(self.__dict__)
+        state.pop('_data_indexes', None)
+        state.pop('_change_logs', None)
+        state.pop('_modified_seq', None)
+        return state
+
+    def note_change (self):
+        """Give the entity a new modification sequence number in the change logs of the containers that hold it.
+
+        Called for changes that do not assign a public attribute, such as state transitions or lists updated in place.
+        """
+        change_logs = self.__dict__.get('_change_logs')
+        if change_logs:
+            self.__dict__['_modified_seq'] = next_modification_seq()
+            for log_ref in change_logs[:]:
+                log = log_ref()
+                if log is None:
+                    change_logs.remove(log_ref)
+                else:
+                    log.changed(self)
+
     def match (self, spec):
         """True if every field in spec == the same field on the entity.
         
@@ -332,12 +433,247 @@ Set -- set state to new value, ensuring it is a proper state and respects the st
 """)
 
 
+class DataIndex (object):
+    
+    """Secondary index over a single field of the items in a container.
+    
+    Items are registered with the index so that assigning the indexed
+    field on an item moves it to the bucket for its new value.  Items whose
+    value is unhashable are kept aside and returned by every lookup, so a
+    lookup always yields a superset of the items that can match.
+    
+    Attributes:
+    field -- name of the indexed field
+    
+    Methods:
+    add -- start tracking an item
+    remove -- stop tracking an item
+    reindex -- move an item to the bucket for its current value
+    lookup -- the items that may hold a value (None if value is unhashable)
+    """
+    
+    _missing = object()
+    
+    def __init__ (self, field):
+        self.field = field
+        self.buckets = {}
+        self.unhashable = set()
+        self.item_keys = {}
+    
+    def __len__ (self):
+        return len(self.item_keys)
+    
+    def _file (self, item):
+        key = getattr(item, self.field, self._missing)
+        try:
+            self.buckets.setdefault(key, set()).add(item)
+        except TypeError:
+            self.unhashable.add(item)
+            self.item_keys[item] = None
+        else:
+            self.item_keys[item] = (key,)
+    
+    def _unfile (self, item):
+        key = self.item_keys.pop(item)
+        if key is None:
+            self.unhashable.discard(item)
+        else:
+            bucket = self.buckets[key[0]]
+            bucket.discard(item)
+            if not bucket:
+                del self.buckets[key[0]]
+    
+    def add (self, item):
+        """Start tracking an item."""
+        if item in self.item_keys:
+            return
+        self._file(item)
+        indexes = item.__dict__.setdefault('_data_indexes', {})
+        indexes.setdefault(self.field, []).append(weakref.ref(self))
+    
+    def remove (self, item):
+        """Stop tracking an item."""
+        if item not in self.item_keys:
+            return
+        self._unfile(item)
+        refs = item.__dict__.get('_data_indexes', {}).get(self.field, [])
+        for index_ref in refs[:]:
+            if index_ref() in (self, None):
+                refs.remove(index_ref)
+    
+    def reindex (self, item):
+        """Move an item to the bucket for its current value."""
+        if item in self.item_keys:
+            self._unfile(item)
+            self._file(item)
+    
+    def lookup (self, value):
+        """Return the items that may hold value, or None if value can not be looked up."""
+        try:
+            bucket = self.buckets.get(value, ())
+        except TypeError:
+            return None
+        if self.unhashable:
+            return self.unhashable.union(bucket)
+        return bucket
+
+
+class ChangeLog (object):
+    
+    """The items of a container in the order they last changed.
+    
+    Items are registered with the log so that noting a change on an item
+    (see Data.note_change) moves it to the end with its new modification
+    sequence number.  Removed items are remembered with the sequence number
+    of their removal, up to a limit.
+    
+    Attributes:
+    oldest -- changes with sequence numbers up to this one are not all known
+    items -- ordered dictionary of the sequence numbers the items last changed at, oldest first
+    deleted -- ordered dictionary of the sequence numbers items were removed at, oldest first
+    
+    Methods:
+    add -- start tracking an item
+    remove -- stop tracking an item, remembering its removal
+    changed -- move an item to the end with its current sequence number
+    since -- the items changed and removed after a sequence number
+    """
+    
+    def __init__ (self, max_deleted=10000):
+        """Initialize a change log.
+        
+        Arguments:
+        max_deleted -- number of removals remembered (default 10000)
+        """
+        self.max_deleted = max_deleted
+        # the changes made before the log existed are not known
+        self.oldest = next_modification_seq()
+        self.items = OrderedDict()
+        self.deleted = OrderedDict()
+    
+    def __len__ (self):
+        return len(self.items)
+    
+    def add (self, item):
+        """Start tracking an item."""
+        if item in self.items:
+            return
+        self.deleted.pop(item, None)
+        item.__dict__.setdefault('_change_logs', []).append(weakref.ref(self))
+        item.note_change()
+    
+    def remove (self, item):
+        """Stop tracking an item, remembering its removal."""
+        if item not in self.items:
+            return
+        del self.items[item]
+        refs = item.__dict__.get('_change_logs', [])
+        for log_ref in refs[:]:
+            if log_ref() in (self, None):
+                refs.remove(log_ref)
+        self.deleted[item] = next_modification_seq()
+        if len(self.deleted) > self.max_deleted:
+            self.oldest = self.deleted.popitem(last=False)[1]
+    
+    def changed (self, item):
+        """Move an item to the end with its current sequence number."""
+        self.items.pop(item, None)
+        self.items[item] = item.__dict__['_modified_seq']
+    
+    def since (self, seq):
+        """Return the items changed and the items removed after seq, or None if not all of those changes are known."""
+        if seq < self.oldest:
+            return None
+        changed = []
+        for item in reversed(self.items):
+            if self.items[item] <= seq:
+                break
+            changed.append(item)
+        deleted = []
+        for item in reversed(self.deleted):
+            if self.deleted[item] <= seq:
+                break
+            deleted.append(item)
+        return changed, deleted
+
+
+def changes_since (logs, seq, key, fields, full=False):
+    """Return the entities of one or more containers changed or deleted after seq.
+    
+    A full listing is returned instead of a delta when full is set or seq is
+    not one the change logs can answer (zero, in the future, or older than
+    the changes they remember).
+    
+    Arguments:
+    logs -- the change logs of the containers
+    seq -- sequence number of the caller's last read
+    key -- attribute name identifying an entity
+    fields -- fields reported for each entity
+    full -- return a full listing whatever seq is (default False)
+    
+    Returns a dictionary with the epoch, the new sequence number, whether
+    the result is a full listing, the changed entities and the deleted keys.
+    """
+    current = modification_seq
+    fields = list(fields)
+    if key not in fields:
+        fields.append(key)
+    deltas = None
+    if not full and 0 < seq <= current:
+        deltas = [log.since(seq) for log in logs]
+    if deltas is None or None in deltas:
+        items = [item for log in logs for item in log.items]
+        return {'epoch':modification_epoch, 'seq':current, 'full':True,
+                'changed':[item.to_rx(fields) for item in items], 'deleted':[]}
+    changed = {}
+    deleted = set()
+    for log_changed, log_deleted in deltas:
+        for item in log_changed:
+            changed[getattr(item, key)] = item
+        for item in log_deleted:
+            deleted.add(getattr(item, key))
+    # an entity moved between containers is removed from one and added to the other
+    return {'epoch':modification_epoch, 'seq':current, 'full':False,
+            'changed':[item.to_rx(fields) for item in changed.itervalues()],
+            'deleted':[item_key for item_key in deleted if item_key not in changed]}
+
+
+def plan_query (indexes, specs):
+    """Pick a candidate set for each spec from a set of indexes.
+    
+    Returns a list of (spec, candidates) tuples, or None if some spec does
+    not pin an indexed field and the container must be scanned.
+    
+    Arguments:
+    indexes -- dictionary of DataIndex objects keyed by field
+    specs -- a list of dictionaries specifying the objects to match
+    """
+    plan = []
+    for spec in specs:
+        best = None
+        for field, index in indexes.iteritems():
+            value = spec.get(field, "*")
+            if value == "*":
+                continue
+            candidates = index.lookup(value)
+            if candidates is not None and (best is None or len(candidates) < len(best)):
+                best = candidates
+        if best is None:
+            return None
+        plan.append((spec, best))
+    return plan
+
+
 class DataList (list):
     
     """A Python list with the Cobalt query interface.
     
     Class attributes:
     item_cls -- the class used to construct new items
+    indexed_fields -- fields to keep secondary indexes on (default none)
+    
+    Properties:
+    change_log -- the ChangeLog of the items, built on first use
     
     Methods:
     q_add -- construct new items in the list
@@ -346,6 +682,132 @@ class DataList (list):
     """
     
     item_cls = Data
+    indexed_fields = []
+    
+    def __getstate__ (self):
+        state = dict(self.__dict__)
+        state.pop('_indexes', None)
+        state.pop('_change_log', None)
+        return state
+    
+    def _get_indexes (self):
+        """Return the secondary indexes, (re)building them if the list has changed behind their back."""
+        if not self.indexed_fields:
+            return None
+        indexes = self.__dict__.get('_indexes')
+        if indexes is None or [index for index in indexes.itervalues() if len(index) != len(self)]:
+            index_rebuild_lock.acquire()
+            try:
+                indexes = self.__dict__.get('_indexes')
+                if indexes is None or [index for index in indexes.itervalues() if len(index) != len(self)]:
+                    if indexes is not None:
+                        for index in indexes.itervalues():
+                            for item in index.item_keys.keys():
+                                index.remove(item)
+                    indexes = dict([(field, DataIndex(field)) for field in self.indexed_fields])
+                    for item in self:
+                        for index in indexes.itervalues():
+                            index.add(item)
+                    self.__dict__['_indexes'] = indexes
+            finally:
+                index_rebuild_lock.release()
+        return indexes
+    
+    def _get_change_log (self):
+        """Return the change log, (re)building it if the list has changed behind its back."""
+        log = self.__dict__.get('_change_log')
+        if log is None or len(log) != len(self):
+            log = ChangeLog()
+            for item in self:
+                log.add(item)
+            self.__dict__['_change_log'] = log
+        return log
+    
+    change_log = property(_get_change_log)
+    
+    def _index_add (self, items):
+        indexes = self.__dict__.get('_indexes')
+        if indexes:
+            for item in items:
+                for index in indexes.itervalues():
+                    index.add(item)
+        log = self.__dict__.get('_change_log')
+        if log is not None:
+            for item in items:
+                log.add(item)
+    
+    def _index_remove (self, items):
+        indexes = self.__dict__.get('_indexes')
+        if indexes:
+            for item in items:
+                for index in indexes.itervalues():
+                    index.remove(item)
+        log = self.__dict__.get('_change_log')
+        if log is not None:
+            for item in items:
+                log.remove(item)
+    
+    def append (self, item):
+        list.append(self, item)
+        self._index_add([item])
+    
+    def extend (self, items):
+        items = list(items)
+        list.extend(self, items)
+        self._index_add(items)
+    
+    def insert (self, position, item):
+        list.insert(self, position, item)
+        self._index_add([item])
+    
+    def remove (self, item):
+        list.remove(self, item)
+        if item not in self:
+            self._index_remove([item])
+    
+    def pop (self, *args):
+        item = list.pop(self, *args)
+        if item not in self:
+            self._index_remove([item])
+        return item
+    
+    def _replace (self, old_items, new_items):
+        """Bring the indexes up to date with old_items replaced by new_items."""
+        self._index_remove([item for item in old_items if item not in self])
+        self._index_add(new_items)
+    
+    def __setitem__ (self, index, value):
+        if isinstance(index, slice):
+            old_items = self[index]
+            new_items = list(value)
+        else:
+            old_items = [self[index]]
+            new_items = [value]
+        list.__setitem__(self, index, value)
+        self._replace(old_items, new_items)
+    
+    def __setslice__ (self, start, end, items):
+        old_items = self[start:end]
+        items = list(items)
+        list.__setslice__(self, start, end, items)
+        self._replace(old_items, items)
+    
+    def __delitem__ (self, index):
+        if isinstance(index, slice):
+            old_items = self[index]
+        else:
+            old_items = [self[index]]
+        list.__delitem__(self, index)
+        self._replace(old_items, [])
+    
+    def __delslice__ (self, start, end):
+        old_items = self[start:end]
+        list.__delslice__(self, start, end)
+        self._replace(old_items, [])
+    
+    def __iadd__ (self, items):
+        self.extend(items)
+        return self
     
     def q_add (self, specs, callback=None, cargs={}):
         """Construct new items of type self.item_cls in the list.
@@ -363,7 +825,7 @@ class DataList (list):
             new_items.append(new_item)
         if callback:
             for item in new_items:
-                callback(new_item, cargs)
+                callback(item, cargs)
         self.extend(new_items)
         return new_items
 
@@ -376,11 +838,19 @@ class DataList (list):
         cargs -- a tuple of arguments to pass to callback after the item
         """
         matched_items = set()
-        for item in self:
-            for spec in specs:
-                if item.match(spec):
-                    matched_items.add(item)
-                    break
+        indexes = self._get_indexes()
+        plan = indexes and plan_query(indexes, specs)
+        if plan:
+            for spec, candidates in plan:
+                for item in list(candidates):
+                    if item not in matched_items and item.match(spec):
+                        matched_items.add(item)
+        else:
+            for item in self:
+                for spec in specs:
+                    if item.match(spec):
+                        matched_items.add(item)
+                        break
         if callback:
             for item in matched_items:
                 callback(item, cargs)
@@ -407,6 +877,10 @@ class DataDict (dict):
     Class attributes:
     item_cls -- the class used to construct new items
     key -- attribute name to use as a key in the dictionary
+    indexed_fields -- fields to keep secondary indexes on (default none)
+    
+    Properties:
+    change_log -- the ChangeLog of the items, built on first use
     
     Methods:
     q_add -- construct new items in the dict
@@ -416,6 +890,106 @@ class DataDict (dict):
     
     item_cls = Data
     key = None
+    indexed_fields = []
+    
+    def __getstate__ (self):
+        state = dict(self.__dict__)
+        state.pop('_indexes', None)
+        state.pop('_change_log', None)
+        return state
+    
+    def _get_indexes (self):
+        """Return the secondary indexes, (re)building them if the dict has changed behind their back."""
+        if not self.indexed_fields:
+            return None
+        indexes = self.__dict__.get('_indexes')
+        if indexes is None or [index for index in indexes.itervalues() if len(index) != len(self)]:
+            index_rebuild_lock.acquire()
+            try:
+                indexes = self.__dict__.get('_indexes')
+                if indexes is None or [index for index in indexes.itervalues() if len(index) != len(self)]:
+                    if indexes is not None:
+                        for index in indexes.itervalues():
+                            for item in index.item_keys.keys():
+                                index.remove(item)
+                    indexes = dict([(field, DataIndex(field)) for field in self.indexed_fields])
+                    for item in self.itervalues():
+                        for index in indexes.itervalues():
+                            index.add(item)
+                    self.__dict__['_indexes'] = indexes
+            finally:
+                index_rebuild_lock.release()
+        return indexes
+    
+    def _get_change_log (self):
+        """Return the change log, (re)building it if the dict has changed behind its back."""
+        log = self.__dict__.get('_change_log')
+        if log is None or len(log) != len(self):
+            log = ChangeLog()
+            for item in self.itervalues():
+                log.add(item)
+            self.__dict__['_change_log'] = log
+        return log
+    
+    change_log = property(_get_change_log)
+    
+    def _index_add (self, items):
+        indexes = self.__dict__.get('_indexes')
+        if indexes:
+            for item in items:
+                for index in indexes.itervalues():
+                    index.add(item)
+        log = self.__dict__.get('_change_log')
+        if log is not None:
+            for item in items:
+                log.add(item)
+    
+    def _index_remove (self, items):
+        indexes = self.__dict__.get('_indexes')
+        if indexes:
+            for item in items:
+                for index in indexes.itervalues():
+                    index.remove(item)
+        log = self.__dict__.get('_change_log')
+        if log is not None:
+            for item in items:
+                log.remove(item)
+    
+    def __setitem__ (self, key, item):
+        if key in self:
+            self._index_remove([dict.__getitem__(self, key)])
+        dict.__setitem__(self, key, item)
+        self._index_add([item])
+    
+    def __delitem__ (self, key):
+        item = dict.__getitem__(self, key)
+        dict.__delitem__(self, key)
+        self._index_remove([item])
+    
+    def clear (self):
+        self._index_remove(self.values())
+        dict.clear(self)
+    
+    def update (self, *args, **kwargs):
+        for key, item in dict(*args, **kwargs).iteritems():
+            self[key] = item
+    
+    def setdefault (self, key, item=None):
+        if key not in self:
+            self[key] = item
+        return dict.__getitem__(self, key)
+    
+    def pop (self, key, *args):
+        if key not in self:
+            return dict.pop(self, key, *args)
+        item = dict.pop(self, key)
+        self._index_remove([item])
+        return item
+    
+    def popitem (self):
+        key, item = dict.popitem(self)
+        self._index_remove([item])
+        return key, item
     
     def q_add (self, specs, callback=None, cargs={}):
         """Construct new items of type self.item_cls in the dict.
@@ -449,11 +1023,19 @@ class DataDict (dict):
         cargs -- a tuple of arguments to pass to callback after the item
         """
         matched_items = set()
-        for item in self.itervalues():
-            for spec in specs:
-                if item.match(spec):
-                    matched_items.add(item)
-                    break
+        indexes = self._get_indexes()
+        plan = indexes and plan_query(indexes, specs)
+        if plan:
+            for spec, candidates in plan:
+                for item in list(candidates):
+                    if item not in matched_items and item.match(spec):
+                        matched_items.add(item)
+        else:
+            for item in self.itervalues():
+                for spec in specs:
+                    if item.match(spec):
+                        matched_items.add(item)
+                        break
         if callback:
             for item in matched_items:
                 callback(item, cargs)
@@ -493,12 +1075,32 @@ class ForeignData (Data):
 
 
 class ForeignDataDict(DataDict):
+    
+    """A DataDict mirroring entities held by another component.
+    
+    Class attributes:
+    __function__ -- called with a list of specs to fetch every foreign entity
+    __since_function__ -- called with a sequence number and __fields__ to fetch
+      a changes_since reply (optional; __function__ is used when unset or unsupported)
+    __fields__ -- fields to fetch
+    """
+    
     __oserror__ = Cobalt.Util.FailureMode("ForeignData connection")
     __function__ = lambda x:[]
+    __since_function__ = None
     __procedure__ = None
     __fields__ = []
+    _feed_epoch = None
+    _feed_seq = 0
+    _feed_supported = True
     
     def Sync(self):
+        if self.__since_function__ is not None and self._feed_supported:
+            self._sync_since()
+        else:
+            self._sync_full()
+    
+    def _sync_full(self):
         spec = dict([(field, "*") for field in self.__fields__])
         try:
             foreign_data = self.__function__([spec])
@@ -506,21 +1108,50 @@ class ForeignDataDict(DataDict):
             self.__oserror__.Fail()
             return
         self.__oserror__.Pass()
-        
-        local_ids = [getattr(item, self.key) for item in self.itervalues()]
-        foreign_ids = [item_dict[self.key] for item_dict in foreign_data]
+        self._sync_all(foreign_data)
+    
+    def _sync_all(self, foreign_data):
+        foreign_ids = set([item_dict[self.key] for item_dict in foreign_data])
         
         # sync removed items
-        for item in local_ids:
-            if item not in foreign_ids:
-                del self[item]
+        for item in [item for item in self.iterkeys() if item not in foreign_ids]:
+            del self[item]
         
         # sync new items
-        for item_dict in foreign_data:
-            if item_dict[self.key] not in local_ids:
-                self.q_add([item_dict])
+        self.q_add([item_dict for item_dict in foreign_data if item_dict[self.key] not in self])
         
         # sync all items
         for item_dict in foreign_data:
             item_id = item_dict[self.key]
             self[item_id].Sync(item_dict)
+    
+    def _sync_since(self):
+        try:
+            delta = self.__since_function__(self._feed_seq, self.__fields__)
+        except xmlrpclib.Fault:
+            # the foreign component has no change feed; fetch everything from now on
+            self._feed_supported = False
+            self._feed_epoch, self._feed_seq = None, 0
+            self._sync_full()
+            return
+        except:
+            self.__oserror__.Fail()
+            return
+        self.__oserror__.Pass()
+        
+        if not delta['full'] and delta['epoch'] != self._feed_epoch:
+            # the foreign component restarted; our sequence number means nothing to it
+            self._feed_epoch, self._feed_seq = None, 0
+            return self._sync_since()
+        
+        if delta['full']:
+            self._sync_all(delta['changed'])
+        else:
+            for item in delta['deleted']:
+                if item in self:
+                    del self[item]
+            self.q_add([item_dict for item_dict in delta['changed'] if item_dict[self.key] not in self])
+            for item_dict in delta['changed']:
+                self[item_dict[self.key]].Sync(item_dict)
+        self._feed_epoch = delta['epoch']
+        self._feed_seq = delta['seq']
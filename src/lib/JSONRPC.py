@@ -0,0 +1,87 @@
+"""Compact JSON encoding for component RPC.
+
+Carries the same calls as XML-RPC in a fraction of the marshaling time.
+Clients ask for it with an Accept header on an ordinary XML-RPC request,
+and switch to sending JSON requests once a server has answered in JSON, so
+XML-RPC stays the default between old and new components.
+
+Request -- {"method": name, "params": [...]}
+Response -- {"result": value} or {"fault": {"faultCode": code, "faultString": string}}
+
+As with xmlrpclib, strings come back as str unless they hold non-ASCII
+characters, and tuples come back as lists.  Values JSON cannot carry
+(xmlrpclib.DateTime, xmlrpclib.Binary) make the dumps functions raise
+TypeError; callers fall back to XML-RPC for those.
+"""
+
+__revision__ = '$Revision$'
+
+__all__ = ["content_type", "dumps_request", "loads_request",
+           "dumps_response", "dumps_fault", "loads_response"]
+
+import xmlrpclib
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+content_type = "application/x-cobalt-json"
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def _ascii (value):
+    """Return value with ASCII-only unicode strings converted to str."""
+    if type(value) is unicode:
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    if type(value) is list:
+        return [_ascii(item) for item in value]
+    return value
+
+# the same handful of field names recur in every object of a response
+_keys = {}
+
+def _object_hook (pairs):
+    # nested objects have already been through the hook
+    obj = {}
+    for key, value in pairs:
+        ascii_key = _keys.get(key)
+        if ascii_key is None:
+            if len(_keys) > 10000:
+                _keys.clear()
+            ascii_key = _keys[key] = _ascii(key)
+        value_type = type(value)
+        if value_type is unicode or value_type is list:
+            value = _ascii(value)
+        obj[ascii_key] = value
+    return obj
+
+_decoder = json.JSONDecoder(object_pairs_hook=_object_hook)
+
+
+def dumps_request (method, params):
+    return _encoder.encode({'method':method, 'params':params})
+
+def loads_request (data):
+    """Return (params, method), like xmlrpclib.loads."""
+    request = _decoder.decode(data)
+    return tuple(request['params']), request['method']
+
+def dumps_response (result):
+    return _encoder.encode({'result':result})
+
+def dumps_fault (fault):
+    return _encoder.encode({'fault':{'faultCode':fault.faultCode,
+                                     'faultString':fault.faultString}})
+
+def loads_response (data):
+    """Return the result of a call, or raise the xmlrpclib.Fault it returned."""
+    response = _decoder.decode(data)
+    if 'fault' in response:
+        fault = response['fault']
+        raise xmlrpclib.Fault(fault['faultCode'], fault['faultString'])
+    return response['result']
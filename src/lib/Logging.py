@@ -2,10 +2,12 @@
 __revision__ = '$Revision$'
 
 # import lxml.etree
+import collections
 import copy
 import fcntl
 import logging
 import logging.handlers
+import itertools
 import math
 import os.path
 import socket
@@ -21,6 +23,7 @@ import threading
 import time
 import Queue
 import traceback
+import xmlrpclib
 
 import Cobalt.JSONEncoders
 import Cobalt.Proxy
@@ -294,11 +297,145 @@ def log_to_syslog (logger_name, level=SYSLOG_LEVEL, format='%(name)s[%(process)d
 
 
 # Log-to-database utilities are below.
+class MessageSpool(object):
+
+    """Append-only on-disk queue of messages, one per line, in fixed-size segment files.
+
+    Segments are named <path>.<number> and filled in order.  A cursor file
+    (<path>.cursor) records the segment and offset of the oldest message
+    not yet consumed, so a spool can be drained a batch at a time, across
+    restarts, without ever being read into memory whole.  Consumed
+    segments are removed.
+
+    Methods:
+    append -- add messages at the end of the spool
+    read -- return messages from the cursor on, each with the position after it
+    consume -- move the cursor to a position returned by read
+    empty -- whether any messages remain
+    """
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.segments = self.__find_segments()
+        if os.path.isfile(path):
+            # an overflow file from before spooling holds the oldest messages
+            number = self.segments and self.segments[0] - 1 or 0
+            os.rename(path, self.__segment_path(number))
+            self.segments.insert(0, number)
+        self.cursor = self.__load_cursor()
+
+    def __segment_path(self, number):
+        return "%s.%d" % (self.path, number)
+
+    def __find_segments(self):
+        directory, base = os.path.split(self.path)
+        segments = []
+        for name in os.listdir(directory or os.curdir):
+            if name.startswith(base + "."):
+                try:
+                    segments.append(int(name[len(base) + 1:]))
+                except ValueError:
+                    pass
+        segments.sort()
+        return segments
+
+    def __load_cursor(self):
+        try:
+            segment, offset = [int(field) for field in open(self.path + ".cursor").read().split()]
+        except (IOError, ValueError):
+            segment, offset = None, 0
+        if not self.segments:
+            return (None, 0)
+        if segment not in self.segments:
+            return (self.segments[0], 0)
+        return (segment, offset)
+
+    def empty(self):
+        segment, offset = self.cursor
+        if not self.segments:
+            return True
+        return segment == self.segments[-1] and offset >= os.path.getsize(self.__segment_path(segment))
+
+    def append(self, messages):
+        """Write messages to the end of the spool."""
+        lines = collections.deque([message.rstrip('\n') + '\n' for message in messages])
+        while lines:
+            size = self.segments and os.path.getsize(self.__segment_path(self.segments[-1])) or 0
+            if not self.segments or size >= self.segment_size:
+                self.segments.append(self.segments and self.segments[-1] + 1 or 0)
+                if self.cursor[0] is None:
+                    self.cursor = (self.segments[-1], 0)
+                size = 0
+            segment_file = open(self.__segment_path(self.segments[-1]), "a")
+            try:
+                while lines and size < self.segment_size:
+                    line = lines.popleft()
+                    segment_file.write(line)
+                    size += len(line)
+            finally:
+                segment_file.close()
+
+    def read(self, count):
+        """Return up to count (message, position after it) pairs from the cursor on, and the position after them."""
+        messages = []
+        segment, offset = self.cursor
+        while segment is not None and len(messages) < count:
+            segment_file = open(self.__segment_path(segment))
+            try:
+                segment_file.seek(offset)
+                while len(messages) < count:
+                    line = segment_file.readline()
+                    if not line.endswith('\n'):
+                        break
+                    offset += len(line)
+                    messages.append((line[:-1], (segment, offset)))
+            finally:
+                segment_file.close()
+            if len(messages) >= count or segment == self.segments[-1]:
+                break
+            if line:
+                logging.getLogger("spool").error("%s: dropping incomplete message at end of segment %d",
+                                                 self.path, segment)
+            segment, offset = self.segments[self.segments.index(segment) + 1], 0
+        return messages, (segment, offset)
+
+    def consume(self, position):
+        """Discard the messages before position, a position returned by read."""
+        segment, offset = position
+        if segment is None:
+            return
+        while self.segments[0] != segment:
+            os.remove(self.__segment_path(self.segments.pop(0)))
+        self.cursor = position
+        if self.empty():
+            os.remove(self.__segment_path(self.segments.pop(0)))
+            self.cursor = (None, 0)
+            if os.path.exists(self.path + ".cursor"):
+                os.remove(self.path + ".cursor")
+            return
+        temp_path = self.path + ".cursor.temp"
+        cursor_file = open(temp_path, "w")
+        try:
+            cursor_file.write("%d %d\n" % position)
+        finally:
+            cursor_file.close()
+        os.rename(temp_path, self.path + ".cursor")
+
+
 class dbwriter(object):
 
-    """I am intending this to involve a singleton IO thread going to the
-    database"""
-    
+    """Queue messages for the database writer component (cdbwriter).
+
+    Messages are sent in batches by a background thread, so components
+    logging job and reservation events do not wait on cdbwriter or the
+    database.  If cdbwriter cannot be reached, messages accumulate in
+    msg_queue; past max_queued they are spilled to a MessageSpool at the
+    overflow file, which is drained, oldest first, once cdbwriter is back.
+    """
+
+    batch_size = 500
+
     def __init__(self, logger, queue=None, overflow_filename=None,
                  max_queued=None):
         
@@ -306,19 +443,32 @@ class dbwriter(object):
         self.enabled = False
         self.cdbwriter_alive = False
         self.cdbwriter = None
-        self.flushing = False
+        # cleared if cdbwriter predates add_messages
+        self.batching = True
         
         self.overflow = False
         self.overflow_filename = overflow_filename
-        self.overflow_file = None
-        self.clearing_overflow = False
+        self.spool = None
         self.max_queued = max_queued    
         
-        if queue:
-            self.msg_queue = queue
-        else:
-            self.msg_queue = []
-            
+        self.msg_queue = queue or []
+
+        # guards msg_queue and the spool, which the sender thread shares with the logging component
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.sender = None
+        self.start_lock = threading.Lock()
+        # while nonzero, messages are queued without waking the sender (see hold)
+        self.held = 0
+
+    def __get_msg_queue(self):
+        return self.__msg_queue
+
+    def __set_msg_queue(self, messages):
+        # components restore the queue from their statefiles as a list
+        self.__msg_queue = collections.deque(messages)
+
+    msg_queue = property(__get_msg_queue, __set_msg_queue)
 
 
     def connect(self):
@@ -342,33 +492,6 @@ class dbwriter(object):
         if not self.enabled:
             return
 
-        #if a queue gets too large, save messages to disk for later writiing.
-        if ((self.max_queued != None) and 
-            (len(self.msg_queue) >= self.max_queued) and 
-            not self.clearing_overflow):
-            self.overflow = True
-            self.open_overflow('a')
-            if self.overflow_file == None:
-                #we have too many messages and cannot write to disk.  
-                #This message has to be dropped.
-                #Of course, a lot of somethings would have to go critically 
-                #wrong to need this.  The logfile message may fail as well.
-
-                try:
-                    message = Cobalt.JSONEncoders.ReportObject(user, event,
-                                                               msg_type, obj).encode()
-                except Exception as e:
-                    self.logger.error("Error encoding message to send to cdbwriter.")
-                    self.logger.error(traceback.format_exc())
-                else:
-                    #done just about all I can.  At this point, I don't have much choice.
-                    self.logger.critical("MESSAGE DROPPED: %s" % message)
-            else:
-                self.queue_to_overflow()
-                self.close_overflow()
-
-        #end queue overflow handling
-
         try:
             message = Cobalt.JSONEncoders.ReportObject(user, event, 
                                                            msg_type, obj).encode()
@@ -377,100 +500,155 @@ class dbwriter(object):
             self.logger.debug(traceback.format_exc())
             
         else:
-            self.msg_queue.append(message)
+            self.lock.acquire()
+            try:
+                self.msg_queue.append(message)
+            finally:
+                self.lock.release()
         
-        self.flush_queue()
+        if not self.held:
+            self.flush_queue()
+
+    def hold(self):
+        """Queue messages without waking the sender until the matching release, so that the messages logged for a burst
+        of changes, such as a bulk job submission, go out together in full batches."""
+        self.held += 1
+
+    def release(self):
+        """End a hold, waking the sender once no holds remain."""
+        self.held -= 1
+        if not self.held:
+            self.flush_queue()
 
  
     def flush_queue(self):
-        """send a series of messages to the writer component."""
-        if not (self.enabled or self.flushing or self.clearing_overflow):
+        """Wake the sender thread to send queued messages to the writer component."""
+        if not self.enabled:
             return
 
-        self.flushing = True
+        self.pending.set()
+        if self.sender is None:
+            self.start_lock.acquire()
+            try:
+                if self.sender is None:
+                    sender = threading.Thread(target=self.__run_sender, name="dbwriter")
+                    sender.setDaemon(True)
+                    sender.start()
+                    self.sender = sender
+            finally:
+                self.start_lock.release()
+
+    def __run_sender(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            try:
+                self.send_queue()
+            except:
+                self.logger.error("dbwriter: unexpected error sending messages to cdbwriter", exc_info=True)
+
+    def __send(self, batch):
+        """Send a batch of messages.
+
+        Returns True if the batch was accepted, False if cdbwriter could
+        not be reached, and None if the batch should be sent again as
+        single messages.
+        """
+        try:
+            if self.batching:
+                self.cdbwriter.add_messages(batch)
+            else:
+                [msg] = batch
+                self.cdbwriter.add_message(msg)
+            return True
+        except Exception, e:
+            if self.batching and isinstance(e, xmlrpclib.Fault):
+                self.logger.info("dbwriter: cdbwriter does not accept batches (%s); sending messages singly",
+                                 e.faultString)
+                self.batching = False
+                return None
+            self.logger.error("dbwriter.send_queue: Unable to contact "\
+                    "database writer when sending message.")
+            self.cdbwriter_alive = False
+            return False
+
+    def send_queue(self):
+        """Send spooled and queued messages to the writer component, oldest first, in batches of up to batch_size."""
         if not self.cdbwriter_alive:
             self.connect()
-        
-        #we're connected and have an "overflow file", we should flush 
-        #that first.
-        if self.overflow and self.cdbwriter_alive:
-            self.clearing_overflow = True
-            #Shove out as many to the writer component as we can.  Save the rest.
-            self.open_overflow('r')
-            if self.overflow_file:
-                #we prepend to the message queue.
-                overflow_queue = [line for line in self.overflow_file]
-                overflow_queue.extend(self.msg_queue)
-                self.msg_queue = overflow_queue
-                self.close_overflow()
-                self.del_overflow() #Now that it is back in memory, we dump if needed.
-                self.overflow = False
 
-        
+        spool = self.get_spool()
 
-        #drain the queue, if we have one.
-        while self.msg_queue and self.cdbwriter_alive:
-            msg = self.msg_queue[0]
+        #spooled messages are older than any in memory, so they go first.  only this thread removes messages, so
+        #a batch stays at the head of the spool or queue while it is being sent.
+        while self.cdbwriter_alive and spool and not spool.empty():
+            self.lock.acquire()
             try:
-               self.cdbwriter.add_message(msg)
-            except:
-                self.logger.error("dbwriter.flush_queue: Unable to contact "\
-                        "database writer when sending message.")
-                self.cdbwriter_alive = False
-                
-                #if the cdbwriter falls over while dealing with overflow.
-                if ((self.max_queued != None) and
-                    (len(self.msg_queue) >= self.max_queued)):
-                    self.overflow = True
-                    self.open_overflow('a')
-                    if self.overflow_file != None:
-                        self.queue_to_overflow()
-                        self.close_overflow()
+                entries, position = spool.read(self.batching and self.batch_size or 1)
+            finally:
+                self.lock.release()
+            batch = [msg for msg, msg_position in entries]
+            if batch:
+                sent = self.__send(batch)
+                if sent is None:
+                    continue
+                if not sent:
+                    break
+            elif position == spool.cursor:
+                #only an incomplete message is left
                 break
-            else:
-                try:
-                    self.msg_queue.pop(0)
-                except IndexError:
-                    self.logger.error("dbwriter.flush_queue: Queue already empty.")
-        
-        self.clearing_overflow = False
-        self.flushing = False
-       
+            self.lock.acquire()
+            try:
+                spool.consume(position)
+            finally:
+                self.lock.release()
 
-    def open_overflow(self, mode):
-        
-        try:
-            self.overflow_file = open(self.overflow_filename,mode)
-        except:
-            self.logger.critical("Unable to open overflow file!  Information to database will be lost!")
+        while self.cdbwriter_alive and self.msg_queue:
+            self.lock.acquire()
+            try:
+                batch = list(itertools.islice(self.msg_queue, self.batching and self.batch_size or 1))
+            finally:
+                self.lock.release()
+            sent = self.__send(batch)
+            if sent is None:
+                continue
+            if not sent:
+                break
+            self.lock.acquire()
+            try:
+                for msg in batch:
+                    self.msg_queue.popleft()
+            finally:
+                self.lock.release()
+
+        #if the cdbwriter is down, keep the queue from consuming all memory
+        if not self.cdbwriter_alive and (self.max_queued != None) and (len(self.msg_queue) >= self.max_queued):
+            self.lock.acquire()
+            try:
+                self.queue_to_overflow()
+            finally:
+                self.lock.release()
 
-    def close_overflow(self):
-        if self.overflow and self.overflow_file:
-            self.overflow_file.close()
-            self.overflow_file = None
-    
-    def del_overflow(self):
-        os.remove(self.overflow_filename)
-        
+    def get_spool(self):
+        """Return the spool at the overflow file, or None if no overflow file is configured."""
+        if self.spool is None and self.overflow_filename:
+            try:
+                self.spool = MessageSpool(self.overflow_filename)
+            except (IOError, OSError), e:
+                self.logger.critical("Unable to open overflow spool %s: %s" % (self.overflow_filename, e))
+        return self.spool
 
     def queue_to_overflow(self):
-        
-        elements_written = 0
-        if len(self.msg_queue) == 0:
-            return
-
-        while self.msg_queue:
-            msg = self.msg_queue.pop(0)
-            try:
-                self.overflow_file.write(msg+'\n')
-                elements_written += 1
-            except IOError:
-                logger.error('Could only partially empty queue, %d messages written' % 
-                             elements_written)
-                self.msg_queue.insert(0, msg)
-                
-        if elements_written > 0:
-            del self.msg_queue[0:elements_written-1] #empty the queue of what we have written
-        
+        """Move the queued messages to the end of the spool; return the number left in memory."""
+        spool = self.get_spool()
+        if spool is None or not self.msg_queue:
+            return len(self.msg_queue)
+        try:
+            spool.append(self.msg_queue)
+        except (IOError, OSError), e:
+            # the spool may have taken some of the messages; better to send those twice than lose the rest
+            self.logger.critical("Unable to write to overflow spool %s: %s" % (self.overflow_filename, e))
+        else:
+            self.msg_queue.clear()
+            self.overflow = True
         return len(self.msg_queue)
-        
@@ -5,12 +5,18 @@ ComponentProxy -- an RPC client proxy to Cobalt components
 
 Functions:
 load_config -- read configuration files
+forget_location -- drop cached service-location lookups for an address
+
+Proxies, transports and service-location lookups are cached for the life of
+the process.  Each endpoint has one transport, which keeps idle HTTP/1.1
+connections open for reuse by later calls.
 """
 
 __revision__ = '$Revision$'
 
 from xmlrpclib import ServerProxy, Fault, _Method
 from ConfigParser import SafeConfigParser, NoSectionError
+import errno
 import logging
 import socket
 import time
@@ -18,18 +24,28 @@ import xmlrpclib
 import urlparse
 import httplib
 import ssl
+import os
 import os.path
+from threading import Lock
 
 import Cobalt
+from Cobalt import JSONRPC
 from Cobalt.Exceptions import ComponentLookupError, ComponentOperationError
 
 __all__ = [
     "ComponentProxy", "ComponentLookupError", "RetryMethod",
-    "register_component", "find_configured_servers",
+    "register_component", "find_configured_servers", "forget_location",
 ]
 
 local_components = dict()
 known_servers = dict()
+# component name -> (address, expiry time) for addresses found through service-location
+located_servers = dict()
+# (url, retry) -> proxy; url -> transport
+server_proxies = dict()
+transports = dict()
+_cache_lock = Lock()
+_communication_config = dict()
 
 log = logging.getLogger("Proxy")
 
@@ -37,7 +53,26 @@ class CertificateError(Exception):
     def __init__(self, commonName):
         self.commonName = commonName
 
-class RetryServerProxy(ServerProxy):
+class CompactServerProxy(ServerProxy):
+    """ServerProxy that sends calls in the compact JSON encoding once the
+    server has shown that it understands it (see Cobalt.JSONRPC).
+    """
+
+    def _ServerProxy__request(self, methodname, params):
+        transport = self._ServerProxy__transport
+        if getattr(transport, 'compact', False):
+            try:
+                request = JSONRPC.dumps_request(methodname, params)
+            except (TypeError, ValueError):
+                pass
+            else:
+                response = transport.request(self._ServerProxy__host, self._ServerProxy__handler,
+                                             request, verbose=self._ServerProxy__verbose,
+                                             content_type=JSONRPC.content_type)
+                return response[0]
+        return ServerProxy._ServerProxy__request(self, methodname, params)
+
+class RetryServerProxy(CompactServerProxy):
     """A Simple proxy wiht it's __getattr__ method overridden to enable
     retries.
 
@@ -198,10 +233,44 @@ class SSLHTTPConnection(httplib.HTTPConnection):
             if scn not in self.scns:
                 raise CertificateError, scn
         self.sock.closeSocket = True
+        self.sock = ReceiveCounter(self.sock)
+
+
+class ReceiveCounter(object):
+    """Socket wrapper counting the bytes received through it, including those read by the file objects it makes.
+
+    The transport uses the count to tell a connection the server closed before answering from one that failed part way
+    through a response.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = 0
+
+    def recv(self, *args):
+        data = self.sock.recv(*args)
+        self.received += len(data)
+        return data
+
+    def makefile(self, *args):
+        fileobject = self.sock.makefile(*args)
+        # read through the wrapper, so that what the response reads is counted
+        fileobject._sock = self
+        return fileobject
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
 
 
 class XMLRPCTransport(xmlrpclib.Transport):
-    def __init__(self, key=None, cert=None, ca=None, scns=None, use_datetime=0, timeout=90):
+    """SSL transport that keeps connections to its endpoint open between requests.
+
+    Connections left idle for longer than keepalive_timeout are closed rather
+    than reused, since the server drops them on its own timeout.
+    """
+
+    def __init__(self, key=None, cert=None, ca=None, scns=None, use_datetime=0, timeout=90,
+                 keepalive_timeout=5, location=None, accept_compact=True):
         if hasattr(xmlrpclib.Transport, '__init__'):
             xmlrpclib.Transport.__init__(self, use_datetime)
         self.key = key
@@ -209,31 +278,142 @@ class XMLRPCTransport(xmlrpclib.Transport):
         self.ca = ca
         self.scns = scns
         self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.location = location
+        # compact is set once the server answers in JSONRPC
+        self.accept_compact = accept_compact
+        self.compact = False
+        self._idle = []
+        self._idle_lock = Lock()
+        self._pid = os.getpid()
 
     def make_connection(self, host):
         host = self.get_host_info(host)[0]
-        http = SSLHTTPConnection(host, key=self.key, cert=self.cert, ca=self.ca,
+        return SSLHTTPConnection(host, key=self.key, cert=self.cert, ca=self.ca,
                                  scns=self.scns, timeout=self.timeout)
-        https = httplib.HTTP()
-        https._setup(http)
-        return https
 
-    def request(self, host, handler, request_body, verbose=0):
+    def _checkout(self, host):
+        """Return an idle connection and True, or a new connection and False."""
+        now = time.time()
+        self._idle_lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # connections inherited through fork belong to the parent
+                self._idle = []
+                self._pid = os.getpid()
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if now - last_used < self.keepalive_timeout:
+                    return connection, True
+                connection.close()
+        finally:
+            self._idle_lock.release()
+        return self.make_connection(host), False
+
+    def _checkin(self, connection):
+        self._idle_lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                self._idle.append((connection, time.time()))
+                return
+        finally:
+            self._idle_lock.release()
+        connection.close()
+
+    def close(self):
+        """Close all idle connections."""
+        self._idle_lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._idle_lock.release()
+        for connection, last_used in idle:
+            connection.close()
+
+    def request(self, host, handler, request_body, verbose=0, content_type="text/xml"):
         """Send request to server and return response."""
-        h = self.make_connection(host)
-        self.send_request(h, handler, request_body)
-        self.send_host(h, host)
-        self.send_user_agent(h)
-        self.send_content(h, request_body)
+        for attempt in range(2):
+            connection, reused = self._checkout(host)
+            try:
+                return self._single_request(connection, host, handler, request_body, verbose,
+                                            content_type)
+            except xmlrpclib.Fault:
+                raise
+            except (socket.error, httplib.BadStatusLine, httplib.CannotSendRequest), e:
+                unanswered = self._unanswered(connection, e)
+                connection.close()
+                if reused and attempt == 0 and unanswered:
+                    # the server closed the connection while it was idle
+                    continue
+                self.close()
+                if self.location:
+                    forget_location(self.location)
+                raise
+            except:
+                connection.close()
+                raise
 
-        errcode, errmsg, headers = h.getreply()
+    def _unanswered(self, connection, error):
+        """Return whether a failed request cannot have been run by the server.
 
-        if errcode != 200:
-            raise xmlrpclib.ProtocolError(host + handler, errcode, errmsg, headers)
+        That is so if the connection failed before the request was written, or if it was reset or closed before any of
+        the response arrived.  A request that timed out may still be running, so it is never taken as unanswered; calls
+        such as add_jobs must not be made twice.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if not getattr(connection, 'request_written', False):
+            return True
+        if getattr(connection.sock, 'received', 0):
+            return False
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return isinstance(error, socket.error) and error.args and error.args[0] == errno.ECONNRESET
+
+    def _single_request(self, connection, host, handler, request_body, verbose, content_type):
+        chost, extra_headers, x509 = self.get_host_info(host)
+        connection.request_written = False
+        connection.putrequest("POST", handler, skip_accept_encoding=True)
+        for key, value in extra_headers or []:
+            connection.putheader(key, value)
+        self.send_user_agent(connection)
+        connection.putheader("Content-Type", content_type)
+        if self.accept_compact:
+            connection.putheader("Accept", "%s, text/xml" % JSONRPC.content_type)
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders(request_body)
+        connection.request_written = True
+        if isinstance(connection.sock, ReceiveCounter):
+            connection.sock.received = 0
+
+        response = connection.getresponse(buffering=True)
+        if response.status != 200:
+            response.read()
+            connection.close()
+            raise xmlrpclib.ProtocolError(host + handler, response.status, response.reason,
+                                          response.msg)
 
         self.verbose = verbose
-        msglen = int(headers.dict['content-length'])
-        return self._get_response(h.getfile(), msglen)
+        msglen = int(response.getheader('content-length'))
+        if response.getheader('content-type') == JSONRPC.content_type:
+            data = response.read(msglen)
+            self._release(connection, response)
+            self.compact = True
+            return (JSONRPC.loads_response(data),)
+        try:
+            result = self._get_response(response, msglen)
+        except xmlrpclib.Fault:
+            # the whole response was read; the connection is still good
+            self._release(connection, response)
+            raise
+        self._release(connection, response)
+        return result
+
+    def _release(self, connection, response):
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(connection)
 
     def _get_response(self, fd, length):
         # read response from input file/socket, and parse it
@@ -261,10 +441,71 @@ def register_component (component):
     local_components[component.name] = component
 
 
+def communication_config():
+    """Return the [communication] settings, read once per set of config files."""
+    config_files = tuple(Cobalt.CONFIG_FILES)
+    settings = _communication_config.get(config_files)
+    if settings is not None:
+        return settings
+    settings = {'password':'default', 'key':None, 'cert':None, 'ca':None,
+                'keepalive_timeout':5.0, 'slp_cache_ttl':60.0, 'compact_rpc':True}
+    config = SafeConfigParser()
+    config.read(config_files)
+    try:
+        settings['password'] = config.get('communication', 'password')
+        settings['key'] = os.path.expandvars(config.get('communication', 'key'))
+        settings['cert'] = os.path.expandvars(config.get('communication', 'cert'))
+        settings['ca'] = os.path.expandvars(config.get('communication', 'ca'))
+    except:
+        settings.update({'password':'default', 'key':None, 'cert':None, 'ca':None})
+    for option in ['keepalive_timeout', 'slp_cache_ttl']:
+        try:
+            settings[option] = config.getfloat('communication', option)
+        except:
+            pass
+    try:
+        settings['compact_rpc'] = config.getboolean('communication', 'compact_rpc')
+    except:
+        pass
+    _communication_config.clear()
+    _communication_config[config_files] = settings
+    return settings
+
+
+def locate(component_name):
+    """Return a component's address from service-location, caching it for slp_cache_ttl seconds."""
+    now = time.time()
+    entry = located_servers.get(component_name)
+    if entry is not None and entry[1] > now:
+        return entry[0]
+    try:
+        slp = ComponentProxy("service-location")
+    except ComponentLookupError:
+        raise ComponentLookupError(component_name)
+    try:
+        address = slp.locate(component_name)
+    except:
+        raise ComponentLookupError(component_name)
+    if not address:
+        raise ComponentLookupError(component_name)
+    located_servers[component_name] = (address, now + communication_config()['slp_cache_ttl'])
+    return address
+
+
+def forget_location(address):
+    """Drop cached service-location lookups that resolved to address."""
+    for component_name, entry in located_servers.items():
+        if entry[0] == address:
+            located_servers.pop(component_name, None)
+
+
 def ComponentProxy(component_name, **kwargs):
     
     """Constructs proxies to components.
     
+    Proxies to remote components are shared across the process, so that
+    calls through them reuse open connections.
+    
     Arguments:
     component_name -- name of the component to connect to
     
@@ -277,48 +518,42 @@ def ComponentProxy(component_name, **kwargs):
         return DeferredProxy(component_name, enable_retry)
 
     user = 'root'
-    try:
-        config = SafeConfigParser()
-        config.read(Cobalt.CONFIG_FILES)
-        passwd = config.get('communication', 'password')
-        keypath = os.path.expandvars(config.get('communication', 'key'))
-        certpath = os.path.expandvars(config.get('communication', 'cert'))
-        capath = os.path.expandvars(config.get('communication', 'ca'))
-    except:
-        passwd = 'default'
-        keypath = None
-        certpath = None
-        capath = None
-
-    ssl_trans = XMLRPCTransport(keypath, certpath, capath, timeout=90)    
     
     if component_name in local_components:
         return LocalProxy(local_components[component_name])
     elif component_name in known_servers:
-        method, path = urlparse.urlparse(known_servers[component_name])[:2]
-        newurl = "%s://%s:%s@%s" % (method, user, passwd, path)
-        if enable_retry:
-            return RetryServerProxy(newurl, allow_none=True, transport=ssl_trans)
-        return ServerProxy(newurl, allow_none=True, transport=ssl_trans)
+        address = known_servers[component_name]
+        located = False
     elif component_name != "service-location":
-        try:
-            slp = ComponentProxy("service-location")
-        except ComponentLookupError:
-            raise ComponentLookupError(component_name)
-        try:
-            address = slp.locate(component_name)
-        except:
-            raise ComponentLookupError(component_name)
-        if not address:
-            raise ComponentLookupError(component_name)
-        method, path = urlparse.urlparse(address)[:2]
-        newurl = "%s://%s:%s@%s" % (method, user, passwd, path)
-        if enable_retry:
-            return RetryServerProxy(newurl, allow_none=True, transport=ssl_trans)
-        return ServerProxy(newurl, allow_none=True, transport=ssl_trans)
+        address = locate(component_name)
+        located = True
     else:
         raise ComponentLookupError(component_name)
 
+    settings = communication_config()
+    method, path = urlparse.urlparse(address)[:2]
+    newurl = "%s://%s:%s@%s" % (method, user, settings['password'], path)
+    proxy = server_proxies.get((newurl, enable_retry))
+    if proxy is not None:
+        return proxy
+    _cache_lock.acquire()
+    try:
+        ssl_trans = transports.get(newurl)
+        if ssl_trans is None:
+            ssl_trans = XMLRPCTransport(settings['key'], settings['cert'], settings['ca'], timeout=90,
+                                        keepalive_timeout=settings['keepalive_timeout'],
+                                        location=located and address or None,
+                                        accept_compact=settings['compact_rpc'])
+            transports[newurl] = ssl_trans
+        if enable_retry:
+            proxy = RetryServerProxy(newurl, allow_none=True, transport=ssl_trans)
+        else:
+            proxy = CompactServerProxy(newurl, allow_none=True, transport=ssl_trans)
+        server_proxies[(newurl, enable_retry)] = proxy
+    finally:
+        _cache_lock.release()
+    return proxy
+
 
 
 
@@ -24,6 +24,7 @@ import time
 import ssl
 
 import Cobalt
+from Cobalt import JSONRPC
 from Cobalt.Proxy import ComponentProxy
 
 class ForkedChild(Exception):
@@ -66,29 +67,51 @@ class CobaltXMLRPCDispatcher (SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
         self.allow_none = allow_none
         self.encoding = encoding
 
-    def _marshaled_dispatch (self, data):
+    def _marshaled_dispatch (self, data, content_type="text/xml", accept=""):
+        """Dispatch an encoded call.
+
+        The call is decoded as XML-RPC, or as JSONRPC when content_type says
+        so.  The response is JSONRPC when the client sent or accepts it and
+        the result can be carried in JSON; otherwise it is XML-RPC.
+
+        Returns the encoded response and its content type.
+        """
         method_func = None
-        params, method = xmlrpclib.loads(data)
+        compact = content_type == JSONRPC.content_type
+        if compact:
+            params, method = JSONRPC.loads_request(data)
+        else:
+            params, method = xmlrpclib.loads(data)
+            compact = JSONRPC.content_type in accept
         #print method, "\n" ,params
 
         try:
             #print "%s: %s being poked" % (time.ctime(), method)
             #time.sleep(120)
             response = self.instance._dispatch(method, params, self.funcs)
+            if compact:
+                try:
+                    return JSONRPC.dumps_response(response), JSONRPC.content_type
+                except (TypeError, ValueError):
+                    pass
             response = (response,)
             raw_response = xmlrpclib.dumps(response, methodresponse=1,
                                            allow_none=self.allow_none,
                                            encoding=self.encoding)
         except xmlrpclib.Fault, fault:
+            if compact:
+                return JSONRPC.dumps_fault(fault), JSONRPC.content_type
             raw_response = xmlrpclib.dumps(fault,
                                            allow_none=self.allow_none,
                                            encoding=self.encoding)
         except:
             # report exception back to server
-            raw_response = xmlrpclib.dumps(
-                xmlrpclib.Fault(1, "%s:%s" % (sys.exc_type, sys.exc_value)),
+            fault = xmlrpclib.Fault(1, "%s:%s" % (sys.exc_type, sys.exc_value))
+            if compact:
+                return JSONRPC.dumps_fault(fault), JSONRPC.content_type
+            raw_response = xmlrpclib.dumps(fault,
                 allow_none=self.allow_none, encoding=self.encoding)
-        return raw_response
+        return raw_response, "text/xml"
 
 
 
@@ -261,7 +284,9 @@ class XMLRPCRequestHandler (SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                 size_remaining -= len(L[-1])
             data = ''.join(L)
 
-            response = self.server._marshaled_dispatch(data)
+            content_type = self.headers.get("content-type", "text/xml")
+            accept = self.headers.get("accept", "")
+            response, content_type = self.server._marshaled_dispatch(data, content_type, accept)
         except: 
             raise
             self.send_response(500)
@@ -269,14 +294,34 @@ class XMLRPCRequestHandler (SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
         else:
             # got a valid XML RPC response
             self.send_response(200)
-            self.send_header("Content-type", "text/xml")
+            self.send_header("Content-type", content_type)
             self.send_header("Content-length", str(len(response)))
+            if self.close_connection:
+                self.send_header("Connection", "close")
             self.end_headers()
             self.wfile.write(response)
-
-            # shut down the connection
             self.wfile.flush()
-            self.connection.shutdown(1)
+
+            # shut down the connection unless the client is keeping it alive
+            if self.close_connection:
+                self.connection.shutdown(1)
+
+    def handle_one_request (self):
+        try:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.handle_one_request(self)
+        except (socket.timeout, ssl.SSLError), e:
+            if "timed out" not in str(e) and "eof" not in str(e).lower():
+                raise
+            # an idle kept-alive connection reached the server timeout or
+            # was dropped by the client
+            self.close_connection = 1
+
+    def log_error (self, format, *args):
+        if format.startswith("Request timed out"):
+            # idle keep-alive connections time out routinely
+            self.logger.debug(format % args)
+        else:
+            self.logger.warning(format % args)
    
 
 class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
@@ -297,7 +342,13 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
     Properties:
     require_auth -- the request handler is requiring authorization
     credentials -- valid credentials being used for authentication
+
+    Class attributes:
+    keep_alive -- serve HTTP/1.1 and keep client connections open between
+                  requests (only sensible when each connection has its own thread)
     """
+
+    keep_alive = False
     
     def __init__ (self, server_address, RequestHandlerClass=None,
                   keyfile=None, certfile=None,
@@ -325,6 +376,8 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
         if not RequestHandlerClass:
             class RequestHandlerClass (XMLRPCRequestHandler):
                 """A subclassed request handler to prevent class-attribute conflicts."""
+            if self.keep_alive:
+                RequestHandlerClass.protocol_version = "HTTP/1.1"
 
         SSLServer.__init__(self,
             server_address, RequestHandlerClass,
@@ -396,7 +449,11 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
                         self.instance.do_tasks()
                 except:
                     self.logger.error("Unexpected task failure", exc_info=1)
-                Cobalt.Util.sleep(self.timeout)
+                if self.instance and hasattr(self.instance, 'wait_for_tasks'):
+                    # returns early when a task is triggered
+                    self.instance.wait_for_tasks(self.timeout)
+                else:
+                    Cobalt.Util.sleep(self.timeout)
         except:
             self.logger.error("tasks_thread failed", exc_info=1)
     
@@ -474,6 +531,8 @@ class BaseXMLRPCServer (SSLServer, CobaltXMLRPCDispatcher, object):
 
 
 class XMLRPCServer (SocketServer.ThreadingMixIn, BaseXMLRPCServer): 
+
+    keep_alive = True
     
     def __init__ (self, server_address, RequestHandlerClass=None,
                   keyfile=None, certfile=None,
@@ -517,7 +576,11 @@ class XMLRPCServer (SocketServer.ThreadingMixIn, BaseXMLRPCServer):
                         self.instance.do_tasks()
                 except:
                     self.logger.error("Unexpected task failure", exc_info=1)
-                Cobalt.Util.sleep(self.timeout)
+                if self.instance and hasattr(self.instance, 'wait_for_tasks'):
+                    # returns early when a task is triggered
+                    self.instance.wait_for_tasks(self.timeout)
+                else:
+                    Cobalt.Util.sleep(self.timeout)
         except:
             self.logger.error("tasks_thread failed", exc_info=1)
     
@@ -15,6 +15,8 @@ class StateMachine (DataState):
     _transitions -- list of legal state transitions in the form of (old state, new state) tuples
     _events -- list of events (may include the special 'Progress' state)
     _initial_state -- starting state (must be in the list of legal states)
+    _sm_actions -- dictionary mapping (state, event) tuples to lists of names of the methods run for them; shared by
+        every instance of the class, and run before any actions given to the instance itself
 
     Methods:
     add_action -- add a new action routine to the list of routines associated with a (state, event) tuple
@@ -28,6 +30,7 @@ class StateMachine (DataState):
 
     _events = ['Progress']
     _states = DataState._states + ['Terminal']
+    _sm_actions = {}
 
     def __init__(self, spec, seas = None, terminal_actions = None):
         """
@@ -76,7 +79,7 @@ class StateMachine (DataState):
                             "entry %s in the SEAs dictionary has an action that is not a function: %s" % (key, action))
             self.__seas = seas
         else:
-            self.__seas = {}
+            self.__seas = None
 
         if terminal_actions != None:
             if not isinstance(terminal_actions, list):
@@ -135,7 +138,35 @@ class StateMachine (DataState):
                             "entry %s in the SEAs dictionary has an action that is not a function: %s" % (key, action))
             self.__seas = seas
         else:
-            self.__seas = {}
+            self.__seas = None
+
+    def _class_actions(cls):
+        '''return the class's _sm_actions with each method name resolved to its function, building the table on first use
+
+        The table is kept on the class, so subclasses overriding an action method get their own.
+        '''
+        table = cls.__dict__.get('_StateMachine__class_actions')
+        if table is None:
+            table = {}
+            for key, names in cls._sm_actions.iteritems():
+                if not isinstance(key, tuple) or len(key) != 2:
+                    raise StateMachineError("_sm_actions contains an invalid (state, event) tuple: %s" % (key,))
+                state, event = key
+                if state not in cls._states:
+                    raise StateMachineError("_sm_actions contains an invalid state: %s" % (state,))
+                if state == 'Terminal':
+                    raise StateMachineError("_sm_actions must not contain entries for the 'Terminal' state")
+                if event not in cls._events:
+                    raise StateMachineError("_sm_actions contains an invalid event: %s" % (event,))
+                try:
+                    table[key] = [getattr(cls, name).im_func for name in names]
+                except AttributeError:
+                    raise StateMachineError("entry %s in _sm_actions names a method %s does not have: %s" % \
+                        (key, cls.__name__, names))
+            cls.__class_actions = table
+        return table
+
+    _class_actions = classmethod(_class_actions)
 
 
     def add_action(self, state, event, action):
@@ -159,6 +190,8 @@ class StateMachine (DataState):
             raise StateMachineNonexistentEventError(event)
         if not callable(action):
             raise StateMachineError("action is not a function: %s" % (action,))
+        if self.__seas is None:
+            self.__seas = {}
         if not self.__seas.has_key((state, event)):
             self.__seas[(state, event)] = []
         self.__seas[(state, event)] += [action]
@@ -194,10 +227,17 @@ class StateMachine (DataState):
         StateMachineIllegalEventError -- the specified event is not legal for the current state
         """
 
-        if self.__seas.has_key((DataState._state.__get__(self), event)):
+        key = (DataState._state.__get__(self), event)
+        class_actions = self._class_actions().get(key)
+        seas = self.__seas
+        if class_actions is not None or (seas and seas.has_key(key)):
             self.__event = event
-            for action in self.__seas[(DataState._state.__get__(self), event)]:
-                action(args)
+            if class_actions is not None:
+                for action in class_actions:
+                    action(self, args)
+            if seas and seas.has_key(key):
+                for action in seas[key]:
+                    action(args)
             if DataState._state.__get__(self) == 'Terminal':
                 for action, ta_args in self.__terminal_actions:
                     action(ta_args)
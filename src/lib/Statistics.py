@@ -1,4 +1,6 @@
 
+from threading import Lock
+
 class Statistic(object):
     def __init__(self, name, initial_value):
         self.name = name
@@ -21,13 +23,23 @@ class Statistic(object):
 class Statistics(object):
     def __init__(self):
         self.data = dict()
+        # values are added by read-only methods running side by side
+        self.lock = Lock()
 
     def add_value(self, name, value):
-        if name not in self.data:
-            self.data[name] = Statistic(name, value)
-        else:
-            self.data[name].add_value(value)
+        self.lock.acquire()
+        try:
+            if name not in self.data:
+                self.data[name] = Statistic(name, value)
+            else:
+                self.data[name].add_value(value)
+        finally:
+            self.lock.release()
 
     def display(self):
-        return dict([value.get_value() for value in self.data.values()])
+        self.lock.acquire()
+        try:
+            return dict([value.get_value() for value in self.data.values()])
+        finally:
+            self.lock.release()
             
@@ -17,7 +17,7 @@ from datetime import date, datetime
 from getopt import getopt, GetoptError
 from Cobalt.Exceptions import TimeFormatError, TimerException, ThreadPickledAliveException
 import logging
-from threading import Thread
+from threading import Thread, Event, Lock, Condition
 from Queue import Queue
 import inspect
 import re
@@ -540,6 +540,18 @@ class Timer (object):
 
     has_expired = property(__get_has_expired, doc = "flag indicating if the timer has expired")
 
+    def __get_expiration_time(self):
+        '''determine the time at which the timer expires'''
+        if self.__max_time == None:
+            return None
+        remaining_time = self.__max_time - self.elapsed_time
+        if not self.is_active and remaining_time >= 0:
+            return None
+        return time.time() + remaining_time
+
+    expiration_time = property(__get_expiration_time,
+        doc = "time at which the timer expires, or None if it has no maximum time or is stopped short of it")
+
     def __get_start_times(self):
         '''create and return a duplicate list of the start times'''
         return list(self.__start_times)
@@ -989,3 +1001,111 @@ class disk_writer_thread(Thread):
 
         logger.warn("Non-blocking File IO thread terminated.")
 
+
+class notifier_thread(Thread):
+
+    '''Thread for posting lightweight notifications to another component without blocking the caller
+
+    Notifications posted while one is waiting to be sent are coalesced, so a burst of events costs a single call.  A
+    failed call (for instance, because the component is not running) is logged and dropped; the receiving component is
+    expected to fall back on polling.
+
+    '''
+
+    def __init__(self, component_name, method_name, *args, **kwargs):
+        '''Initialize the thread; it is started by the first post.
+
+        '''
+        super(notifier_thread, self).__init__(*args, **kwargs)
+        self.setDaemon(True)
+        self.component_name = component_name
+        self.method_name = method_name
+        self.pending = Event()
+        self.start_lock = Lock()
+        self.started = False
+
+    def post(self):
+        '''Ask for a notification to be sent.
+
+        '''
+        self.pending.set()
+        if not self.started:
+            self.start_lock.acquire()
+            try:
+                if not self.started:
+                    self.start()
+                    self.started = True
+            finally:
+                self.start_lock.release()
+
+    def run(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            try:
+                proxy = ComponentProxy(self.component_name, defer=False, retry=False)
+                getattr(proxy, self.method_name)()
+            except:
+                logger.debug("unable to notify %s with %s", self.component_name, self.method_name, exc_info=True)
+
+
+class ReadWriteLock(object):
+
+    '''Lock held either by any number of readers at once or by a single writer
+
+    A waiting writer holds back readers arriving after it, so a stream of readers cannot starve writers.  When a writer
+    releases the lock, the readers already waiting are let in ahead of any other writer, so a stream of writers cannot
+    starve readers either.
+
+    '''
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writing = False
+        self.readers_waiting = 0
+        self.writers_waiting = 0
+        # readers that were waiting when the last writer released the lock and have yet to enter
+        self.readers_passed = 0
+
+    def acquire_read(self):
+        self.cond.acquire()
+        try:
+            self.readers_waiting += 1
+            while self.writing or (self.writers_waiting and not self.readers_passed):
+                self.cond.wait()
+            self.readers_waiting -= 1
+            if self.readers_passed:
+                self.readers_passed -= 1
+            self.readers += 1
+        finally:
+            self.cond.release()
+
+    def release_read(self):
+        self.cond.acquire()
+        try:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def acquire_write(self):
+        self.cond.acquire()
+        try:
+            self.writers_waiting += 1
+            while self.writing or self.readers or self.readers_passed:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writing = True
+        finally:
+            self.cond.release()
+
+    def release_write(self):
+        self.cond.acquire()
+        try:
+            self.writing = False
+            self.readers_passed = self.readers_waiting
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
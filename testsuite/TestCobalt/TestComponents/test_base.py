@@ -1,8 +1,8 @@
 import logging
 
-from Cobalt.Components.base import Component, exposed, automatic
+from Cobalt.Components.base import Component, exposed, automatic, readonly
 import Cobalt.Proxy
-import time, random
+import threading, time, random
 from TestCobalt.Utilities.Time import timeout
 
 class TestComponent (object):
@@ -81,3 +81,87 @@ class TestComponent (object):
         while len(component.m4data) > 1:
             assert component.m4data[1] - component.m4data[0] > 4
             component.m4data = component.m4data[1:]
+
+    def test_trigger_automatic (self):
+
+        class TestComponent (Component):
+
+            runs = []
+
+            def method1 (self):
+                self.runs.append(time.time())
+            method1 = automatic(method1, 100)
+
+        component = TestComponent()
+        component.do_tasks()
+        assert len(component.runs) == 1
+        component.do_tasks()
+        assert len(component.runs) == 1
+        component.trigger_automatic('method1')
+        component.do_tasks()
+        assert len(component.runs) == 2
+        component.do_tasks()
+        assert len(component.runs) == 2
+
+        # triggers within the delay are folded into one run
+        start = time.time()
+        for i in range(5):
+            component.trigger_automatic('method1', 0.5)
+        component.do_tasks()
+        assert len(component.runs) == 2
+        component.wait_for_tasks(10)
+        assert 0.4 < time.time() - start < 5
+        component.do_tasks()
+        assert len(component.runs) == 3
+        component.do_tasks()
+        assert len(component.runs) == 3
+
+    def test_wait_for_tasks (self):
+        component = Component()
+        start = time.time()
+        component.wait_for_tasks(0.2)
+        assert time.time() - start >= 0.2
+        timer = threading.Timer(0.2, component.trigger_automatic, ['save'])
+        timer.start()
+        start = time.time()
+        component.wait_for_tasks(30)
+        assert time.time() - start < 10
+        timer.join()
+
+    def test_readonly (self):
+
+        class TestComponent (Component):
+
+            def __init__ (self, **kwargs):
+                Component.__init__(self, **kwargs)
+                self.readers = 0
+                self.overlapped = threading.Event()
+                self.log = []
+
+            def read (self):
+                # returns once the other reader is in as well
+                self.readers += 1
+                if self.readers == 2:
+                    self.overlapped.set()
+                self.overlapped.wait(10)
+                time.sleep(0.1)
+                self.log.append("read")
+            read = exposed(readonly(read))
+
+            def write (self):
+                self.log.append("write")
+            write = exposed(write)
+
+        component = TestComponent()
+        readers = [threading.Thread(target=component._dispatch, args=("read", (), {})) for i in range(2)]
+        for reader in readers:
+            reader.start()
+        component.overlapped.wait(10)
+        assert component.overlapped.isSet()
+        component._dispatch("write", (), {})
+        for reader in readers:
+            reader.join()
+        assert component.log == ["read", "read", "write"]
+        statistics = component.get_statistics()
+        assert statistics['component_lock_read_held'][1] >= 0.1
+        assert 'component_lock_write_wait' in statistics and 'component_lock_wait' not in statistics
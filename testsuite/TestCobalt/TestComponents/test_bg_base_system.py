@@ -0,0 +1,330 @@
+import random
+
+from Cobalt.Components.bg_base_system import BGBaseSystem, BackfillEngine, NodeCard, Partition
+import Cobalt.Components.bg_base_system
+import Cobalt.Proxy
+
+__all__ = [
+    "TestUpdateRelatives", "TestFindJobLocation", "TestBackfillEngine",
+]
+
+def reference_update_relatives(partitions, managed_partitions):
+    """the original O(P^2) algorithm; returns {name: (parents, children, all_children)} for the managed partitions"""
+    parents = dict([(p_name, set()) for p_name in managed_partitions])
+    children = dict([(p_name, set()) for p_name in managed_partitions])
+    all_children = {}
+    for p_name in managed_partitions:
+        p = partitions[p_name]
+        all_children[p_name] = set()
+        for dep_name in p._wiring_conflicts:
+            if dep_name in managed_partitions:
+                parents[p_name].add(dep_name)
+        for other in partitions.itervalues():
+            if p.name == other.name:
+                continue
+            p_set = set(p.node_card_names)
+            other_set = set(other.node_card_names)
+            if p.size == 16 and other.size == 16 and len(p_set ^ other_set) == 0:
+                continue
+            if other.name in managed_partitions:
+                if p_set.intersection(other_set) == p_set:
+                    if p.size < other.size:
+                        parents[p_name].add(other.name)
+                        children[other.name].add(p_name)
+                elif p_set.union(other_set) == p_set:
+                    if p.size > other.size:
+                        children[p_name].add(other.name)
+                        parents[other.name].add(p_name)
+            if p_set.union(other_set) == p_set:
+                if p.size > other.size:
+                    all_children[p_name].add(other.name)
+    for p_name in managed_partitions:
+        for child_name in children[p_name]:
+            for dep_name in partitions[child_name]._wiring_conflicts:
+                if dep_name in managed_partitions:
+                    parents[p_name].add(dep_name)
+            for par_name in list(parents[child_name]):
+                if par_name != p_name and par_name in managed_partitions:
+                    parents[p_name].add(par_name)
+    return dict([(p_name, (parents[p_name], children[p_name], all_children[p_name])) for p_name in managed_partitions])
+
+def reference_backfill_times(partitions, order, now, job_end_times):
+    """the original per-object backfill propagation, visiting the partitions in the given order"""
+    backfill_time = {}
+    for p_name in order:
+        if partitions[p_name].state == "idle":
+            backfill_time[p_name] = now
+        else:
+            backfill_time[p_name] = now + 5*60
+    for p_name in order:
+        if p_name in job_end_times:
+            if job_end_times[p_name] > backfill_time[p_name]:
+                backfill_time[p_name] = job_end_times[p_name]
+            for parent_name in partitions[p_name].parents:
+                if backfill_time[p_name] > backfill_time[parent_name]:
+                    backfill_time[parent_name] = backfill_time[p_name]
+    for p_name in order:
+        if backfill_time[p_name] == now:
+            continue
+        for child_name in partitions[p_name].children:
+            if backfill_time[child_name] == now or backfill_time[child_name] > backfill_time[p_name]:
+                backfill_time[child_name] = backfill_time[p_name]
+    return backfill_time
+
+def reference_scores(partitions, candidates, backfill_time, now=None, walltime=None):
+    """the original blocked-parent scores of the idle candidates a job could use"""
+    scores = {}
+    for p_name in candidates:
+        p = partitions[p_name]
+        if now is not None and 60 * walltime > backfill_time[p_name] - now:
+            continue
+        if p.state == "idle":
+            scores[p_name] = len([parent for parent in p.parents
+                if partitions[parent].state == "idle" and partitions[parent].scheduled])
+    return scores
+
+
+class PartitionFixture (object):
+
+    def setup (self):
+        self.rand = random.Random(42)
+        self.node_cards = {}
+        self.system = BGBaseSystem(register=False)
+
+    def teardown (self):
+        Cobalt.Proxy.local_components.clear()
+
+    def _node_card(self, name):
+        if name not in self.node_cards:
+            self.node_cards[name] = NodeCard(name)
+        return self.node_cards[name]
+
+    def _partition_specs(self, racks):
+        """blocks from half a node card up to the whole machine, in the style of a BG/P"""
+        specs = []
+        midplanes = ["R%02d-M%d" % (rack, midplane) for rack in range(racks) for midplane in range(2)]
+        def _add(name, size, nc_names):
+            specs.append({'name':name, 'size':size, 'queue':"default",
+                'node_cards':[self._node_card(nc_name) for nc_name in nc_names]})
+        for mp in midplanes:
+            nc_names = ["%s-N%02d" % (mp, nc) for nc in range(16)]
+            for nc in range(16):
+                _add("%s-N%02d-J00" % (mp, nc), 16, nc_names[nc:nc + 1])
+                _add("%s-N%02d-J01" % (mp, nc), 16, nc_names[nc:nc + 1])
+            for count, size in [(1, 32), (2, 64), (4, 128), (8, 256), (16, 512)]:
+                for first in range(0, 16, count):
+                    _add("%s-%d-%d" % (mp, size, first), size, nc_names[first:first + count])
+        for first in range(0, len(midplanes), 2):
+            nc_names = ["%s-N%02d" % (mp, nc) for mp in midplanes[first:first + 2] for nc in range(16)]
+            _add("R%02d-1024" % (first / 2), 1024, nc_names)
+        nc_names = ["%s-N%02d" % (mp, nc) for mp in midplanes for nc in range(16)]
+        _add("ALL-%d" % (512 * len(midplanes)), 512 * len(midplanes), nc_names)
+        return specs
+
+    def _add_wiring(self, partitions, count):
+        by_size = {}
+        for p in partitions.itervalues():
+            by_size.setdefault(p.size, []).append(p)
+        big = [parts for size, parts in by_size.iteritems() if size >= 512 and len(parts) > 1]
+        for _ in range(count):
+            if not big:
+                break
+            p1, p2 = self.rand.sample(self.rand.choice(big), 2)
+            p1._wiring_conflicts.add(p2.name)
+            p2._wiring_conflicts.add(p1.name)
+
+
+
+class TestUpdateRelatives (PartitionFixture):
+
+    def _check(self):
+        expected = reference_update_relatives(self.system._partitions, self.system._managed_partitions)
+        for p_name, (parents, children, all_children) in expected.iteritems():
+            p = self.system._partitions[p_name]
+            assert set(p.parents) == parents, (p_name, sorted(set(p.parents) ^ parents))
+            assert set(p.children) == children, (p_name, sorted(set(p.children) ^ children))
+            assert set(p.all_children) == all_children, (p_name, sorted(set(p.all_children) ^ all_children))
+        for p_name, p in self.system._partitions.iteritems():
+            if p_name not in self.system._managed_partitions:
+                assert not p.parents and not p.children and not p.all_children
+
+    def test_all_managed (self):
+        self.system._partitions.q_add(self._partition_specs(4))
+        self._add_wiring(self.system._partitions, 6)
+        self.system.add_partitions([{'name':p_name} for p_name in self.system._partitions])
+        self._check()
+
+    def test_incremental (self):
+        self.system._partitions.q_add(self._partition_specs(2))
+        self._add_wiring(self.system._partitions, 4)
+        names = self.system._partitions.keys()
+        self.system.add_partitions([{'name':p_name} for p_name in self.rand.sample(names, len(names) / 2)])
+        self._check()
+        for _ in range(40):
+            p_name = self.rand.choice(names)
+            if p_name in self.system._managed_partitions:
+                self.system.del_partitions([{'name':p_name}])
+            else:
+                self.system.add_partitions([{'name':p_name}])
+            self._check()
+
+    def test_partitions_replaced (self):
+        self.system._partitions.q_add(self._partition_specs(2))
+        self._add_wiring(self.system._partitions, 4)
+        self.system.add_partitions([{'name':p_name} for p_name in self.system._partitions])
+        self._check()
+        # a partition disappears from the control system and later reappears as a new object
+        for _ in range(10):
+            p_name = self.rand.choice(self.system._partitions.keys())
+            p = self.system._partitions[p_name]
+            for dep_name in p._wiring_conflicts:
+                self.system._partitions[dep_name]._wiring_conflicts.discard(p_name)
+            self.system._managed_partitions.discard(p_name)
+            del self.system._partitions[p_name]
+            self.system.update_relatives()
+            self._check()
+            self.system._partitions.q_add([{'name':p_name, 'size':p.size, 'queue':"default",
+                'node_cards':p.node_cards}])
+            self.system._managed_partitions.add(p_name)
+            self.system.update_relatives()
+            self._check()
+
+
+class TestFindJobLocation (PartitionFixture):
+
+    def setup (self):
+        PartitionFixture.setup(self)
+        self.system._partitions.q_add(self._partition_specs(1))
+        self.system.add_partitions([{'name':p_name} for p_name in self.system._partitions])
+        self.system.set_partitions([{'name':"*"}], {'functional':True, 'scheduled':True})
+
+    def _job(self, jobid, nodes, **kwargs):
+        job = {'jobid':str(jobid), 'nodes':nodes, 'queue':"default", 'utility_score':1, 'walltime':10, 'attrs':{}}
+        job.update(kwargs)
+        return job
+
+    def test_snapshot (self):
+        self.system._partitions["R00-M0-512-0"].state = "busy"
+        snapshot = self.system._snapshot_partitions()
+        assert set(snapshot.keys()) == self.system._managed_partitions
+        part = snapshot["R00-M0-512-0"]
+        assert part.state == "busy"
+        assert set(part.children) == set(self.system._partitions["R00-M0-512-0"].children)
+        part.backfill_time = 1
+        assert self.system._partitions["R00-M0-512-0"].backfill_time is None
+
+    def test_find_job_location (self):
+        best = self.system.find_job_location([self._job(1, 512)], [])
+        assert best.keys() == ['1']
+        assert self.system._partitions[best['1'][0]].size == 512
+        assert self.system._partitions[best['1'][0]].state == "allocated"
+        assert 'find_job_location_snapshot' in self.system.get_statistics()
+
+    def test_find_job_location_required (self):
+        best = self.system.find_job_location([self._job(2, 64, required=["R00-M1-512-0"])], [])
+        assert best.keys() == ['2']
+        assert best['2'][0] in self.system._partitions["R00-M1-512-0"].children
+
+    def test_locations_cache_reused (self):
+        builds = []
+        build_locations_cache = self.system._build_locations_cache
+        def _build_locations_cache():
+            builds.append(1)
+            build_locations_cache()
+        self.system._build_locations_cache = _build_locations_cache
+        self.system.find_job_location([self._job(3, 512)], [])
+        self.system.find_job_location([self._job(4, 512)], [])
+        assert len(builds) == 1
+        self.system.set_partitions([{'name':"R00-M0-512-0"}], {'state':"idle"})
+        self.system.find_job_location([self._job(5, 512)], [])
+        assert len(builds) == 1
+        self.system.set_partitions([{'name':"R00-M0-512-0"}], {'functional':False})
+        self.system.find_job_location([self._job(6, 512)], [])
+        assert len(builds) == 2
+
+    def test_locations_cache_not_functional (self):
+        self.system.set_partitions([{'name':"R00-M0-512-0"}], {'functional':False})
+        self.system.find_job_location([self._job(7, 32)], [])
+        locations = [p.name for p in self.system.possible_locations(32, "default")]
+        assert locations
+        for p_name in locations:
+            assert p_name.startswith("R00-M1-")
+        assert "R00-M0-32-0" in self.system._not_functional_set
+        self.system.set_partitions([{'name':"R00-M0-512-0"}], {'functional':True})
+        self.system.find_job_location([self._job(8, 32)], [])
+        assert "R00-M0-32-0" not in self.system._not_functional_set
+        assert "R00-M0-32-0" in [p.name for p in self.system.possible_locations(32, "default")]
+
+    def test_single_placement (self):
+        best = self.system.find_job_location([self._job(jobid, 32) for jobid in range(10)], [])
+        assert best.keys() == ['0']
+
+    def test_batch_placement (self):
+        Cobalt.Components.bg_base_system.max_jobs_per_pass = 8
+        try:
+            best = self.system.find_job_location([self._job(jobid, 512) for jobid in range(4)], [])
+            assert len(best) == 2
+            assert set([p_names[0] for p_names in best.values()]) == set(["R00-M0-512-0", "R00-M1-512-0"])
+            for p in self.system._partitions.itervalues():
+                p.state = "idle"
+            best = self.system.find_job_location([self._job(jobid, 32) for jobid in range(10)], [])
+            assert len(best) == 8
+            node_cards = [nc for p_names in best.values() for nc in self.system._partitions[p_names[0]].node_card_names]
+            assert len(node_cards) == len(set(node_cards))
+        finally:
+            Cobalt.Components.bg_base_system.max_jobs_per_pass = 1
+
+
+class TestBackfillEngine (PartitionFixture):
+
+    def setup (self):
+        PartitionFixture.setup(self)
+        self.system._partitions.q_add(self._partition_specs(2))
+        self._add_wiring(self.system._partitions, 4)
+        self.system.add_partitions([{'name':p_name} for p_name in self.system._partitions])
+        self.system.set_partitions([{'name':"*"}], {'functional':True, 'scheduled':True})
+        self.partitions = self.system._snapshot_partitions()
+        for p in self.partitions.itervalues():
+            p.state = self.rand.choice(["idle", "idle", "idle", "busy", "blocked"])
+        self.system.cached_partitions = self.partitions
+        self.system.cached_offline_partitions = []
+        self.system._build_locations_cache()
+        self.engine = BackfillEngine(self.partitions, self.system._locations_cache)
+        self.engine.load(self.partitions)
+
+    def test_propagate (self):
+        now = 1000.0
+        for _ in range(5):
+            busy = [p_name for p_name, p in self.partitions.iteritems() if p.state == "busy"]
+            job_end_times = dict([(p_name, now + self.rand.randint(0, 7200)) for p_name in busy])
+            self.engine.propagate(now, job_end_times)
+            expected = reference_backfill_times(self.partitions, self.engine.names, now, job_end_times)
+            for i, p_name in enumerate(self.engine.names):
+                assert self.engine.backfill_time[i] == expected[p_name], p_name
+
+    def test_select (self):
+        now = 1000.0
+        busy = [p_name for p_name, p in self.partitions.iteritems() if p.state == "busy"]
+        job_end_times = dict([(p_name, now + self.rand.randint(0, 7200)) for p_name in busy])
+        self.engine.propagate(now, job_end_times)
+        backfill_time = dict([(p_name, self.engine.backfill_time[i]) for i, p_name in enumerate(self.engine.names)])
+        for size in [32, 64, 128, 256, 512, 1024]:
+            candidates = self.engine.locations["default"][size]
+            for walltime in [None, 10, 60]:
+                if walltime is None:
+                    best = self.engine.select(candidates, set())
+                    scores = reference_scores(self.partitions, [self.engine.names[i] for i in candidates], None)
+                else:
+                    best = self.engine.select(candidates, set(), now, float(walltime), float(walltime))
+                    scores = reference_scores(self.partitions, [self.engine.names[i] for i in candidates],
+                        backfill_time, now, walltime)
+                if not scores:
+                    assert best is None, (size, walltime)
+                else:
+                    assert scores[self.engine.names[best]] == min(scores.values()), (size, walltime)
+
+    def test_forbidden (self):
+        excluded = self.engine.forbidden(["R00-M0-128-4"])
+        expected = set([p_name for p_name, p in self.partitions.iteritems()
+            if p_name == "R00-M0-128-4" or "R00-M0-128-4" in p.children or "R00-M0-128-4" in p.parents])
+        assert set([self.engine.names[i] for i in excluded]) == expected
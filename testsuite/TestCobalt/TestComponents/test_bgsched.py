@@ -0,0 +1,68 @@
+import threading
+import time
+
+import Cobalt.Proxy
+from Cobalt.Components import bgsched
+from Cobalt.Components.bgsched import BGSched, Reservation
+
+__all__ = [
+    "TestBGSchedReservations",
+]
+
+class TestBGSchedReservations (object):
+
+    def setup (self):
+        self.bgsched = BGSched()
+        self.logged = []
+        self.log_to_db = bgsched.dbwriter.log_to_db
+        bgsched.dbwriter.log_to_db = lambda user, event, table, obj: self.logged.append(event)
+
+    def teardown (self):
+        bgsched.dbwriter.log_to_db = self.log_to_db
+        Cobalt.Proxy.local_components.clear()
+
+    def test_get_reservations_activating (self):
+        # the reservation started before the first query, so it activates while being matched
+        reservation = Reservation({'name':"mine", 'start':time.time() - 10, 'duration':600, 'res_id':1})
+        self.bgsched.reservations["mine"] = reservation
+        # results are marshalled, reading the active field again, once the component lock is released, so only the
+        # calls made while matching the specs are counted
+        matching = threading.local()
+        q_get = self.bgsched.reservations.q_get
+        def matching_q_get (specs):
+            matching.active = True
+            try:
+                return q_get(specs)
+            finally:
+                matching.active = False
+        self.bgsched.reservations.q_get = matching_q_get
+        callers = [0]
+        overlaps = []
+        is_active = reservation.is_active
+        def slow_is_active (stime=False):
+            if not getattr(matching, 'active', False):
+                return is_active(stime)
+            callers[0] += 1
+            overlaps.append(callers[0])
+            try:
+                time.sleep(0.2)
+                return is_active(stime)
+            finally:
+                callers[0] -= 1
+        reservation.is_active = slow_is_active
+
+        results = []
+        def query ():
+            results.append(self.bgsched._dispatch('get_reservations', ([{'name':"*", 'active':True}],), {}))
+        threads = [threading.Thread(target=query) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        assert [len(result) for result in results] == [1, 1]
+        # activating the reservation is a change, so the callers take turns
+        assert max(overlaps) == 1
+        assert self.logged == ["activating"]
+        assert reservation.running
+        assert reservation.res_id == 1
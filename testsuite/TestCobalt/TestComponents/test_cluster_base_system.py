@@ -0,0 +1,169 @@
+import json
+import time
+
+import TestCobalt
+import Cobalt.Proxy
+from Cobalt.Components import cluster_base_system
+from Cobalt.Components.cluster_base_system import ClusterBaseSystem
+from Cobalt.Exceptions import ComponentLookupError
+
+__all__ = [
+    "TestClusterCleaning",
+]
+
+class StubForker (object):
+    """Stands in for the system script forker, recording the calls made to it."""
+
+    def __init__ (self):
+        self.next_id = 1
+        self.unavailable = False
+        self.unstarted = set()
+        self.children = {}
+        self.forked = []
+        self.signaled = []
+        self.cleaned = []
+
+    def _new_child (self):
+        child_id = self.next_id
+        self.next_id += 1
+        self.children[child_id] = {'id':child_id, 'complete':False, 'stdout':[], 'stderr':[]}
+        return child_id
+
+    def fork_many (self, specs):
+        if self.unavailable:
+            raise ComponentLookupError("system_script_forker")
+        self.forked.append(('many', [spec['args'][1] for spec in specs]))
+        return [spec['args'][1] not in self.unstarted and self._new_child() or None for spec in specs]
+
+    def fork_fanout (self, args, hosts, tag, label, env, window, host_timeout):
+        if self.unavailable:
+            raise ComponentLookupError("system_script_forker")
+        self.forked.append(('fanout', hosts))
+        return self._new_child()
+
+    def get_children (self, tag, child_ids, output):
+        return [self.children[child_id] for child_id in child_ids if child_id in self.children]
+
+    def signal (self, child_id, signame):
+        self.signaled.append((child_id, signame))
+
+    def cleanup_children (self, child_ids):
+        self.cleaned.extend(child_ids)
+        for child_id in child_ids:
+            self.children.pop(child_id, None)
+
+
+class CleaningSystem (ClusterBaseSystem):
+
+    name = "system"
+    implementation = "cleaning_system"
+
+    def __init__ (self, *args, **kwargs):
+        ClusterBaseSystem.__init__(self, *args, **kwargs)
+        self.finished = []
+
+    def del_process_groups (self, jobid):
+        self.finished.append(jobid)
+
+
+class TestClusterCleaning (object):
+
+    def setup (self):
+        self.forker = StubForker()
+        self.proxy = cluster_base_system.ComponentProxy
+        cluster_base_system.ComponentProxy = lambda name: self.forker
+        self.config = cluster_base_system.config
+        self.config.set('cluster_system', 'epilogue', "/bin/true")
+        self.config.set('cluster_system', 'script_fanout', "false")
+        self.system = CleaningSystem()
+        self.hosts = ["host1", "host2", "host3"]
+        self.system.running_nodes.update(self.hosts)
+        self.system.locations_by_jobid[1] = list(self.hosts)
+        self.system.jobid_to_user[1] = "nobody"
+
+    def teardown (self):
+        cluster_base_system.ComponentProxy = self.proxy
+        for option in ['epilogue', 'script_fanout']:
+            self.config.remove_option('cluster_system', option)
+        Cobalt.Proxy.local_components.clear()
+
+    def complete (self, child_id, stdout=[]):
+        self.forker.children[child_id].update({'complete':True, 'exit_status':0, 'stdout':stdout})
+
+    def test_completion (self):
+        self.system.clean_nodes(self.hosts, "nobody", 1)
+        assert self.forker.forked == [('many', self.hosts)]
+        assert [process['cleaning_id'] for process in self.system.cleaning_processes] == [1, 2, 3]
+        self.complete(1)
+        self.complete(2)
+        self.system.check_done_cleaning()
+        assert self.system.running_nodes == set(["host3"])
+        assert self.forker.cleaned == [1, 2]
+        assert self.system.finished == []
+        self.complete(3)
+        self.system.check_done_cleaning()
+        assert self.system.running_nodes == set() and self.system.down_nodes == set()
+        assert self.system.cleaning_processes == []
+        assert self.system.finished == [1]
+        assert self.system.locations_by_jobid == {} and self.system.cleaning_host_count == {}
+
+    def test_timeout (self):
+        self.system.clean_nodes(self.hosts, "nobody", 1)
+        self.complete(1)
+        for process in self.system.cleaning_processes:
+            process['start_time'] -= process['timeout'] + 1
+        self.system.check_done_cleaning()
+        assert sorted(self.forker.signaled) == [(2, "SIGINT"), (3, "SIGINT")]
+        assert self.system.down_nodes == set(["host2", "host3"])
+        assert self.system.running_nodes == set()
+        assert sorted(self.forker.cleaned) == [1, 2, 3]
+        assert self.system.finished == [1]
+
+    def test_unstarted (self):
+        # a host the forker could not start the epilogue on was never cleaned
+        self.forker.unstarted.add("host2")
+        self.system.clean_nodes(self.hosts, "nobody", 1)
+        assert self.system.down_nodes == set(["host2"])
+        assert self.system.running_nodes == set(["host1", "host3"])
+        assert [process['host'] for process in self.system.cleaning_processes] == ["host1", "host3"]
+        self.complete(1)
+        self.complete(2)
+        self.system.check_done_cleaning()
+        assert self.system.down_nodes == set(["host2"])
+        assert self.system.running_nodes == set()
+        assert self.system.finished == [1]
+
+    def test_retry (self):
+        self.forker.unavailable = True
+        self.system.clean_nodes(self.hosts, "nobody", 1)
+        assert [process['retry'] for process in self.system.cleaning_processes] == [True] * 3
+        self.system.check_done_cleaning()
+        assert self.system.running_nodes == set(self.hosts)
+        self.forker.unavailable = False
+        self.forker.unstarted.add("host3")
+        self.system.retry_cleaning_scripts()
+        assert self.forker.forked == [('many', self.hosts)]
+        assert [(process['host'], process['cleaning_id']) for process in self.system.cleaning_processes] == \
+            [("host1", 1), ("host2", 2)]
+        assert self.system.down_nodes == set(["host3"])
+        self.complete(1)
+        self.complete(2)
+        self.system.check_done_cleaning()
+        assert self.system.running_nodes == set()
+        assert self.system.finished == [1]
+
+    def test_fanout_results (self):
+        self.config.set('cluster_system', 'script_fanout', "true")
+        self.system.clean_nodes(self.hosts, "nobody", 1)
+        assert self.forker.forked == [('fanout', self.hosts)]
+        assert [process['cleaning_id'] for process in self.system.cleaning_processes] == [1, 1, 1]
+        results = [{'host':"host1", 'exit_status':0, 'timed_out':False, 'output':""},
+                   {'host':"host2", 'exit_status':137, 'timed_out':True, 'output':"hung\n"},
+                   {'host':"host3", 'exit_status':1, 'timed_out':False, 'output':"failed\n"}]
+        self.complete(1, [json.dumps(result) for result in results])
+        self.system.check_done_cleaning()
+        assert self.system.down_nodes == set(["host2"])
+        assert self.system.running_nodes == set()
+        assert self.forker.signaled == []
+        assert self.forker.cleaned == [1]
+        assert self.system.finished == [1]
@@ -28,13 +28,15 @@ config_fp.write(CQM_CONFIG_FILE_ENTRY)
 config_fp.close()
 
 import ConfigParser
+import cPickle
 from nose.tools import timed, TimeExpired
 import os
 import os.path
 import pwd
+import shutil
 import tempfile
 import time
-from threading import Lock, Condition
+from threading import Lock, Condition, Thread
 import traceback
 import types
 import unittest
@@ -233,6 +235,42 @@ class TestCQMJobManagement (TestCQMComponent):
         results = self.cqm.get_queues([{'tag':"queue", 'name':"bar"}])
         assert len(results[0].jobs) == 0
 
+    def test_add_jobs_batch(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        self.cqm.add_queues([{'tag':"queue", 'name':"foo"}])
+        queues = ["default", "default", "foo", "default"]
+        jobs = self.cqm.add_jobs([{'tag':"job", 'queue':queue} for queue in queues])
+
+        # the jobs come back in the order submitted, numbered from a single range of ids
+        assert [job.queue for job in jobs] == queues
+        assert [job.jobid for job in jobs] == range(jobs[0].jobid, jobs[0].jobid + len(queues))
+        assert len(self.cqm.Queues['default'].jobs) == 3 and len(self.cqm.Queues['foo'].jobs) == 1
+        # every job, not just the last of each queue, is given the terminal action
+        for job in jobs:
+            assert len(job._StateMachine__terminal_actions) == 1
+
+    def test_add_jobs_batch_restrictions(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        self.cqm.set_queues([{'name':"default"}], {'maxqueued':"10", 'maxnodehours':"100"})
+        self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"alice", 'walltime':"60", 'nodes':"1"}])
+
+        # each spec in a batch counts against the limits for the specs after it
+        def batch(count, user="alice", nodes="1"):
+            return [{'tag':"job", 'queue':"default", 'user':user, 'walltime':"60", 'nodes':nodes} for i in range(count)]
+        for specs in [batch(10), batch(2, "bob", "60")]:
+            try:
+                self.cqm.add_jobs(specs)
+            except QueueError:
+                pass
+            else:
+                assert not "a batch past the queue's limits should be rejected"
+        counts = self.cqm.Queues['default'].jobs.counts
+        assert len(counts.user_jobs['alice']) == 1 and 'bob' not in counts.user_jobs
+        assert counts.batch_jobs == {} and counts.batch_node_hours == {}
+
+        assert len(self.cqm.add_jobs(batch(9) + batch(1, "bob", "60"))) == 10
+        assert len(counts.user_jobs['alice']) == 10
+
     def test_get_jobs(self):
         self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
         self.cqm.add_queues([{'tag':"queue", 'name':"foo"}])
@@ -253,7 +291,149 @@ class TestCQMJobManagement (TestCQMComponent):
 
         results = self.cqm.get_jobs([{'tag':"job", 'jobid':"*", 'queue':"bar"}])
         assert len(results) == 0
+
+    def test_get_jobs_options(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':name, 'walltime':walltime}
+            for name, walltime in [("a", 30), ("b", 10), ("c", 20), ("d", 10)]])
+        specs = [{'tag':"job", 'jobid':"*", 'jobname':"*", 'walltime':"*"}]
+
+        # the options are applied when the query is marshalled for a caller
+        results = self.cqm._dispatch('get_jobs', (specs, {'sort':["walltime", "-jobname"], 'offset':1, 'limit':2}), {})
+        assert [job['jobname'] for job in results] == ["b", "c"]
+        assert sorted(results[0].keys()) == ['jobid', 'jobname', 'tag', 'walltime']
+
+        results = self.cqm._dispatch('get_jobs', (specs, {'sort':["jobname"], 'fields':["jobname"]}), {})
+        assert results == [{'jobname':name} for name in "abcd"]
+
+        assert self.cqm._dispatch('get_jobs', (specs, {'count':True}), {}) == 4
+        assert len(self.cqm._dispatch('get_jobs', (specs,), {})) == 4
+
+    def test_wait_for_jobs(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        [job] = self.cqm.add_jobs([{'tag':"job", 'queue':"default"}])
+        jobid = job.jobid
+        missing = jobid + 1000
+
+        # jobs already in a state return at once, and a job no longer queued is done
+        assert self.cqm.wait_for_jobs([jobid, missing], ["queued", "done"], 30) == \
+            [{'jobid':jobid, 'state':"queued"}, {'jobid':missing, 'state':"done"}]
+        start = time.time()
+        assert self.cqm.wait_for_jobs([jobid], ["user_hold"], 0.2) == []
+        assert time.time() - start >= 0.2
+
+        # a state change wakes a waiting call
+        results = []
+        waiter = Thread(target=lambda: results.append(self.cqm.wait_for_jobs([jobid], ["user_hold"], 30)))
+        waiter.start()
+        time.sleep(0.2)
+        assert waiter.isAlive()
+        start = time.time()
+        self.cqm._dispatch('set_jobs', ([{'tag':"job", 'jobid':jobid}], {'user_hold':True}), {})
+        waiter.join(10)
+        assert not waiter.isAlive() and time.time() - start < 5
+        assert results == [[{'jobid':jobid, 'state':"user_hold"}]]
+        assert Cobalt.Components.cqm.job_watches == {}
+
+    def _wait_in_thread(self, jobid, states, change):
+        # run change while a wait_for_jobs call is watching jobid, returning what the call returned
+        results = []
+        waiter = Thread(target=lambda: results.append(self.cqm.wait_for_jobs([jobid], states, 30)))
+        waiter.start()
+        time.sleep(0.2)
+        assert waiter.isAlive()
+        start = time.time()
+        change()
+        waiter.join(10)
+        assert not waiter.isAlive() and time.time() - start < 5
+        return results[0]
+
+    def test_wait_for_jobs_holds(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        self.cqm.set_queues([{'name':"default"}], {'maxrunning':"1"})
+        jobs = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"alice"} for i in range(2)])
+        queue = self.cqm.Queues['default']
+        running, held = jobs
+        running._DataState__state = 'Running'
+        Cobalt.Components.cqm.schedule_count(running)
+        queue.update_max_running()
+        assert held.state == "maxrun_hold"
+
+        # releasing a maxrunning hold changes no state machine state
+        def release():
+            self.cqm.set_queues([{'name':"default"}], {'maxrunning':"2"})
+            self.cqm.component_lock_acquire()
+            try:
+                queue.update_max_running()
+            finally:
+                self.cqm.component_lock_release()
+        assert self._wait_in_thread(held.jobid, ["queued"], release) == [{'jobid':held.jobid, 'state':"queued"}]
+
+        # nor do dependencies on jobs that will never run
+        depend = lambda: self.cqm._dispatch('set_jobs', ([{'tag':"job", 'jobid':held.jobid}],
+            {'all_dependencies':str(held.jobid + 1000)}), {})
+        assert self._wait_in_thread(held.jobid, ["dep_fail"], depend) == [{'jobid':held.jobid, 'state':"dep_fail"}]
+        clear = lambda: self.cqm._dispatch('set_jobs', ([{'tag':"job", 'jobid':held.jobid}],
+            {'all_dependencies':""}), {})
+        assert self._wait_in_thread(held.jobid, ["queued"], clear) == [{'jobid':held.jobid, 'state':"queued"}]
+        assert Cobalt.Components.cqm.job_watches == {}
     
+    def test_get_jobs_since(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"one"}])
+        self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"two"}])
+        fields = ['jobid', 'jobname', 'state']
+
+        result = self.cqm.get_jobs_since(0, fields)
+        assert result['full']
+        assert sorted([job['jobname'] for job in result['changed']]) == ["one", "two"]
+        seq = result['seq']
+
+        result = self.cqm.get_jobs_since(seq, fields)
+        assert not result['full']
+        assert result['changed'] == [] and result['deleted'] == []
+
+        self.cqm.set_jobs([{'jobname':"one"}], {'jobname':"uno"})
+        self.cqm.del_jobs([{'jobname':"two"}])
+        result = self.cqm.get_jobs_since(seq, fields)
+        assert result['seq'] > seq
+        assert [job['jobname'] for job in result['changed']] == ["uno"]
+        assert len(result['deleted']) == 1
+        seq = result['seq']
+
+        # state transitions are changes; reading the jobs is not
+        self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"three"}])
+        self.cqm.get_jobs([{'tag':"job", 'jobid':"*", 'state':"*", 'is_runnable':"*"}])
+        self.cqm.set_jobs([{'jobname':"uno"}], {'user_hold':True})
+        result = self.cqm.get_jobs_since(seq, fields)
+        assert not result['full']
+        assert sorted([(job['jobname'], job['state']) for job in result['changed']]) == \
+            [("three", "queued"), ("uno", "user_hold")]
+        assert result['deleted'] == []
+        assert self.cqm.get_jobs_since(result['seq'], fields)['changed'] == []
+
+        # the jobs of a deleted queue can not be told apart, so the caller starts over
+        self.cqm.add_queues([{'tag':"queue", 'name':"other"}])
+        self.cqm.add_jobs([{'tag':"job", 'queue':"other", 'jobname':"four"}])
+        seq = self.cqm.get_jobs_since(seq, fields)['seq']
+        self.cqm.del_queues([{'name':"other"}], True)
+        result = self.cqm.get_jobs_since(seq, fields)
+        assert result['full']
+        assert sorted([job['jobname'] for job in result['changed']]) == ["three", "uno"]
+
+    def test_get_queues_since(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}, {'tag':"queue", 'name':"other"}])
+        fields = ['name', 'state']
+        result = self.cqm.get_queues_since(0, fields)
+        assert result['full']
+        seq = result['seq']
+        self.cqm.set_queues([{'name':"default"}], {'state':"running"})
+        self.cqm.del_queues([{'name':"other"}])
+        result = self.cqm.get_queues_since(seq, fields)
+        assert not result['full']
+        assert result['changed'] == [{'name':"default", 'state':"running"}]
+        assert result['deleted'] == ["other"]
+
     def test_del_jobs(self):
         self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
         self.cqm.add_queues([{'tag':"queue", 'name':"foo"}])
@@ -278,6 +458,202 @@ class TestCQMJobManagement (TestCQMComponent):
         results = self.cqm.get_jobs([{'tag':"job", 'user':"wally"}])
         assert len(results) == 0
 
+    def test_dependency_graph(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        [first] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"first"}])
+        [second] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"second",
+                                       'all_dependencies':str(first.jobid)}])
+        [third] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"third",
+                                      'all_dependencies':"%s:%s" % (first.jobid, second.jobid)}])
+        assert self.cqm.dependents[str(first.jobid)] == set([second, third])
+        assert self.cqm.dependents[str(second.jobid)] == set([third])
+        assert second.state == "dep_hold"
+        assert not second.dep_fail
+
+        self.cqm.set_jobs([{'jobname':"third"}], {'all_dependencies':[str(second.jobid)]})
+        assert self.cqm.dependents[str(first.jobid)] == set([second])
+
+        first.exit_status = 0
+        self.cqm._job_terminal_action({'job':first})
+        assert second.satisfied_dependencies == [str(first.jobid)]
+        assert second.state == "queued"
+
+        second.exit_status = 1
+        self.cqm._job_terminal_action({'job':second})
+        assert third.dep_fail
+        assert third.state == "dep_fail"
+
+    def test_dependency_on_missing_job(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        [job] = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'all_dependencies':"999999"}])
+        assert job.dep_fail
+        self.cqm.set_jobs([{'jobid':job.jobid}], {'all_dependencies':[]})
+        assert not job.dep_fail
+        assert "999999" not in self.cqm.dependents
+
+    def test_state_journal_recovery(self):
+        statedir = tempfile.mkdtemp()
+        try:
+            statefile = os.path.join(statedir, "cqm")
+            self.cqm.statefile = statefile
+            self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+            self.cqm.add_queues([{'tag':"queue", 'name':"foo"}])
+            self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"one"}])
+            self.cqm._save_state()
+            snapshot = open(statefile).read()
+
+            self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"two"}])
+            self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"three"}])
+            self.cqm.set_jobs([{'jobname':"one"}], {'queue':"foo", 'user_hold':True})
+            self.cqm.del_jobs([{'jobname':"three"}])
+            self.cqm._save_state()
+            assert open(statefile).read() == snapshot
+
+            # the queue manager dies part way through its next flush
+            journal = open(statefile + ".journal", "ab")
+            journal.write("\0\0\1\0torn")
+            journal.close()
+
+            recovered = cPickle.load(open(statefile))
+            recovered.statefile = statefile
+            recovered.recover()
+            jobs = dict([(job.jobname, job) for job in recovered.get_jobs([{'jobid':"*"}])])
+            assert sorted(jobs) == ["one", "two"]
+            assert jobs['one'].queue == "foo" and jobs['one'].user_hold
+            assert jobs['two'].state == "queued"
+            assert recovered.id_gen.idnum == self.cqm.id_gen.idnum
+
+            # recovery folds the journal into a new snapshot
+            assert open(statefile).read() != snapshot
+            assert recovered.journal.read(recovered.journal_generation) == []
+        finally:
+            shutil.rmtree(statedir)
+
+    def test_state_journal_disabled(self):
+        statedir = tempfile.mkdtemp()
+        state_journal_enabled = Cobalt.Components.cqm.state_journal_enabled
+        try:
+            statefile = os.path.join(statedir, "cqm")
+            self.cqm.statefile = statefile
+            self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+            self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"one"}])
+            self.cqm._save_state()
+            self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'jobname':"two"}])
+            self.cqm._save_state()
+
+            # a restart with journaling turned off replays the journal left behind, once
+            Cobalt.Components.cqm.state_journal_enabled = False
+            recovered = cPickle.load(open(statefile))
+            recovered.statefile = statefile
+            recovered.recover()
+            assert sorted([job.jobname for job in recovered.get_jobs([{'jobid':"*"}])]) == ["one", "two"]
+            assert recovered.journal is None
+            assert not os.path.exists(statefile + ".journal")
+            snapshot = open(statefile).read()
+
+            # later restarts neither start a journal nor rewrite the statefile
+            recovered = cPickle.load(open(statefile))
+            recovered.statefile = statefile
+            recovered.recover()
+            assert sorted([job.jobname for job in recovered.get_jobs([{'jobid':"*"}])]) == ["one", "two"]
+            assert recovered.journal is None
+            assert os.listdir(statedir) == ["cqm"]
+            assert open(statefile).read() == snapshot
+        finally:
+            Cobalt.Components.cqm.state_journal_enabled = state_journal_enabled
+            shutil.rmtree(statedir)
+
+    def test_progress_schedule(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        jobs = self.cqm.add_jobs([{'tag':"job", 'queue':"default"} for i in range(3)])
+        progressed = []
+        for job in jobs:
+            job.progress = lambda job = job: progressed.append(job.jobid)
+
+        # queued jobs have no progress action
+        self.cqm._QueueManager__progress()
+        assert progressed == []
+        assert self.cqm.progress_polled == {} and self.cqm.progress_deadlines == {}
+
+        # a job retrying is visited at every pass; a job being killed only once its signal timer expires
+        retrying, killing = jobs[0], jobs[1]
+        retrying._DataState__state = 'Kill_Retry'
+        killing._DataState__state = 'Killing'
+        killing._Job__signal_timer = Timer(60)
+        killing._Job__signal_timer.start()
+        Cobalt.Components.cqm.schedule_progress(retrying)
+        Cobalt.Components.cqm.schedule_progress(killing)
+        self.cqm._QueueManager__progress()
+        assert progressed == [retrying.jobid]
+        assert killing.jobid in self.cqm.progress_deadlines
+
+        killing._Job__signal_timer.max_time = 0
+        Cobalt.Components.cqm.schedule_progress(killing)
+        self.cqm._QueueManager__progress()
+        assert progressed == [retrying.jobid, retrying.jobid, killing.jobid]
+
+        # jobs leaving the queue leave the schedule
+        self.cqm.Queues['default'].jobs.remove(retrying)
+        self.cqm._QueueManager__progress()
+        assert progressed == [retrying.jobid, retrying.jobid, killing.jobid, killing.jobid]
+        assert self.cqm.progress_polled == {}
+
+    def test_queue_job_counts(self):
+        self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
+        self.cqm.set_queues([{'name':"default"}], {'maxqueued':"3", 'maxnodehours':"10", 'maxrunning':"1"})
+        jobs = self.cqm.add_jobs([{'tag':"job", 'queue':"default", 'user':"alice", 'walltime':"60", 'nodes':"4"}
+            for i in range(2)])
+        queue = self.cqm.Queues['default']
+        counts = queue.jobs.counts
+        assert len(counts.user_jobs['alice']) == 2 and counts.node_hours['alice'] == 8.0
+
+        # node hours are checked against the jobs already queued
+        spec = {'queue':"default", 'user':"alice", 'walltime':"60", 'nodes':"4"}
+        try:
+            self.cqm.can_queue(spec)
+        except QueueError:
+            pass
+        else:
+            assert not "exceeding maxnodehours should prevent queuing the job"
+        spec['nodes'] = "2"
+        self.cqm.can_queue(spec)
+        self.cqm.add_jobs([spec])
+        spec['nodes'] = "0"
+        try:
+            self.cqm.can_queue(spec)
+        except QueueError:
+            pass
+        else:
+            assert not "exceeding maxqueued should prevent queuing the job"
+
+        # a running job holds the user's other jobs, and is counted by its nodes
+        running = jobs[0]
+        running._DataState__state = 'Running'
+        Cobalt.Components.cqm.schedule_count(running)
+        queue.update_max_running()
+        assert queue.jobs.counts.running_nodes == {'alice':4} and queue.jobs.counts.total_running_nodes == 4
+        assert not running.max_running and jobs[1].max_running
+
+        # the job leaving the queue releases them
+        queue.jobs.remove(running)
+        queue.update_max_running()
+        assert not jobs[1].max_running
+        assert queue.jobs.counts.running_nodes == {} and len(queue.jobs.counts.user_jobs['alice']) == 2
+
+        # once the user's last job leaves, a new submission has only the queue's limits to meet
+        for job in list(queue.jobs):
+            queue.jobs.remove(job)
+        assert queue.jobs.counts.user_jobs == {} and queue.jobs.counts.node_hours == {}
+        spec['nodes'] = "11"
+        try:
+            self.cqm.can_queue(spec)
+        except QueueError:
+            pass
+        else:
+            assert not "exceeding maxnodehours should prevent queuing the job"
+        spec['nodes'] = "10"
+        self.cqm.can_queue(spec)
+
     def test_set_jobs(self):
         self.cqm.add_queues([{'tag':"queue", 'name':"default"}])
         self.cqm.add_queues([{'tag':"queue", 'name':"foo"}])
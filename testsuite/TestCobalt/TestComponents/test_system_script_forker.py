@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import TestCobalt
+import Cobalt.Components.base_forker
+from Cobalt.Components.system_script_forker import run_fanout, SystemScriptForker
+
+
+class TestFanout (object):
+
+    def test_results (self):
+        hosts = ["host%d" % i for i in range(10)]
+        results = run_fanout(["/bin/sh", "-c", 'echo $0; test $0 != host3', "{host}"], hosts, 4)
+        assert [result['host'] for result in results] == hosts
+        assert [result['output'] for result in results] == [host + "\n" for host in hosts]
+        assert [result['exit_status'] for result in results] == [0, 0, 0, 1, 0, 0, 0, 0, 0, 0]
+        assert not [result for result in results if result['timed_out']]
+
+    def test_window (self):
+        start = time.time()
+        run_fanout(["/bin/sleep", "0.5"], ["host%d" % i for i in range(6)], 3)
+        elapsed = time.time() - start
+        assert 1.0 <= elapsed < 2.0
+
+    def test_host_timeout (self):
+        start = time.time()
+        results = run_fanout(["/bin/sh", "-c", 'test $0 = slow && sleep 30; exit 0', "{host}"], ["fast", "slow"], 2,
+            host_timeout = 0.5)
+        assert time.time() - start < 5
+        assert [(result['exit_status'], result['timed_out']) for result in results] == [(0, False), (137, True)]
+
+    def test_output_tail (self):
+        [result] = run_fanout(["/bin/sh", "-c", 'head -c 10000 /dev/zero | tr "\\0" y'], ["host"], 1, max_output = 100)
+        assert result['output'] == "y" * 100
+
+    def test_missing_command (self):
+        [result] = run_fanout(["/nonexistent/command"], ["host"], 1)
+        assert result['exit_status'] == 255
+
+
+class TestSystemScriptForker (object):
+
+    def setup (self):
+        self.forker = SystemScriptForker()
+        self.config = Cobalt.Components.base_forker.config
+        if not self.config.has_section('forker'):
+            self.config.add_section('forker')
+        self.spool_dir = tempfile.mkdtemp()
+
+    def teardown (self):
+        for option in ['output_head_size', 'output_tail_size', 'output_spool_dir']:
+            self.config.remove_option('forker', option)
+        shutil.rmtree(self.spool_dir)
+
+    def wait_for_child (self, child_id, timeout=10):
+        # the reaper thread triggers _wait once the child has exited
+        deadline = time.time() + timeout
+        while not self.forker._task_triggers.has_key('_wait'):
+            assert time.time() < deadline, "child was not reaped"
+            time.sleep(0.01)
+        del self.forker._task_triggers['_wait']
+        self.forker._wait()
+        [child] = self.forker.get_children(None, [child_id], True)
+        return child
+
+    def test_reap (self):
+        child_id = self.forker.fork(["/bin/sh", "-c", "echo out; echo err >&2; exit 3"], "test", "test")
+        child = self.wait_for_child(child_id)
+        assert child['complete'] and child['exit_status'] == 3
+        assert child['stdout'] == ["out"] and child['stderr'] == ["err"]
+        assert self.forker.pid_index == {}
+        self.forker.cleanup_children([child_id])
+        assert self.forker.children == {}
+
+    def test_fanout (self):
+        child_id = self.forker.fork_fanout(["/bin/sh", "-c", "echo $0", "{host}"], ["a", "b"], "test", "test", None, 1)
+        child = self.wait_for_child(child_id)
+        assert child['exit_status'] == 0
+        assert [json.loads(line)['output'] for line in child['stdout']] == ["a\n", "b\n"]
+
+    def test_fork_many (self):
+        # the second spec has no command, so that child can not be started
+        child_ids = self.forker.fork_many([{'args':["/bin/sh", "-c", "exit 1"], 'tag':"test", 'label':"one"},
+                                           {'tag':"test", 'label':"bad"},
+                                           {'args':["/bin/sh", "-c", "exit 2"], 'tag':"test", 'label':"two"}])
+        assert child_ids[1] is None
+        assert None not in (child_ids[0], child_ids[2]) and child_ids[0] != child_ids[2]
+        deadline = time.time() + 10
+        while [child for child in self.forker.get_children(None, [child_ids[0], child_ids[2]]) if not child['complete']]:
+            assert time.time() < deadline, "children were not reaped"
+            if self.forker._task_triggers.pop('_wait', None):
+                self.forker._wait()
+            time.sleep(0.01)
+        children = self.forker.get_children(None, [child_ids[0], child_ids[2]])
+        assert [child['exit_status'] for child in children] == [1, 2]
+
+    def test_output_bounds (self):
+        self.config.set('forker', 'output_head_size', '20')
+        self.config.set('forker', 'output_tail_size', '20')
+        child_id = self.forker.fork(["/bin/sh", "-c", "seq 1 1000"], "test", "test")
+        child = self.wait_for_child(child_id)
+        assert child['stdout'][:2] == ["1", "2"] and child['stdout'][-2:] == ["999", "1000"]
+        assert "[3853 bytes omitted]" in child['stdout']
+        assert 'stdout_path' not in child
+        [metadata] = self.forker.get_children(None, [child_id])
+        assert metadata['complete'] and 'stdout' not in metadata and 'stderr' not in metadata
+
+    def test_output_spool (self):
+        self.config.set('forker', 'output_head_size', '0')
+        self.config.set('forker', 'output_tail_size', '5')
+        self.config.set('forker', 'output_spool_dir', self.spool_dir)
+        child_id = self.forker.fork(["/bin/sh", "-c", "seq 1 1000"], "test", "test")
+        child = self.wait_for_child(child_id)
+        assert child['stdout'][-1] == "1000"
+        assert child['stdout'][0].endswith("full stdout in %s]" % (child['stdout_path'],))
+        assert os.path.dirname(child['stdout_path']) == self.spool_dir
+        assert open(child['stdout_path']).read() == "".join(["%d\n" % i for i in range(1, 1001)])
@@ -2,10 +2,13 @@ import time
 import itertools
 import warnings
 
+import xmlrpclib
+
 from Cobalt.Data import IncrID, RandomID, Data, ForeignData, DataList, \
-     DataDict, ForeignData, ForeignDataDict, DataState
+     DataDict, ForeignData, ForeignDataDict, DataState, ChangeLog, changes_since, apply_query_options
 from Cobalt.Exceptions import DataCreationError, DataStateError, DataStateTransitionError
 
+import Cobalt.Data
 import Cobalt.Logging
 
 Cobalt.Logging.setup_logging("test", to_console=True)
@@ -26,6 +29,13 @@ class TestIncrID (object):
             if count >= max:
                 break
 
+    def test_reserve (self):
+        generator = IncrID()
+        generator.get()
+        assert generator.reserve(3) == [2, 3, 4]
+        assert generator.reserve(0) == []
+        assert generator.get() == 5
+
 
 class TestRandomID (object):
     
@@ -253,6 +263,19 @@ class TestDataList (object):
         assert len(self.datalist) == 2
         assert self.datalist[0].tag == "one"
         assert self.datalist[1].tag == "two"
+
+    def test_query_options (self):
+        self.datalist.q_add([{'tag':tag} for tag in ["b", "c", "a"]])
+        items = self.datalist.q_get([{'tag':"*"}])
+        assert [item.tag for item in apply_query_options(items, {'sort':["tag"]})] == ["a", "b", "c"]
+        assert [item.tag for item in apply_query_options(items, {'sort':["-tag"], 'limit':2})] == ["c", "b"]
+        assert [item.tag for item in apply_query_options(items, {'sort':["tag"], 'offset':2})] == ["c"]
+        assert apply_query_options(items, {'count':True, 'limit':1}) == 3
+
+    def test_q_add_callback (self):
+        added = []
+        self.datalist.q_add([{'tag':"one"}, {'tag':"two"}], lambda item, cargs: added.append(item.tag))
+        assert added == ["one", "two"]
     
     def test_q_get (self):
         one = {'tag':"one"}
@@ -328,6 +351,128 @@ class TestDataDict (object):
         assert self.datadict["three"].tag == "three"
 
 
+class IndexedData (Data):
+    fields = Data.fields + ['name', 'state', 'location']
+    def __init__ (self, spec):
+        Data.__init__(self, spec)
+        self.name = spec.get('name')
+        self.state = spec.get('state', "queued")
+        self.location = spec.get('location', None)
+
+
+class TestIndexedDataList (object):
+    
+    def setup (self):
+        self.datalist = DataList()
+        self.datalist.item_cls = IndexedData
+        self.datalist.indexed_fields = ['name', 'state', 'location']
+        self.datalist.q_add([{'name':"one"}, {'name':"two"}, {'name':"three", 'state':"running"}])
+    
+    def test_q_get (self):
+        items = self.datalist.q_get([{'state':"queued"}])
+        assert sorted([item.name for item in items]) == ["one", "two"]
+        items = self.datalist.q_get([{'name':"two", 'state':"running"}, {'name':"three"}])
+        assert [item.name for item in items] == ["three"]
+    
+    def test_update_field (self):
+        self.datalist.q_get([{'state':"queued"}])
+        self.datalist[0].state = "running"
+        self.datalist[1].update({'state':"hold"})
+        assert [item.name for item in self.datalist.q_get([{'state':"queued"}])] == []
+        assert sorted([item.name for item in self.datalist.q_get([{'state':"running"}])]) == ["one", "three"]
+        assert [item.name for item in self.datalist.q_get([{'state':"hold"}])] == ["two"]
+    
+    def test_add_remove (self):
+        self.datalist.q_get([{'state':"queued"}])
+        self.datalist.q_del([{'name':"one"}])
+        moved = self.datalist.pop(0)
+        assert [item.name for item in self.datalist.q_get([{'state':"queued"}])] == []
+        self.datalist.append(moved)
+        assert [item.name for item in self.datalist.q_get([{'state':"queued"}])] == ["two"]
+        # items removed from the list no longer update its index
+        self.datalist.remove(moved)
+        moved.state = "running"
+        assert [item.name for item in self.datalist.q_get([{'state':"running"}])] == ["three"]
+    
+    def test_unhashable_values (self):
+        self.datalist.q_add([{'name':"four", 'location':['R00', 'R01']}])
+        items = self.datalist.q_get([{'location':['R00', 'R01']}])
+        assert [item.name for item in items] == ["four"]
+        items = self.datalist.q_get([{'location':None}])
+        assert sorted([item.name for item in items]) == ["one", "three", "two"]
+    
+    def test_modified_behind_back (self):
+        self.datalist.q_get([{'state':"queued"}])
+        list.append(self.datalist, IndexedData({'name':"four"}))
+        assert sorted([item.name for item in self.datalist.q_get([{'state':"queued"}])]) == ["four", "one", "two"]
+    
+    def test_replace (self):
+        # replacements that leave the length alone must still reach the index
+        self.datalist.q_get([{'state':"queued"}])
+        one = self.datalist[0]
+        self.datalist[0] = IndexedData({'name':"four"})
+        self.datalist[1:2] = [IndexedData({'name':"five"})]
+        self.datalist[2:] = [one]
+        assert sorted([item.name for item in self.datalist.q_get([{'state':"queued"}])]) == ["five", "four", "one"]
+        one.state = "running"
+        assert [item.name for item in self.datalist.q_get([{'state':"running"}])] == ["one"]
+        del self.datalist[0]
+        self.datalist += [IndexedData({'name':"six"})]
+        assert sorted([item.name for item in self.datalist.q_get([{'state':"queued"}])]) == ["five", "six"]
+
+
+class TestIndexedDataDict (object):
+    
+    def setup (self):
+        self.datadict = DataDict()
+        self.datadict.item_cls = IndexedData
+        self.datadict.key = "name"
+        self.datadict.indexed_fields = ['name', 'state']
+        self.datadict.q_add([{'name':"one"}, {'name':"two"}, {'name':"three", 'state':"running"}])
+    
+    def test_q_get (self):
+        items = self.datadict.q_get([{'state':"queued"}])
+        assert sorted([item.name for item in items]) == ["one", "two"]
+        items = self.datadict.q_get([{'state':"*", 'name':"one"}])
+        assert [item.name for item in items] == ["one"]
+        items = self.datadict.q_get([{'tag':"unknown"}])
+        assert len(items) == 3
+    
+    def test_update_field (self):
+        self.datadict.q_get([{'state':"queued"}])
+        self.datadict['one'].state = "running"
+        assert [item.name for item in self.datadict.q_get([{'state':"queued"}])] == ["two"]
+    
+    def test_add_remove (self):
+        self.datadict.q_get([{'state':"queued"}])
+        self.datadict.q_del([{'name':"one"}])
+        del self.datadict['two']
+        self.datadict.q_add([{'name':"four"}])
+        assert [item.name for item in self.datadict.q_get([{'state':"queued"}])] == ["four"]
+        self.datadict.clear()
+        assert self.datadict.q_get([{'state':"queued"}]) == []
+    
+    def test_replace (self):
+        self.datadict.q_get([{'state':"queued"}])
+        self.datadict.update({'one':IndexedData({'name':"one", 'state':"running"}), 'two':IndexedData({'name':"two"})})
+        assert sorted([item.name for item in self.datadict.q_get([{'state':"running"}])]) == ["one", "three"]
+        assert [item.name for item in self.datadict.q_get([{'state':"queued"}])] == ["two"]
+        self.datadict.pop('two')
+        assert self.datadict.q_get([{'state':"queued"}]) == []
+        self.datadict.setdefault('four', IndexedData({'name':"four"}))
+        assert [item.name for item in self.datadict.q_get([{'state':"queued"}])] == ["four"]
+    
+    def test_pickle (self):
+        import cPickle
+        self.datadict.q_get([{'state':"queued"}])
+        datadict = cPickle.loads(cPickle.dumps(self.datadict))
+        assert '_indexes' not in datadict.__dict__
+        assert '_data_indexes' not in datadict['one'].__dict__
+        datadict['one'].state = "running"
+        assert sorted([item.name for item in datadict.q_get([{'state':"running"}])]) == ["one", "three"]
+
+
+
 class TestForeignDataDict (object):
     class my_data (ForeignData):
         fields = ['id', 'value']
@@ -372,3 +517,165 @@ class TestForeignDataDict (object):
         assert f.__oserror__.status == True
         f.Sync()
         assert f.__oserror__.status == False
+
+    class feed_tester (object):
+        def __init__(self, items):
+            self.items = DataDict()
+            self.items.key = 'id'
+            self.items.update(items)
+            self.calls = []
+            self.results = []
+        
+        def Call(self, seq, fields):
+            self.calls.append(seq)
+            result = changes_since([self.items.change_log], seq, 'id', fields)
+            self.results.append(result)
+            return result
+
+    def test_sync_since(self):
+        items = dict([(i, self.my_data({'id':i, 'value':'queued'})) for i in range(1, 4)])
+        s = self.feed_tester(items)
+        f = ForeignDataDict()
+        f.item_cls = self.my_data
+        f.key = 'id'
+        f.__since_function__ = s.Call
+        f.__fields__ = ['id', 'value']
+        f.Sync()
+        assert sorted(f.keys()) == [1, 2, 3]
+        s.items[2].value = 'running'
+        del s.items[3]
+        s.items[4] = self.my_data({'id':4, 'value':'queued'})
+        f.Sync()
+        assert sorted(f.keys()) == [1, 2, 4]
+        assert f[2].value == 'running'
+        f.Sync()
+        assert s.calls == [0, s.results[0]['seq'], s.results[1]['seq']]
+        assert [result['full'] for result in s.results] == [True, False, False]
+        assert s.results[2]['changed'] == [] and s.results[2]['deleted'] == []
+        assert f.__oserror__.status == True
+
+    def test_sync_since_restart(self):
+        items = dict([(i, self.my_data({'id':i, 'value':'queued'})) for i in range(1, 4)])
+        s = self.feed_tester(items)
+        f = ForeignDataDict()
+        f.item_cls = self.my_data
+        f.key = 'id'
+        f.__since_function__ = s.Call
+        f.__fields__ = ['id', 'value']
+        f.Sync()
+        s.items[1].value = 'running'
+        f.Sync()
+        seq = s.results[-1]['seq']
+        # a restarted component may reach the same sequence numbers in a new epoch
+        epoch = Cobalt.Data.modification_epoch
+        Cobalt.Data.modification_epoch = "restarted"
+        try:
+            s.items[1].value = 'exiting'
+            del s.items[2]
+            f.Sync()
+        finally:
+            Cobalt.Data.modification_epoch = epoch
+        assert s.calls[-2:] == [seq, 0]
+        assert sorted(f.keys()) == [1, 3]
+        assert f[1].value == 'exiting'
+
+    def test_sync_since_unsupported(self):
+        def since(seq, fields):
+            raise xmlrpclib.Fault(1, "no such method")
+        f = ForeignDataDict()
+        f.item_cls = self.my_data
+        f.key = 'id'
+        f.__since_function__ = since
+        f.__function__ = lambda specs: [{'id':1, 'value':'queued'}]
+        f.Sync()
+        assert f.keys() == [1]
+        assert not f._feed_supported
+
+
+class TestChangeLog (object):
+    
+    def setup (self):
+        self.items = DataDict()
+        self.items.key = 'id'
+        for i in range(1, 6):
+            self.items[i] = TestForeignDataDict.my_data({'id':i, 'value':'queued'})
+    
+    def since (self, seq):
+        return changes_since([self.items.change_log], seq, 'id', ['value'])
+    
+    def test_full (self):
+        result = self.since(0)
+        assert result['full']
+        assert result['seq'] == Cobalt.Data.modification_seq
+        assert sorted([spec['id'] for spec in result['changed']]) == [1, 2, 3, 4, 5]
+        assert self.since(result['seq'] + 1)['full']
+        assert changes_since([self.items.change_log], result['seq'], 'id', ['value'], full=True)['full']
+    
+    def test_delta (self):
+        seq = self.since(0)['seq']
+        result = self.since(seq)
+        assert not result['full']
+        assert result['seq'] == seq
+        assert result['changed'] == [] and result['deleted'] == []
+        self.items[2].value = 'running'
+        del self.items[5]
+        result = self.since(seq)
+        assert result['seq'] > seq
+        assert result['changed'] == [{'id':2, 'value':'running'}]
+        assert result['deleted'] == [5]
+        assert self.since(result['seq'])['changed'] == []
+    
+    def test_unchanged_values (self):
+        seq = self.since(0)['seq']
+        # assigning the same value, or a private attribute, is not a change
+        self.items[1].value = 'queued'
+        self.items[1]._scratch = 'scratch'
+        assert self.since(seq)['changed'] == []
+        self.items[1].note_change()
+        assert self.since(seq)['changed'] == [{'id':1, 'value':'queued'}]
+    
+    def test_only_changed_items_visited (self):
+        seq = self.since(0)['seq']
+        self.items[3].value = 'running'
+        log = self.items.change_log
+        assert log.items.keys()[-1] is self.items[3]
+        changed, deleted = log.since(seq)
+        assert changed == [self.items[3]] and deleted == []
+    
+    def test_moved_item (self):
+        other = DataDict()
+        other.key = 'id'
+        seq = changes_since([self.items.change_log, other.change_log], 0, 'id', ['value'])['seq']
+        item = self.items.pop(4)
+        other[4] = item
+        result = changes_since([self.items.change_log, other.change_log], seq, 'id', ['value'])
+        assert not result['full']
+        assert result['changed'] == [{'id':4, 'value':'queued'}]
+        assert result['deleted'] == []
+    
+    def test_deleted_expiry (self):
+        log = ChangeLog(max_deleted=2)
+        items = self.items.values()
+        for item in items:
+            log.add(item)
+        seqs = [Cobalt.Data.modification_seq]
+        for item in items[:3]:
+            log.remove(item)
+            seqs.append(Cobalt.Data.modification_seq)
+        assert log.since(seqs[0]) is None
+        changed, deleted = log.since(seqs[1])
+        assert changed == [] and deleted == [items[2], items[1]]
+        # the log no longer follows removed items
+        items[0].value = 'running'
+        assert log.since(seqs[3]) == ([], [])
+    
+    def test_rebuild (self):
+        seq = self.since(0)['seq']
+        dict.__delitem__(self.items, 1)
+        assert self.since(seq)['full']
+        # a list changed behind the log's back starts over as well
+        items = DataList()
+        items.extend(self.items.values())
+        seq = changes_since([items.change_log], 0, 'id', ['value'])['seq']
+        list.append(items, TestForeignDataDict.my_data({'id':6, 'value':'queued'}))
+        assert changes_since([items.change_log], seq, 'id', ['value'])['full']
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import xmlrpclib
+
+from Cobalt import JSONRPC
+
+
+class TestJSONRPC (object):
+
+    def test_request (self):
+        data = JSONRPC.dumps_request("get_jobs", ([{'jobid':"*", 'queue':"default"}],))
+        params, method = JSONRPC.loads_request(data)
+        assert method == "get_jobs"
+        assert params == ([{'jobid':"*", 'queue':"default"}],)
+
+    def test_response (self):
+        result = [{'jobid':1, 'location':["R00", "R01"], 'score':1.5, 'index':None, 'attrs':{'mode':"vn"}}]
+        assert JSONRPC.loads_response(JSONRPC.dumps_response(result)) == result
+
+    def test_strings (self):
+        # like xmlrpclib, ASCII strings come back as str
+        result = JSONRPC.loads_response(JSONRPC.dumps_response({'user':"alice", 'args':["-v"], 'name':u"café"}))
+        assert type(result.keys()[0]) is str
+        assert type(result['user']) is str
+        assert type(result['args'][0]) is str
+        assert result['name'] == u"café"
+
+    def test_fault (self):
+        data = JSONRPC.dumps_fault(xmlrpclib.Fault(20, "Server Failure"))
+        try:
+            JSONRPC.loads_response(data)
+        except xmlrpclib.Fault, fault:
+            assert fault.faultCode == 20
+            assert fault.faultString == "Server Failure"
+        else:
+            assert not "fault not raised"
+
+    def test_unencodable (self):
+        try:
+            JSONRPC.dumps_response(xmlrpclib.DateTime(0))
+        except TypeError:
+            pass
+        else:
+            assert not "DateTime encoded"
@@ -0,0 +1,149 @@
+import logging
+import os
+import shutil
+import tempfile
+import xmlrpclib
+
+from Cobalt.Logging import dbwriter, MessageSpool
+
+
+class FakeWriter (object):
+
+    def __init__ (self, batching=True, fail_after=None):
+        self.batching = batching
+        self.fail_after = fail_after
+        self.calls = []
+        self.received = []
+
+    def _receive (self, msgs):
+        if self.fail_after is not None and len(self.received) + len(msgs) > self.fail_after:
+            raise IOError("connection reset")
+        self.calls.append(len(msgs))
+        self.received.extend(msgs)
+
+    def add_messages (self, msgs):
+        if not self.batching:
+            raise xmlrpclib.Fault(1, "add_messages")
+        self._receive(msgs)
+
+    def add_message (self, msg):
+        self._receive([msg])
+
+
+class TestDBWriter (object):
+
+    def setup (self):
+        self.writer = dbwriter(logging)
+        self.writer.enabled = True
+        self.writer.cdbwriter_alive = True
+        self.writer.batch_size = 4
+        self.writer.msg_queue.extend(["msg%d" % i for i in range(10)])
+
+    def test_batches (self):
+        self.writer.cdbwriter = FakeWriter()
+        self.writer.send_queue()
+        assert self.writer.cdbwriter.calls == [4, 4, 2]
+        assert self.writer.cdbwriter.received == ["msg%d" % i for i in range(10)]
+        assert not self.writer.msg_queue
+
+    def test_single_messages (self):
+        self.writer.cdbwriter = FakeWriter(batching=False)
+        self.writer.send_queue()
+        assert not self.writer.batching
+        assert self.writer.cdbwriter.calls == [1] * 10
+        assert self.writer.cdbwriter.received == ["msg%d" % i for i in range(10)]
+
+    def test_failed_batch_kept (self):
+        self.writer.cdbwriter = FakeWriter(fail_after=6)
+        self.writer.send_queue()
+        assert not self.writer.cdbwriter_alive
+        assert self.writer.cdbwriter.received == ["msg%d" % i for i in range(4)]
+        assert list(self.writer.msg_queue) == ["msg%d" % i for i in range(4, 10)]
+
+    def test_spill_and_drain (self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            self.writer.overflow_filename = os.path.join(spool_dir, "overflow")
+            self.writer.max_queued = 5
+            self.writer.cdbwriter = FakeWriter(fail_after=0)
+            self.writer.send_queue()
+            assert not self.writer.msg_queue
+            self.writer.msg_queue.append("msg10")
+
+            self.writer.cdbwriter = FakeWriter()
+            self.writer.cdbwriter_alive = True
+            self.writer.send_queue()
+            assert self.writer.cdbwriter.received == ["msg%d" % i for i in range(11)]
+            assert self.writer.spool.empty()
+            assert os.listdir(spool_dir) == []
+        finally:
+            shutil.rmtree(spool_dir)
+
+
+    def test_hold (self):
+        self.writer.hold()
+        self.writer.hold()
+        self.writer.log_to_db(None, "creating", "job_data", None)
+        self.writer.release()
+        assert not self.writer.pending.isSet()
+        self.writer.release()
+        assert self.writer.pending.isSet()
+
+
+class TestMessageSpool (object):
+
+    def setup (self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.spool_dir, "overflow")
+
+    def teardown (self):
+        shutil.rmtree(self.spool_dir)
+
+    def drain (self, spool, count):
+        messages = []
+        while not spool.empty():
+            entries, position = spool.read(count)
+            messages.extend([msg for msg, msg_position in entries])
+            spool.consume(position)
+        return messages
+
+    def test_segments (self):
+        spool = MessageSpool(self.path, segment_size=20)
+        spool.append(["message %d" % i for i in range(10)])
+        assert len(spool.segments) == 5
+        entries, position = spool.read(3)
+        assert [msg for msg, msg_position in entries] == ["message 0", "message 1", "message 2"]
+        assert entries[-1][1] == position
+        spool.consume(position)
+        assert len(spool.segments) == 4
+        spool.append(["message 10"])
+        assert self.drain(spool, 4) == ["message %d" % i for i in range(3, 11)]
+        assert os.listdir(self.spool_dir) == []
+
+    def test_cursor_persists (self):
+        spool = MessageSpool(self.path, segment_size=20)
+        spool.append(["message %d" % i for i in range(10)])
+        entries, position = spool.read(5)
+        spool.consume(position)
+        spool = MessageSpool(self.path, segment_size=20)
+        assert self.drain(spool, 2) == ["message %d" % i for i in range(5, 10)]
+
+    def test_old_overflow_file (self):
+        overflow = open(self.path, "w")
+        overflow.write("old 0\nold 1\n")
+        overflow.close()
+        spool = MessageSpool(self.path)
+        spool.append(["new 0"])
+        assert self.drain(spool, 10) == ["old 0", "old 1", "new 0"]
+
+    def test_incomplete_message (self):
+        spool = MessageSpool(self.path)
+        spool.append(["message 0"])
+        segment = open(self.path + ".0", "a")
+        segment.write("torn")
+        segment.close()
+        entries, position = spool.read(10)
+        assert [msg for msg, msg_position in entries] == ["message 0"]
+        spool.consume(position)
+        assert not spool.empty()
+        assert spool.read(10) == ([], position)
@@ -0,0 +1,124 @@
+import errno
+import httplib
+import socket
+
+import Cobalt.Proxy
+from Cobalt.Proxy import ComponentProxy, locate, forget_location, communication_config
+from Cobalt.Components.base import exposed
+from Cobalt.Components.slp import ServiceLocator
+from Cobalt.Exceptions import ComponentLookupError
+
+
+class CountingServiceLocator (ServiceLocator):
+
+    def __init__ (self, *args, **kwargs):
+        ServiceLocator.__init__(self, *args, **kwargs)
+        self.lookups = 0
+
+    def locate (self, service_name):
+        self.lookups += 1
+        return ServiceLocator.locate(self, service_name)
+    locate = exposed(locate)
+
+
+class TestComponentProxy (object):
+
+    def setup (self):
+        Cobalt.Proxy.located_servers.clear()
+        self.slp = CountingServiceLocator()
+        self.slp.register("foo_service", "https://localhost:5900")
+        self.ttl = communication_config()['slp_cache_ttl']
+
+    def teardown (self):
+        Cobalt.Proxy.local_components.clear()
+        Cobalt.Proxy.located_servers.clear()
+        communication_config()['slp_cache_ttl'] = self.ttl
+
+    def test_locate_cached (self):
+        assert locate("foo_service") == "https://localhost:5900"
+        assert locate("foo_service") == "https://localhost:5900"
+        assert self.slp.lookups == 1
+
+    def test_locate_expired (self):
+        communication_config()['slp_cache_ttl'] = 0
+        locate("foo_service")
+        locate("foo_service")
+        assert self.slp.lookups == 2
+
+    def test_locate_unknown (self):
+        try:
+            locate("bar_service")
+        except ComponentLookupError:
+            pass
+        else:
+            assert not "located an unregistered service"
+        assert "bar_service" not in Cobalt.Proxy.located_servers
+
+    def test_forget_location (self):
+        locate("foo_service")
+        forget_location("https://localhost:5900")
+        assert "foo_service" not in Cobalt.Proxy.located_servers
+        locate("foo_service")
+        assert self.slp.lookups == 2
+
+    def test_proxy_shared (self):
+        proxy = ComponentProxy("foo_service", defer=False)
+        assert ComponentProxy("foo_service", defer=False) is proxy
+        assert ComponentProxy("foo_service", defer=False, retry=False) is not proxy
+        assert self.slp.lookups == 1
+
+
+class FakeConnection (object):
+
+    def __init__ (self, written, received, error):
+        self.written = written
+        self.sock = Cobalt.Proxy.ReceiveCounter(None)
+        self.sock.received = received
+        self.error = error
+        self.closed = False
+
+    def close (self):
+        self.closed = True
+
+
+class FailingTransport (Cobalt.Proxy.XMLRPCTransport):
+    '''transport whose idle connection fails as set up, and whose new connections answer'''
+
+    def __init__ (self, connection):
+        Cobalt.Proxy.XMLRPCTransport.__init__(self)
+        self.connection = connection
+        self.requests = 0
+
+    def _checkout (self, host):
+        connection, self.connection = self.connection, None
+        return connection or FakeConnection(True, 0, None), connection is not None
+
+    def _single_request (self, connection, *args):
+        self.requests += 1
+        connection.request_written = connection.written
+        if connection.error:
+            raise connection.error
+        return "answer"
+
+
+class TestXMLRPCTransport (object):
+
+    def request (self, written, received, error):
+        transport = FailingTransport(FakeConnection(written, received, error))
+        try:
+            transport.request("localhost:5900", "/RPC2", "")
+        except (socket.error, httplib.HTTPException):
+            return transport.requests, False
+        return transport.requests, True
+
+    def test_resent_when_unanswered (self):
+        assert self.request(False, 0, socket.error(errno.EPIPE, "broken pipe")) == (2, True)
+        assert self.request(True, 0, httplib.BadStatusLine("")) == (2, True)
+        assert self.request(True, 0, socket.error(errno.ECONNRESET, "reset")) == (2, True)
+
+    def test_not_resent_once_run (self):
+        # the server may have run the call; running add_jobs or fork twice is worse than failing
+        assert self.request(True, 0, socket.timeout("timed out")) == (1, False)
+        assert self.request(False, 0, socket.timeout("timed out")) == (1, False)
+        assert self.request(True, 10, socket.error(errno.ECONNRESET, "reset")) == (1, False)
+        assert self.request(True, 0, socket.error(errno.EPIPE, "broken pipe")) == (1, False)
@@ -6,7 +6,8 @@ import ssl
 import ConfigParser
 
 import Cobalt.Server
-from Cobalt.Server import find_intended_location, XMLRPCServer
+from Cobalt import JSONRPC
+from Cobalt.Server import find_intended_location, XMLRPCServer, CobaltXMLRPCDispatcher
 from Cobalt.Components.base import Component
 
 cp = ConfigParser.ConfigParser()
@@ -210,3 +211,46 @@ class TestXMLRPCServer_https (XMLRPCServerTester):
     def test_url (self):
         hname = socket.gethostname()
         assert self.server.url == "https://%s:5900" % hname, self.server.url
+
+
+class TestCompactDispatch (object):
+
+    def setup (self):
+        self.dispatcher = CobaltXMLRPCDispatcher(True, None)
+        self.dispatcher.register_instance(Component())
+
+    def test_xml (self):
+        response, content_type = self.dispatcher._marshaled_dispatch(
+            xmlrpclib.dumps((), "get_name"))
+        assert content_type == "text/xml"
+        assert xmlrpclib.loads(response)[0] == ("component",)
+
+    def test_accept_compact (self):
+        response, content_type = self.dispatcher._marshaled_dispatch(
+            xmlrpclib.dumps((), "get_name"), "text/xml", "%s, text/xml" % JSONRPC.content_type)
+        assert content_type == JSONRPC.content_type
+        assert JSONRPC.loads_response(response) == "component"
+
+    def test_compact_request (self):
+        response, content_type = self.dispatcher._marshaled_dispatch(
+            JSONRPC.dumps_request("get_name", []), JSONRPC.content_type)
+        assert content_type == JSONRPC.content_type
+        assert JSONRPC.loads_response(response) == "component"
+
+    def test_compact_fault (self):
+        response, content_type = self.dispatcher._marshaled_dispatch(
+            JSONRPC.dumps_request("no_such_method", []), JSONRPC.content_type)
+        try:
+            JSONRPC.loads_response(response)
+        except xmlrpclib.Fault:
+            pass
+        else:
+            assert not "fault not returned"
+
+    def test_compact_fallback (self):
+        # values JSON cannot carry are answered in XML-RPC
+        self.dispatcher.register_function(lambda: xmlrpclib.DateTime(0), "get_time")
+        response, content_type = self.dispatcher._marshaled_dispatch(
+            JSONRPC.dumps_request("get_time", []), JSONRPC.content_type)
+        assert content_type == "text/xml"
+        assert isinstance(xmlrpclib.loads(response)[0][0], xmlrpclib.DateTime)
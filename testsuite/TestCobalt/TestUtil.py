@@ -1,5 +1,6 @@
-from Cobalt.Util import Timer
+from Cobalt.Util import Timer, ReadWriteLock
 from Cobalt.Exceptions import TimerException
+import threading
 import time
 
 class TestTimers (object):
@@ -43,3 +44,43 @@ class TestTimers (object):
         time.sleep(sleep_time)
         assert t.has_expired
         t.stop()
+
+class TestReadWriteLock (object):
+    def run (self, func):
+        thread = threading.Thread(target=func)
+        thread.start()
+        time.sleep(0.1)
+        return thread
+
+    def test_readers_share(self):
+        lock = ReadWriteLock()
+        lock.acquire_read()
+        reader = self.run(lock.acquire_read)
+        assert not reader.isAlive()
+        writer = self.run(lock.acquire_write)
+        assert writer.isAlive()
+        lock.release_read()
+        lock.release_read()
+        writer.join(5)
+        assert not writer.isAlive()
+        lock.release_write()
+
+    def test_fairness(self):
+        lock = ReadWriteLock()
+        lock.acquire_read()
+        # a waiting writer holds back new readers
+        writer = self.run(lock.acquire_write)
+        reader = self.run(lock.acquire_read)
+        assert writer.isAlive() and reader.isAlive()
+        lock.release_read()
+        writer.join(5)
+        assert not writer.isAlive() and reader.isAlive()
+        # the readers waiting on a writer go ahead of the next writer
+        next_writer = self.run(lock.acquire_write)
+        lock.release_write()
+        reader.join(5)
+        assert not reader.isAlive() and next_writer.isAlive()
+        lock.release_read()
+        next_writer.join(5)
+        assert not next_writer.isAlive()
+        lock.release_write()
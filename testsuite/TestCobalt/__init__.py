@@ -16,6 +16,9 @@ log_dir: /tmp
 
 [bgsched]
 utility_file: /dev/null
+
+[cluster_system]
+hostfile: /dev/null
 """)
 fp.close()
 
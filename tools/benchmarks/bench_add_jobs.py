@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+'''Measure the throughput of submitting a large batch of jobs to cqm in a single add_jobs call, the way a cqsub wrapper
+submitting a parameter sweep does.
+
+The queue carries maxqueued, maxnodehours and maxrunning restrictions so that the restriction checks are included.
+
+usage: bench_add_jobs.py [number of jobs ...]
+'''
+__revision__ = '$Revision$'
+
+import os
+import sys
+import tempfile
+import time
+
+import Cobalt
+
+fd, config_file = tempfile.mkstemp()
+os.write(fd, "[cqm]\nlog_dir: %s\n\n[bgsched]\nutility_file: /dev/null\n" % (tempfile.gettempdir(), ))
+os.close(fd)
+Cobalt.CONFIG_FILES = [config_file]
+
+import Cobalt.Components.cqm
+from Cobalt.Components.cqm import QueueManager
+
+def make_spec (n):
+    return {'tag':"job", 'jobid':"*", 'queue':"default", 'user':"user%d" % (n % 7), 'project':"project%d" % (n % 3),
+            'walltime':"30", 'nodes':"512", 'procs':"512", 'mode':"script", 'command':"/home/user/bin/a.out",
+            'args':["-n", str(n)], 'cwd':"/home/user", 'outputdir':"/home/user/runs", 'attrs':{}, 'envs':{}}
+
+def run (count):
+    cqm = QueueManager()
+    cqm.add_queues([{'tag':"queue", 'name':"default"}])
+    cqm.set_queues([{'name':"default"}], {'state':"running", 'maxqueued':str(count), 'maxnodehours':str(count * 512),
+        'maxrunning':"10"})
+    specs = [make_spec(n) for n in xrange(count)]
+    start = time.time()
+    jobs = cqm.add_jobs(specs)
+    elapsed = time.time() - start
+    assert len(jobs) == count
+    print "%8d %10.2f %12.0f" % (count, elapsed, count / elapsed)
+    sys.stdout.flush()
+
+def main (counts):
+    print "%8s %10s %12s" % ("jobs", "time (s)", "jobs/s")
+    sys.stdout.flush()
+    for count in counts:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run(count)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+    os.remove(config_file)
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+'''Measure how quickly the simulator refills an empty machine from a queue of small jobs, placing one job per
+scheduling pass and placing a batch of jobs per pass.
+
+usage: bench_batch_placement.py [number of racks] [batch size] [scheduling interval in seconds]
+'''
+__revision__ = '$Revision$'
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+import Cobalt.Components.bg_base_system
+from Cobalt.Components.simulator import Simulator
+
+def write_config (racks):
+    '''write a simulator partition file with blocks from 32 nodes up to a rack'''
+    lines = ["<BG>", "<PartitionList>"]
+    def _add (name, nc_names):
+        lines.append("   <Partition name='%s'>" % (name, ))
+        lines.extend(["      <NodeCard id='%s' />" % (nc_name, ) for nc_name in nc_names])
+        lines.append("   </Partition>")
+    for rack in range(racks):
+        rack_nc_names = []
+        for midplane in range(2):
+            mp = "R%02d-M%d" % (rack, midplane)
+            nc_names = ["%s-N%02d" % (mp, nc) for nc in range(16)]
+            rack_nc_names.extend(nc_names)
+            for count, size in [(1, 32), (2, 64), (4, 128), (8, 256), (16, 512)]:
+                for first in range(0, 16, count):
+                    _add("%s-%d-%d" % (mp, size, first), nc_names[first:first + count])
+        _add("R%02d-1024" % (rack, ), rack_nc_names)
+    lines.extend(["</PartitionList>", "</BG>"])
+    fd, path = tempfile.mkstemp(suffix=".xml")
+    os.write(fd, "\n".join(lines))
+    os.close(fd)
+    return path
+
+def refill (config_file, batch_size, job_count):
+    '''returns the number of scheduling passes needed to start the queued jobs, and the time spent in the allocator'''
+    Cobalt.Components.bg_base_system.max_jobs_per_pass = batch_size
+    system = Simulator(config_file=config_file, register=False)
+    system.add_partitions([{'name':"*"}])
+    system.set_partitions([{'name':"*"}], {'functional':True, 'scheduled':True})
+    rand = random.Random(1)
+    queued = [{'jobid':str(jobid), 'nodes':rand.choice([32, 32, 64, 128]), 'queue':"default", 'utility_score':1,
+        'walltime':rand.randint(60, 600), 'attrs':{}} for jobid in range(job_count)]
+    end_times = []
+    passes = 0
+    allocator_time = 0.0
+    while queued:
+        start = time.time()
+        best_partition_dict = system.find_job_location(queued, end_times)
+        allocator_time += time.time() - start
+        if not best_partition_dict:
+            break
+        passes += 1
+        for job in [job for job in queued if best_partition_dict.has_key(job['jobid'])]:
+            location = best_partition_dict[job['jobid']][0]
+            system.reserve_partition(location)
+            end_times.append([[location], time.time() + 60 * job['walltime']])
+            queued.remove(job)
+    return passes, job_count - len(queued), allocator_time
+
+if __name__ == '__main__':
+    racks = 4
+    batch_size = 16
+    interval = 10
+    if len(sys.argv) > 1:
+        racks = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        batch_size = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        interval = float(sys.argv[3])
+
+    config_file = write_config(racks)
+    try:
+        for size in [1, batch_size]:
+            passes, started, allocator_time = refill(config_file, size, racks * 64)
+            print "batch size %3d: %4d jobs started in %4d passes (%6.0f s at %g s per pass, %.1f jobs/min); " \
+                "allocator %.2f s" % (size, started, passes, passes * interval, interval,
+                60.0 * started / (passes * interval), allocator_time)
+    finally:
+        os.unlink(config_file)
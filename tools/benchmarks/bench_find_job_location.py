@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+'''Time find_job_location on a full machine, where every job in the queue has to be tried and drained for.
+
+usage: bench_find_job_location.py [number of racks] [number of jobs] [number of passes]
+'''
+__revision__ = '$Revision$'
+
+import random
+import sys
+import time
+
+from Cobalt.Components.bg_base_system import BGBaseSystem
+from bench_partition_snapshot import make_specs
+
+if __name__ == '__main__':
+    racks = 20
+    job_count = 300
+    passes = 3
+    if len(sys.argv) > 1:
+        racks = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        job_count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        passes = int(sys.argv[3])
+
+    rand = random.Random(1)
+    system = BGBaseSystem(register=False)
+    system._partitions.q_add(make_specs(racks))
+    system.add_partitions([{'name':p_name} for p_name in system._partitions])
+    end_times = []
+    for p_name in [p_name for p_name in system._partitions if '-512-' in p_name]:
+        part = system._partitions[p_name]
+        part.state = "busy"
+        for p in part._children | part._parents:
+            p.state = "blocked (%s)" % (p_name,)
+        end_times.append(((p_name,), time.time() + rand.randint(0, 7200)))
+    jobs = [{'jobid':str(jobid), 'nodes':rand.choice([32, 64, 128]), 'queue':"default", 'utility_score':1,
+        'walltime':600, 'attrs':{}} for jobid in range(job_count)]
+
+    system.find_job_location(jobs[:1], end_times)
+    start = time.time()
+    for _ in xrange(passes):
+        system.find_job_location(jobs, end_times)
+    print "%d partitions, %d jobs: %.2f ms/pass" % (len(system._partitions), job_count,
+        1000 * (time.time() - start) / passes)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+'''Measure the memory held by cqm jobs, and the time to create, save and reload them the way cqm saves and restores
+its statefile.
+
+Each size runs in a child process so that its memory is measured from a clean start.
+
+usage: bench_job_memory.py [number of jobs ...]
+'''
+__revision__ = '$Revision$'
+
+import cPickle
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import Cobalt
+
+fd, config_file = tempfile.mkstemp()
+os.write(fd, "[cqm]\nlog_dir: %s\n\n[bgsched]\nutility_file: /dev/null\n" % (tempfile.gettempdir(), ))
+os.close(fd)
+Cobalt.CONFIG_FILES = [config_file]
+
+from Cobalt.Components.cqm import Job
+
+def max_rss ():
+    '''peak resident set size of this process in MB'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def make_job (jobid):
+    return Job({'tag':"job", 'jobid':jobid, 'queue':"default", 'user':"user%d" % (jobid % 97),
+                'project':"project%d" % (jobid % 13), 'walltime':30 + jobid % 720, 'nodes':512, 'procs':512,
+                'mode':"script", 'command':"/home/user/bin/a.out", 'args':["-n", str(jobid)],
+                'cwd':"/home/user", 'outputdir':"/home/user/runs", 'attrs':{}, 'envs':{}})
+
+def run (count):
+    base = max_rss()
+    start = time.time()
+    jobs = [make_job(jobid) for jobid in xrange(1, count + 1)]
+    create_time = time.time() - start
+    held = max_rss() - base
+
+    start = time.time()
+    data = cPickle.dumps(jobs)
+    dump_time = time.time() - start
+
+    del jobs
+    start = time.time()
+    cPickle.loads(data)
+    load_time = time.time() - start
+
+    print "%8d %10.0f %10.2f %10.2f %10.1f %10.2f" % (count, held, create_time, dump_time, len(data) / 1e6, load_time)
+    sys.stdout.flush()
+
+def main (counts):
+    print "%8s %10s %10s %10s %10s %10s" % ("jobs", "rss (MB)", "create (s)", "dump (s)", "size (MB)", "load (s)")
+    sys.stdout.flush()
+    for count in counts:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run(count)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+    os.remove(config_file)
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 50000, 100000])
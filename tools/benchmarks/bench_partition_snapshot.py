@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+'''Compare deep-copying the partitions with taking a PartitionSnapshot at the start of find_job_location.
+
+usage: bench_partition_snapshot.py [number of racks] [number of passes]
+'''
+__revision__ = '$Revision$'
+
+import copy
+import sys
+import time
+
+from Cobalt.Components.bg_base_system import BGBaseSystem, NodeCard
+
+def make_specs (racks):
+    specs = []
+    node_cards = {}
+    def _add (name, size, nc_names):
+        for nc_name in nc_names:
+            node_cards.setdefault(nc_name, NodeCard(nc_name))
+        specs.append({'name':name, 'size':size, 'queue':"default", 'scheduled':True, 'functional':True,
+            'node_cards':[node_cards[nc_name] for nc_name in nc_names]})
+    midplanes = ["R%02d-M%d" % (rack, midplane) for rack in range(racks) for midplane in range(2)]
+    for mp in midplanes:
+        nc_names = ["%s-N%02d" % (mp, nc) for nc in range(16)]
+        for count, size in [(1, 32), (2, 64), (4, 128), (8, 256), (16, 512)]:
+            for first in range(0, 16, count):
+                _add("%s-%d-%d" % (mp, size, first), size, nc_names[first:first + count])
+    return specs
+
+def time_it (func, passes):
+    times = []
+    for _ in xrange(passes):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return 1000 * sum(times) / len(times)
+
+if __name__ == '__main__':
+    racks = 40
+    passes = 5
+    if len(sys.argv) > 1:
+        racks = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        passes = int(sys.argv[2])
+
+    system = BGBaseSystem(register=False)
+    system._partitions.q_add(make_specs(racks))
+    system.add_partitions([{'name':p_name} for p_name in system._partitions])
+    print "%d partitions, %d passes" % (len(system._partitions), passes)
+    print "deepcopy  %8.2f ms/pass" % time_it(lambda: copy.deepcopy(system.partitions), passes)
+    print "snapshot  %8.2f ms/pass" % time_it(system._snapshot_partitions, passes)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+'''Time the queries made by a bgsched scheduling pass with and without secondary indexes.
+
+usage: bench_q_get.py [number of jobs] [number of passes]
+'''
+__revision__ = '$Revision$'
+
+import random
+import sys
+import time
+
+from Cobalt.Data import Data, DataDict
+
+QUEUES = ['default', 'short', 'long', 'backfill', 'R.maint']
+STATES = ['queued'] * 8 + ['running', 'user_hold']
+
+
+class BenchJob (Data):
+    fields = Data.fields + ['jobid', 'queue', 'state', 'user', 'location', 'is_runnable', 'has_resources']
+
+    def __init__ (self, spec):
+        Data.__init__(self, spec)
+        self.jobid = spec['jobid']
+        self.queue = spec['queue']
+        self.state = spec['state']
+        self.user = spec['user']
+        self.location = spec.get('location')
+        self.is_runnable = self.state == 'queued'
+        self.has_resources = self.state == 'running'
+
+
+class ScanJobDict (DataDict):
+    item_cls = BenchJob
+    key = 'jobid'
+
+
+class IndexedJobDict (ScanJobDict):
+    indexed_fields = ['jobid', 'queue', 'state', 'user', 'location', 'is_runnable', 'has_resources']
+
+
+def make_specs (count):
+    rand = random.Random(count)
+    specs = []
+    for jobid in xrange(1, count + 1):
+        state = rand.choice(STATES)
+        spec = {'jobid':jobid, 'queue':rand.choice(QUEUES), 'state':state, 'user':"user%d" % rand.randrange(200)}
+        if state == 'running':
+            spec['location'] = ["ANL-R%02d-1024" % rand.randrange(40)]
+        specs.append(spec)
+    return specs
+
+def scheduling_pass (jobs, started):
+    '''the queries bgsched makes per pass: runnable jobs per equivalence class, running jobs, and the started jobs'''
+    for eq_queues in [QUEUES[:2], QUEUES[2:4]]:
+        jobs.q_get([{'is_runnable':True, 'queue':queue} for queue in eq_queues])
+        jobs.q_get([{'has_resources':True}])
+    jobs.q_get([{'queue':QUEUES[4], 'is_runnable':True}])
+    jobs.q_get([{'jobid':jobid} for jobid in started])
+
+def churn (jobs, rand, count):
+    '''simulate the state changes a sync applies between passes'''
+    for job in rand.sample(jobs.values(), count):
+        job.state = rand.choice(STATES)
+        job.is_runnable = job.state == 'queued'
+        job.has_resources = job.state == 'running'
+
+def run (cls, specs, passes):
+    rand = random.Random(0)
+    jobs = cls()
+    jobs.q_add(specs)
+    scheduling_pass(jobs, [])
+    times = []
+    for _ in xrange(passes):
+        churn(jobs, rand, 100)
+        started = [rand.randrange(1, len(specs) + 1) for _ in xrange(10)]
+        start = time.time()
+        scheduling_pass(jobs, started)
+        times.append(time.time() - start)
+    return times
+
+if __name__ == '__main__':
+    job_count = 50000
+    passes = 10
+    if len(sys.argv) > 1:
+        job_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        passes = int(sys.argv[2])
+
+    specs = make_specs(job_count)
+    print "%d jobs, %d scheduling passes" % (job_count, passes)
+    for label, cls in [("scan", ScanJobDict), ("indexed", IndexedJobDict)]:
+        times = run(cls, specs, passes)
+        print "%-8s mean %8.2f ms/pass  min %8.2f ms  max %8.2f ms" % (label, 1000 * sum(times) / len(times),
+            1000 * min(times), 1000 * max(times))
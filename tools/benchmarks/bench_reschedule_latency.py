@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+'''Measure submit-to-start latency of a scheduler that only polls against one that is also woken by reschedule
+notifications.
+
+The scheduler pass and the server task loop run on the usual 10 second period and the notification delay is 1 second,
+all scaled down by the given factor so that the run finishes quickly; latencies are reported in unscaled seconds.
+
+usage: bench_reschedule_latency.py [number of jobs] [scale]
+'''
+__revision__ = '$Revision$'
+
+import random
+import sys
+import threading
+import time
+
+from Cobalt.Components.base import Component, automatic
+
+def make_scheduler (period):
+    class Scheduler (Component):
+        name = "scheduler"
+
+        def __init__ (self, *args, **kwargs):
+            Component.__init__(self, *args, **kwargs)
+            self.pending = []
+            self.latencies = []
+
+        def schedule_jobs (self):
+            now = time.time()
+            while self.pending:
+                self.latencies.append(now - self.pending.pop())
+        schedule_jobs = automatic(schedule_jobs, period)
+    return Scheduler(register=False)
+
+def run (job_count, scale, notify):
+    scheduler = make_scheduler(10.0 / scale)
+    running = [True]
+    def _tasks_thread ():
+        # same loop as the server's task thread
+        while running[0]:
+            scheduler.do_tasks()
+            if notify:
+                scheduler.wait_for_tasks(10.0 / scale)
+            else:
+                time.sleep(10.0 / scale)
+    thread = threading.Thread(target=_tasks_thread)
+    thread.start()
+    rand = random.Random(1)
+    try:
+        for _ in range(job_count):
+            time.sleep(rand.uniform(0, 20.0 / scale))
+            scheduler.pending.append(time.time())
+            if notify:
+                scheduler.trigger_automatic('schedule_jobs', 1.0 / scale)
+        while scheduler.pending:
+            time.sleep(0.1)
+    finally:
+        running[0] = False
+        thread.join()
+    return sorted([latency * scale for latency in scheduler.latencies])
+
+def percentile (values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+if __name__ == '__main__':
+    job_count = 40
+    scale = 10.0
+    if len(sys.argv) > 1:
+        job_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        scale = float(sys.argv[2])
+
+    for label, notify in [("polling", False), ("notified", True)]:
+        latencies = run(job_count, scale, notify)
+        print "%-9s min %5.1f s  p50 %5.1f s  p90 %5.1f s  max %5.1f s" % (label, latencies[0],
+            percentile(latencies, 0.5), percentile(latencies, 0.9), latencies[-1])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+'''Time marshaling a get_jobs response in XML-RPC and in the compact JSON encoding.
+
+Each job carries the kinds of values a full get_jobs spec returns: strings,
+integers, floats, None, lists and an attrs dictionary.
+
+usage: bench_rpc_encoding.py [number of jobs] [repetitions]
+'''
+__revision__ = '$Revision$'
+
+import sys
+import time
+import xmlrpclib
+
+from Cobalt import JSONRPC
+
+QUEUES = ['default', 'short', 'long', 'backfill', 'R.maint']
+STATES = ['queued'] * 8 + ['running', 'user_hold']
+
+
+def make_jobs (count):
+    jobs = []
+    for jobid in xrange(1, count + 1):
+        state = STATES[jobid % len(STATES)]
+        jobs.append({
+            'jobid':jobid, 'jobname':"job%d" % jobid, 'queue':QUEUES[jobid % len(QUEUES)],
+            'state':state, 'user':"user%d" % (jobid % 97), 'project':"project%d" % (jobid % 13),
+            'nodes':512 * (1 + jobid % 8), 'procs':"%d" % (2048 * (1 + jobid % 8)),
+            'mode':"script", 'walltime':"%d" % (30 + jobid % 720), 'walltime_p':30 + jobid % 720,
+            'submittime':1300000000.0 + jobid, 'starttime':None, 'endtime':None,
+            'score':float(jobid % 1000) / 7, 'index':None, 'has_resources':state == 'running',
+            'is_runnable':state == 'queued', 'is_active':state == 'running',
+            'location':state == 'running' and ["ANL-R%02d-1024" % (jobid % 40)] or None,
+            'outputdir':"/home/user%d/runs" % (jobid % 97), 'cwd':"/home/user%d" % (jobid % 97),
+            'command':"/home/user%d/bin/a.out" % (jobid % 97), 'args':["-n", "%d" % jobid, "-v"],
+            'envs':{'OMP_NUM_THREADS':"4", 'RUN':"%d" % jobid}, 'attrs':{'location':"ANL-R00-M0-512"},
+            'dep_frac':None, 'all_dependencies':[], 'satisfied_dependencies':[],
+            'user_hold':state == 'user_hold', 'admin_hold':False, 'user_list':["user%d" % (jobid % 97)],
+            'kernel':"default", 'notify':None, 'preemptable':False, 'exit_status':None,
+        })
+    return jobs
+
+def best (func, repetitions):
+    times = []
+    for each in range(repetitions):
+        start = time.time()
+        value = func()
+        times.append(time.time() - start)
+    return min(times), value
+
+def main (count=20000, repetitions=3):
+    jobs = make_jobs(count)
+    print "%d jobs, best of %d" % (count, repetitions)
+    print "%-8s %10s %10s %10s" % ("", "size (MB)", "dumps (s)", "loads (s)")
+    for name, dumps, loads in [
+            ("xml-rpc", lambda: xmlrpclib.dumps((jobs,), methodresponse=1, allow_none=True),
+                        lambda data: xmlrpclib.loads(data)[0][0]),
+            ("json", lambda: JSONRPC.dumps_response(jobs),
+                     JSONRPC.loads_response)]:
+        dump_time, data = best(dumps, repetitions)
+        load_time, result = best(lambda: loads(data), repetitions)
+        assert result == jobs
+        print "%-8s %10.1f %10.3f %10.3f" % (name, len(data) / 1e6, dump_time, load_time)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])